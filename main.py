@@ -1,37 +1,73 @@
-from utils.sheet import Sheet, Cell
+import os
+import sys
+
+# The modules of utils import each other by name (from sheet import Sheet), as when they are run
+# from that folder, so it has to be on the path before any of them is imported
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+
+from sheet import Sheet, Cell, column_label, split_cell_name
 import tkinter as tk
 import tkinter.simpledialog as simpledialog
 from tkinter import messagebox, filedialog
 import tkinter.colorchooser as colorchooser
-from utils.calculates import FormulaParser
-import string
-import sys
-from utils.import_export import SheetLoader
+from calculates import FormulaParser
+from formula_compiler import ERRORS
+from import_export import SheetLoader
+from recalc_worker import RecalcWorker, SlicedRecalc
 
-window = tk.Tk()
-window.geometry("800x500")
-window.title("sheet")
+window = None  # the main Tk window, created by main() so the batch mode never starts Tk
 
 class UserInterface:
-    def __init__(self):
+    WINDOW_SIZE = (800, 500)
+    ENTRY_WIDTH = 10  # characters, the width of every column
+    EXPORT_ALL_FORMATS = ('.json', '.csv', '.xlsx', '.pdf')
+    EXPORT_POLL_MS = 100  # how often the progress of "Export All" is checked
+    RECALC_POLL_MS = 30  # how often the results of a background recalculation are checked
+    ROW_LABEL_WIDTH = 80  # pixels taken by the row labels and the vertical scrollbar
+    # Pixels taken by a cell (entry and padding), measured with the font size of every new pool
+    cell_size = (88, 27)
+
+    def __init__(self, slice_ms=None):
         self.file_path = None
         self.entry_font_size = 10
         self.cell_colors = {}
-        self.entry_boxes = {}
+        self.entry_boxes = {}  # (row, col) -> entry, for the visible cells
+        self.entry_cells = {}  # entry -> (row, col) of the cell it shows
         self.font_colors = {}
+        self.grid_frame = None  # frame holding the pool of entries of the visible cells
+        self.entry_styles = {}  # entry -> (bg, fg, font size) it was last painted with
+        self.pending_cells = set()  # cells whose value or style changed since the last repaint
+        self.refresh_scheduled = False
+        # Formulas are recalculated on a snapshot of the sheet in a background thread
+        self.recalc_worker = RecalcWorker()
+        self.recalc_polling = False
+        # ... or, with slice_ms, on the GUI thread in slices of at most slice_ms milliseconds
+        self.recalc_slicer = None
+        if slice_ms:
+            self.recalc_slicer = SlicedRecalc(lambda callback: window.after(1, callback), slice_ms / 1000,
+                                              on_slice=self.queue_refresh, on_done=self.finish_sliced_recalculation)
+        self.status_label = tk.Label(window, font=("Arial", 9), anchor="w")
+        self.status_label.grid(row=1, column=0, sticky="w")
+        self.export_label = tk.Label(window, font=("Arial", 9), anchor="e")
+        self.export_label.grid(row=1, column=0, sticky="e")
+        self.profiler = None  # the Profiler of the "Profile" dialog, still readable after it stops
+        self.profile_text = None  # text widget of the "Profile" dialog while it is open
+        self.profile_toggle = None
         # Ask the user whether to import a file or create a new sheet
         self.choose_option()
 
     def configure_menu_bar(self):
         menu_bar = tk.Menu(window)
         file_menu = tk.Menu(menu_bar, tearoff=0)
-        file_menu.add_command(label="Import JSON/YAML", command=self.load_file)
+        file_menu.add_command(label="Import Sheet/JSON/YAML/CSV/Excel", command=self.load_file)
         file_menu.add_separator()
+        file_menu.add_command(label="Export to Sheet (binary)", command=lambda: self.export_to_file('.hsheet'))
         file_menu.add_command(label="Export to JSON", command=lambda: self.export_to_file('.json'))
         file_menu.add_command(label="Export to YAML", command=lambda: self.export_to_file('.yaml'))
         file_menu.add_command(label="Export to PDF", command=self.export_to_pdf)
         file_menu.add_command(label="Export to CSV", command=self.export_to_csv)
         file_menu.add_command(label="Export to Excel", command=self.export_to_excel)
+        file_menu.add_command(label="Export All (JSON, CSV, Excel, PDF)", command=self.export_all)
 
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.exit_application)
@@ -46,6 +82,7 @@ class UserInterface:
 
         menu_bar.add_cascade(label="File", menu=file_menu)
         menu_bar.add_cascade(label="Edit", menu=edit_menu)
+        menu_bar.add_command(label="Profile", command=self.show_profile)
 
         window.config(menu=menu_bar)
 
@@ -59,21 +96,93 @@ class UserInterface:
             self.prompt_sheet_dimensions()
 
 
-    def update_formula_cells(self):
-        formula_cells = self.sheet.get_formula_cells()
-        for (row, col), entry in self.entry_boxes.items():
-            cell_address = self.sheet.get_cell_address(row, col)
-            if cell_address in formula_cells:
-                formula = entry.get()
-                if formula.startswith('='):
-                    # Remove leading '=' and whitespace
-                    formula = formula[1:].strip()
-                    if not formula.startswith('clr'):
-                        result = FormulaParser.evaluate_formula(formula, self.sheet)
-                        if result is not None:
-                            self.sheet.set_value(result, row, col)
-                            entry.delete(0, tk.END)
-                            entry.insert(0, str(result))  # Update entry text with result
+    def update_formula_cells(self, changed):
+        """Recalculate, in the background, only the formulas that depend on the changed cells"""
+        self.start_recalculation(changed)
+
+    def start_recalculation(self, changed=None):
+        """Hand a snapshot of the sheet to the recalculation thread (superseding the pass that is
+        running) and check for its results from the Tk mainloop"""
+        self.status_label.config(text="Recalculating... values shown may be out of date")
+        if self.recalc_slicer is not None:
+            self.recalc_slicer.submit(self.sheet, changed)
+            return
+        self.recalc_worker.submit(self.sheet, changed)
+        if not self.recalc_polling:
+            self.recalc_polling = True
+            window.after(self.RECALC_POLL_MS, self.poll_recalculation)
+
+    def finish_sliced_recalculation(self, recalculated):
+        """Report a time-sliced pass and how long its slices kept the GUI busy"""
+        stats = self.recalc_slicer.blocked_stats()
+        self.status_label.config(text=f"Recalculated {len(recalculated)} formulas, the GUI was blocked "
+                                      f"{stats['max'] * 1000:.1f} ms at most "
+                                      f"({stats['mean'] * 1000:.1f} ms on average over {stats['slices']} slices)")
+        self.show_recalculated(recalculated)
+
+    def poll_recalculation(self):
+        """Write the values of a finished pass to the sheet and show them"""
+        result = self.recalc_worker.poll()
+        error = None
+        if result is not None:
+            recalculated, values, error = result
+            for (row, col), value in values.items():
+                self.sheet.set_value(value, row, col)
+            self.show_recalculated(recalculated)
+        if self.recalc_worker.stale:
+            window.after(self.RECALC_POLL_MS, self.poll_recalculation)
+        else:
+            self.recalc_polling = False
+            self.status_label.config(text="" if error is None else f"Recalculation failed: {error}")
+
+    def show_recalculated(self, recalculated):
+        """Update the entries of recalculated cells and report the formulas that failed"""
+        errors = []
+        for row, col in recalculated:
+            value = self.sheet.get_value(row, col)
+            if value in ERRORS:
+                errors.append(f"{self.sheet.get_cell_address(row, col)}: {value}")
+        self.queue_refresh(recalculated)
+        if errors:
+            messagebox.showerror("Error", "Some formulas could not be calculated:\n" + "\n".join(errors[:20]))
+
+    def queue_refresh(self, cells):
+        """Remember cells whose value or style changed. They are repainted together by a single
+        flush once Tk is idle, so an event repaints each changed cell once at most"""
+        self.pending_cells.update(cells)
+        if self.pending_cells and not self.refresh_scheduled:
+            self.refresh_scheduled = True
+            window.after_idle(self.flush_refresh)
+
+    def flush_refresh(self):
+        """Repaint the pending cells that are visible, the others are painted when scrolled to"""
+        self.refresh_scheduled = False
+        pending, self.pending_cells = self.pending_cells, set()
+        if len(pending) > len(self.entry_boxes):
+            cells = [cell for cell in self.entry_boxes if cell in pending]
+        else:
+            cells = [cell for cell in pending if cell in self.entry_boxes]
+        for row, col in cells:
+            self.paint_entry(self.entry_boxes[(row, col)], row, col)
+
+    def paint_entry(self, entry, row, col):
+        """Show a cell in an entry, only touching the text and the options that differ"""
+        text = self.display_text(row, col)
+        if entry.get() != text:
+            entry.delete(0, tk.END)
+            entry.insert(0, text)
+        style = (self.get_cell_color(row, col), self.get_font_color(row, col), self.entry_font_size)
+        painted = self.entry_styles.get(entry)
+        if painted != style:
+            options = {}
+            if painted is None or painted[0] != style[0]:
+                options['bg'] = style[0]
+            if painted is None or painted[1] != style[1]:
+                options['fg'] = style[1]
+            if painted is None or painted[2] != style[2]:
+                options['font'] = ("Arial", style[2])
+            entry.config(**options)
+            self.entry_styles[entry] = style
 
     def bind_enter_key(self, entry):
         # Bind the Enter key to the entry widget
@@ -81,30 +190,29 @@ class UserInterface:
             entry.bind('<Return>', lambda event: self.move_focus_down(entry))
 
     def bind_focus_out_event(self, entry):
-        # Bind the <FocusOut> event to update the cell when the user exits the entry field
+        # Bind the <FocusOut> event to update the cell the entry shows when the user exits the entry field
         if entry.winfo_exists():
-            entry.bind('<FocusOut>', lambda event: self.update_formula_cells())
-        entry.bind('<FocusIn>', lambda event: self.recalculate_all_formulas())
+            entry.bind('<FocusOut>', lambda event: self.update_cell(*self.get_entry_position(entry), entry))
 
     def move_focus_down(self, entry):
         current_row, current_col = self.get_entry_position(entry)
         next_row = current_row + 1
         next_col = current_col
         if next_row < self.sheet.rows:
+            if next_row >= self.top_row + self.view_rows:
+                self.scroll_rows('scroll', 1, 'units')
             next_entry = self.entry_boxes[(next_row, next_col)]
             next_entry.focus_set()
 
     def get_entry_position(self, entry):
         """Find the position (row, col) of the given entry widget"""
-        for (row, col), widget in self.entry_boxes.items():
-            if widget == entry:
-                return row, col
-        return -1, -1  # Default if not found
+        return self.entry_cells.get(entry, (-1, -1))  # Default if not found
 
     def set_cell_color(self, row, col, color):
         """Set the color of the cell at the specified row and column."""
         cell_address = self.sheet.get_cell_address(row, col)
         self.cell_colors[cell_address] = color
+        self.queue_refresh([(row, col)])
 
     def get_cell_color(self, row, col):
         """Get the color of the cell at the specified row and column."""
@@ -112,20 +220,15 @@ class UserInterface:
         return self.cell_colors.get(cell_address, '#FFFFFF')  # Default color is black
 
     def get_cell_colors(self):
-        """Get the cell colors as a 2D array."""
-        cell_colors = []
-        for row_index in range(self.sheet.rows):
-            row_colors = []
-            for col_index in range(self.sheet.cols):
-                cell_color = self.get_cell_color(row_index, col_index)
-                row_colors.append(cell_color)
-            cell_colors.append(row_colors)
-        return cell_colors
+        """Get the colors of the colored cells as {(row, col): color}, white cells are left out."""
+        return {split_cell_name(address): color for address, color in self.cell_colors.items()
+                if color != '#FFFFFF'}
 
     def set_font_color(self, row, col, color):
         """Set the font color of the cell at the specified row and column."""
         cell_address = self.sheet.get_cell_address(row, col)
         self.font_colors[cell_address] = color
+        self.queue_refresh([(row, col)])
 
     def get_font_color(self, row, col):
         """Get the font color of the cell at the specified row and column."""
@@ -137,11 +240,11 @@ class UserInterface:
         while True:
             try:
                 dimensions = simpledialog.askstring("Enter Sheet Size",
-                                                    "Enter the number of rows "
-                                                    "(1-50) and columns (1-25) separated by comma:")
+                                                    f"Enter the number of rows (1-{Sheet.MAX_ROWS}) and "
+                                                    f"columns (1-{Sheet.MAX_COLS}) separated by comma:")
                 if dimensions:
                     rows, cols = map(int, dimensions.split(","))
-                    if 1 <= rows <= 50 and 1 <= cols <= 25:
+                    if 1 <= rows <= Sheet.MAX_ROWS and 1 <= cols <= Sheet.MAX_COLS:
                         self.sheet = Sheet(rows, cols)
                         self.display_sheet()
                         break
@@ -152,149 +255,224 @@ class UserInterface:
                 messagebox.showerror("Error", "Please enter comma-separated integers only.")
 
     def display_sheet(self):
-        """ Code to display the spreadsheet in the GUI"""
-        label_row = tk.Frame(window)
-        for col_index, label in enumerate(['']):
-            entry_width = 10  # Default width
-            tk.Label(label_row, text=label, font=("Arial", 10), width=entry_width).grid(
-                row=0, column=col_index, padx=2, pady=2)
-        label_row.grid(row=0, column=0, columnspan=self.sheet.cols + 1, sticky="nsew")
-
-        # Add non-editable entry widgets for column indices on top of the first row
-        for col_index in range(self.sheet.cols):
-            entry_width = self.get_entry_width()  # Use the width of existing entry widgets
-            entry_text = string.ascii_uppercase[col_index]  # Get the corresponding column label (A, B, C, ...)
-            entry = tk.Entry(window, font=("Arial", 10), width=entry_width)
-            entry.insert(0, entry_text)  # Insert column label
-            entry.config(state='readonly')  # Set entry to read-only
-            entry.grid(row=0, column=col_index + 1, padx=2, pady=2, sticky="nsew")
-
-        # Add entry widgets for cells
-        for row_index in range(self.sheet.rows):
-            # Add label for row index
-            row_label = tk.Label(window, text=str(row_index + 1), font=("Arial", 10), width=3)  # Adjust width here
+        """ Code to display the spreadsheet in the GUI.
+        Only the visible part of the sheet gets widgets: a fixed pool of entries, sized to the window,
+        is rebound to other cells when the user scrolls, so a big sheet opens as fast as a small one"""
+        self.top_row = 0
+        self.left_col = 0
+        self.build_viewport()
+        window.bind('<Configure>', self.on_window_resize)
+
+    def viewport_size(self, width, height):
+        """Number of rows and columns of entries that fit in a window of the given size (in pixels)"""
+        if width <= 1 or height <= 1:
+            width, height = self.WINDOW_SIZE  # the window is not drawn yet
+        cell_width, cell_height = self.cell_size
+        # the column labels, the horizontal scrollbar and the status line take a row each
+        rows = height // cell_height - 3
+        cols = (width - self.ROW_LABEL_WIDTH) // cell_width
+        return max(1, min(rows, self.sheet.rows)), max(1, min(cols, self.sheet.cols))
+
+    def build_viewport(self):
+        """Create the pool of entries, the labels and the scrollbars of the visible area,
+        replacing the widgets of the previous sheet"""
+        if self.grid_frame is not None:
+            self.grid_frame.destroy()
+            self.entry_styles = {}
+        window.update_idletasks()
+        self.measure_cell_size()
+        self.view_rows, self.view_cols = self.viewport_size(window.winfo_width(), window.winfo_height())
+        self.top_row = min(self.top_row, self.sheet.rows - self.view_rows)
+        self.left_col = min(self.left_col, self.sheet.cols - self.view_cols)
+
+        self.grid_frame = tk.Frame(window)
+        self.grid_frame.grid(row=0, column=0, sticky="nsew")
+        window.grid_rowconfigure(0, weight=1)
+        window.grid_columnconfigure(0, weight=1)
+
+        # Labels of the visible columns on top of the first row
+        self.column_labels = []
+        for col_index in range(self.view_cols):
+            label = tk.Label(self.grid_frame, font=("Arial", 10), borderwidth=1, relief="sunken",
+                             width=self.ENTRY_WIDTH)
+            label.grid(row=0, column=col_index + 1, padx=2, pady=2, sticky="nsew")
+            self.column_labels.append(label)
+
+        # Pool of entries for the visible cells, every row with its label
+        self.row_labels = []
+        self.entry_pool = []
+        for row_index in range(self.view_rows):
+            row_label = tk.Label(self.grid_frame, font=("Arial", 10), width=max(3, len(str(self.sheet.rows))))
             row_label.grid(row=row_index + 1, column=0, padx=2, pady=2, sticky="nsew")
-
-            for col_index in range(self.sheet.cols):
-                value = self.sheet.get_value(row_index, col_index)
-                formula = self.sheet.get_formula(row_index, col_index)
-
-                entry = tk.Entry(window, font=("Arial", 10), borderwidth=1, relief="raised", width=10)
-                entry.insert(0, str(value) if value is not None else str(formula))
+            self.row_labels.append(row_label)
+            pool_row = []
+            for col_index in range(self.view_cols):
+                entry = tk.Entry(self.grid_frame, font=("Arial", self.entry_font_size), borderwidth=1,
+                                 relief="raised", width=self.ENTRY_WIDTH)
                 entry.grid(row=row_index + 1, column=col_index + 1, padx=2, pady=2, sticky="nsew")
-                self.bind_focus_out_event(entry)  # Bind FocusOut event
-
-                # Bind the <FocusOut> event to update the cell when the user exits the entry field
-                entry.bind('<FocusOut>',
-                           lambda event, row=row_index, col=col_index, entry=entry: self.update_cell(row, col, entry))
-
-                # Bind Enter key for all entry widgets
+                self.bind_focus_out_event(entry)
                 self.bind_enter_key(entry)
-                self.entry_boxes[(row_index, col_index)] = entry  # Store the entry widget after creation
+                self.bind_mouse_wheel(entry)
+                pool_row.append(entry)
+            self.entry_pool.append(pool_row)
 
-        # Configure column and row weights for dynamic resizing
-        window.grid_columnconfigure(0, weight=1)  # Row index column
-        for i in range(self.sheet.cols):
-            window.grid_columnconfigure(i + 1, weight=1)
-        for i in range(self.sheet.rows):
-            window.grid_rowconfigure(i + 1, weight=1)
-
-    def get_entry_width(self):
-        """Determine the width of the existing entry widgets."""
-        max_width = 0
-        for entry in self.entry_boxes.values():
-            width = entry.winfo_width()
-            if width > max_width:
-                max_width = width
-        return max_width
+        self.vertical_scrollbar = tk.Scrollbar(self.grid_frame, orient=tk.VERTICAL, command=self.scroll_rows)
+        self.vertical_scrollbar.grid(row=1, column=self.view_cols + 1, rowspan=self.view_rows, sticky="ns")
+        self.horizontal_scrollbar = tk.Scrollbar(self.grid_frame, orient=tk.HORIZONTAL, command=self.scroll_cols)
+        self.horizontal_scrollbar.grid(row=self.view_rows + 1, column=1, columnspan=self.view_cols, sticky="ew")
+        self.bind_mouse_wheel(self.grid_frame)
 
+        # Configure column and row weights for dynamic resizing
+        self.grid_frame.grid_columnconfigure(0, weight=1)  # Row index column
+        for i in range(self.view_cols):
+            self.grid_frame.grid_columnconfigure(i + 1, weight=1)
+        for i in range(self.view_rows):
+            self.grid_frame.grid_rowconfigure(i + 1, weight=1)
+
+        self.render_viewport()
+
+    def measure_cell_size(self):
+        """Measure the pixels taken by a cell with the current font size. Every column has the same
+        width, one entry gives the size of all the cells"""
+        entry = tk.Entry(window, font=("Arial", self.entry_font_size), borderwidth=1, relief="raised",
+                         width=self.ENTRY_WIDTH)
+        self.cell_size = (entry.winfo_reqwidth() + 4, entry.winfo_reqheight() + 4)
+        entry.destroy()
+
+    def render_viewport(self):
+        """Rebind the pool of entries to the cells under the viewport and show their values"""
+        self.entry_boxes = {}
+        self.entry_cells = {}
+        for row_index, pool_row in enumerate(self.entry_pool):
+            row = self.top_row + row_index
+            self.row_labels[row_index].config(text=str(row + 1))
+            for col_index, entry in enumerate(pool_row):
+                col = self.left_col + col_index
+                self.paint_entry(entry, row, col)
+                self.entry_boxes[(row, col)] = entry
+                self.entry_cells[entry] = (row, col)
+        for col_index, label in enumerate(self.column_labels):
+            label.config(text=column_label(self.left_col + col_index))
+        self.vertical_scrollbar.set(self.top_row / self.sheet.rows,
+                                    (self.top_row + self.view_rows) / self.sheet.rows)
+        self.horizontal_scrollbar.set(self.left_col / self.sheet.cols,
+                                      (self.left_col + self.view_cols) / self.sheet.cols)
+
+    def display_text(self, row, col):
+        """Text shown in the entry of a cell: its value, or its formula when it has no value.
+        Values are stored typed, this is the only place they are formatted"""
+        value = self.sheet.get_value(row, col)
+        if value is None:
+            return str(self.sheet.get_formula(row, col))
+        if isinstance(value, bool):
+            return "TRUE" if value else "FALSE"
+        return str(value)
+
+    @staticmethod
+    def scroll_position(args, first, visible, total):
+        """New first visible row (or column) for the arguments of a scrollbar command:
+        ('moveto', fraction) or ('scroll', count, 'units' or 'pages')"""
+        if args[0] == 'moveto':
+            first = int(float(args[1]) * total)
+        elif args[0] == 'scroll':
+            first += int(args[1]) * (visible if args[2] == 'pages' else 1)
+        return max(0, min(first, total - visible))
+
+    def scroll_rows(self, *args):
+        """Command of the vertical scrollbar"""
+        top_row = self.scroll_position(args, self.top_row, self.view_rows, self.sheet.rows)
+        if top_row != self.top_row:
+            self.commit_focused_entry()
+            self.top_row = top_row
+            self.render_viewport()
+
+    def scroll_cols(self, *args):
+        """Command of the horizontal scrollbar"""
+        left_col = self.scroll_position(args, self.left_col, self.view_cols, self.sheet.cols)
+        if left_col != self.left_col:
+            self.commit_focused_entry()
+            self.left_col = left_col
+            self.render_viewport()
+
+    def bind_mouse_wheel(self, widget):
+        # Scroll the rows with the mouse wheel (<Button-4>/<Button-5> on X11)
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            widget.bind(sequence, self.on_mouse_wheel)
+
+    def on_mouse_wheel(self, event):
+        self.scroll_rows('scroll', -3 if event.num == 4 or event.delta > 0 else 3, 'units')
+        return "break"
+
+    def on_window_resize(self, event):
+        """Resize the pool of entries when the window can show more (or less) cells"""
+        if event.widget is window and self.viewport_size(event.width, event.height) != (self.view_rows,
+                                                                                        self.view_cols):
+            self.commit_focused_entry()
+            self.build_viewport()
+
+    def commit_focused_entry(self):
+        """Save the edit of the focused entry before the pool is rebound to other cells"""
+        focused_widget = window.focus_get()
+        row, col = self.get_entry_position(focused_widget)
+        if row != -1:
+            self.update_cell(row, col, focused_widget)
+            self.grid_frame.focus_set()
 
     def update_cell(self, row, col, entry):
+        if row == -1:
+            return  # the entry is no longer bound to a cell
         try:
             new_value = entry.get()  # Get the new value from the entry widget
+            if new_value == self.display_text(row, col):
+                # The entry still shows the value of the cell, nothing was edited
+                return
             if new_value.startswith('='):
                 formula = new_value[1:].strip()  # Remove leading '='
-                if formula.upper().startswith(('SUM', 'AVERAGE', 'MAX', 'MIN')):
-                    # Evaluate built-in function
-                    result = FormulaParser.evaluate_formula(formula, self.sheet)
-                elif formula.startswith('clr'):
+                if formula.startswith('clr'):
                     # Apply color formula
                     self.apply_color_formula(formula[4:-1])  # Extract cell range from formula
                     result = None
                 else:
-                    # Evaluate the mathematical expression
-                    result = FormulaParser.convert_to_math_formula(formula, self.sheet)
+                    # Evaluate the compiled formula (math expressions and built-in functions)
+                    result = FormulaParser.evaluate_formula(formula, self.sheet)
 
                 if result is not None:
-                    self.sheet.set_value(result, row, col)
                     self.sheet.set_formula(new_value, row, col)
-                    entry.delete(0, tk.END)
-                    entry.insert(0, str(result))
-
-                    # Reevaluate all formula cells
-                    self.recalculate_all_formulas()
+                    self.sheet.set_value(result, row, col)
             else:
+                self.sheet.clear_formula(row, col)
                 self.sheet.set_value(new_value, row, col)
-                # Update entry text to match the new value
-                entry.delete(0, tk.END)
-                entry.insert(0, str(new_value))
 
-            # Check for division by zero errors in formula cells
-            self.check_for_division_by_zero()
-
-        except ValueError as e:
-            # Handle invalid input (e.g., non-numeric values)
-            messagebox.showerror("Error", str(e))
-            print("Error:", e)
+            # Reevaluate only the formula cells that depend on this cell
+            self.queue_refresh([(row, col)])
+            self.update_formula_cells([(row, col)])
 
-    def check_for_division_by_zero(self):
-        try:
-            self.recalculate_all_formulas()
-        except ZeroDivisionError:
-            # Handle division by zero error
-            messagebox.showerror("Error", "Division by zero error detected in formula.")
         except ValueError as e:
+            # Handle invalid input (e.g., non-numeric values, division by zero)
             messagebox.showerror("Error", str(e))
             print("Error:", e)
 
     def recalculate_all_formulas(self):
-        for (row, col), entry in self.entry_boxes.items():
-            formula = self.sheet.get_formula(row, col)
-            if formula is not None and formula.startswith('='):
-                # Remove leading '=' and whitespace
-                formula = formula[1:].strip()
-                if formula.upper().startswith(('SUM', 'AVERAGE', 'MAX', 'MIN')):
-                    # Evaluate built-in function
-                    result = FormulaParser.evaluate_formula(formula, self.sheet)
-                elif formula.startswith('clr'):
-                    # Apply color formula
-                    self.apply_color_formula(formula[4:-1])  # Extract cell range from formula
-                    result = None
-                else:
-                    # Evaluate the mathematical expression
-                    result = FormulaParser.convert_to_math_formula(formula, self.sheet)
-
-                if result is not None:
-                    self.sheet.set_value(result, row, col)
-                    entry.delete(0, tk.END)
-                    entry.insert(0, str(result))  # Update entry text with result
+        """Recalculate every formula of the sheet in the background and show the results"""
+        self.start_recalculation()
 
     def load_file(self):
         """load imported file"""
-        file_path = filedialog.askopenfilename(filetypes=[("JSON Files", "*.json"), ("YAML Files", "*.yaml")])
+        file_path = filedialog.askopenfilename(filetypes=[("Sheet Files", "*.hsheet"), ("JSON Files", "*.json"),
+                                                          ("YAML Files", "*.yaml"), ("CSV Files", "*.csv"),
+                                                          ("Excel Files", "*.xlsx")])
         if file_path:
             self.file_path = file_path
-            if self.file_path.endswith('.json'):
-                loaded_sheet = SheetLoader.load_from_json(self.file_path)
-            elif self.file_path.endswith('.yaml'):
-                loaded_sheet = SheetLoader.load_from_yaml(self.file_path)
-            else:
+            try:
+                loaded_sheet = SheetLoader.load(self.file_path)
+            except ValueError:
                 messagebox.showerror("Error", "Unsupported file format.")
                 return
 
             if loaded_sheet:
                 self.sheet = loaded_sheet
                 self.display_sheet()
+                self.recalculate_all_formulas()
 
     def prompt_font_color_change(self):
         """Prompt the user to choose a font color for the selected cell"""
@@ -303,13 +481,6 @@ class UserInterface:
             color = colorchooser.askcolor(title="Choose Font Color")
             if color[1]:  # If a color was chosen
                 self.set_font_color(cell_address[0], cell_address[1], color[1])
-                self.refresh_font_colors()
-
-    def refresh_font_colors(self):
-        """Update font colors of all cells based on sheet data"""
-        for (row, col), entry in self.entry_boxes.items():
-            font_color = self.get_font_color(row, col)
-            entry.config(fg=font_color)
 
     def prompt_color_change(self):
         """Allow user to choose a color for the selected cell"""
@@ -318,19 +489,9 @@ class UserInterface:
             color = colorchooser.askcolor(title="Choose Color")
             if color[1]:  # If a color was chosen
                 self.set_cell_color(cell_address[0], cell_address[1], color[1])
-                self.refresh_cell_colors()
-
-    def refresh_cell_colors(self):
-        for (row, col), entry in self.entry_boxes.items():
-            cell_color = self.get_cell_color(row, col)
-            entry.config(bg=cell_color)
 
     def get_selected_cell(self):
-        focused_widget = window.focus_get()
-        for (row, col), entry in self.entry_boxes.items():
-            if entry == focused_widget:
-                return row, col
-        return None
+        return self.entry_cells.get(window.focus_get())
 
     def apply_color_formula(self, cell_range):
         start, end = cell_range.split(":")
@@ -344,7 +505,6 @@ class UserInterface:
             for row in range(start_row, end_row + 1):
                 for col in range(start_col, end_col + 1):
                     self.set_cell_color(row, col, chosen_color)
-        self.refresh_cell_colors()
 
     def increase_font_size(self):
         self.entry_font_size += 1
@@ -356,8 +516,9 @@ class UserInterface:
             self.refresh_entry_font_size()
 
     def refresh_entry_font_size(self):
-        for entry in self.entry_boxes.values():
-            entry.config(font=("Arial", self.entry_font_size))
+        # The cells grow or shrink with the font, so the window fits another number of them
+        self.commit_focused_entry()
+        self.build_viewport()
 
     def exit_application(self):
         window.destroy()
@@ -368,12 +529,18 @@ class UserInterface:
             return
 
         file_path = filedialog.asksaveasfilename(defaultextension=file_extension,
-                                                 filetypes=[("JSON Files", "*.json"), ("YAML Files", "*.yaml")])
+                                                 filetypes=[("Sheet Files", "*.hsheet"), ("JSON Files", "*.json"),
+                                                            ("YAML Files", "*.yaml")])
         if file_path:
-            if file_extension == '.json':
-                SheetLoader.export_to_json(self.sheet, file_path)
-            elif file_extension == '.yaml':
-                SheetLoader.export_to_yaml(self.sheet, file_path)
+            try:
+                if file_extension == '.hsheet':
+                    SheetLoader.export_to_native(self.sheet, file_path)
+                elif file_extension == '.json':
+                    SheetLoader.export_to_json(self.sheet, file_path)
+                elif file_extension == '.yaml':
+                    SheetLoader.export_to_yaml(self.sheet, file_path)
+            except Exception as e:
+                messagebox.showerror("Error", f"An unexpected error occurred: {str(e)}")
 
     def export_to_pdf(self):
         """Export the sheet to a PDF file."""
@@ -418,14 +585,123 @@ class UserInterface:
             except Exception as e:
                 messagebox.showerror("Error", f"An unexpected error occurred: {str(e)}")
 
-def main():
-    user_interface = UserInterface()
+    def export_all(self):
+        """Export the sheet to every format of EXPORT_ALL_FORMATS at once. The exports run in worker
+        processes on a snapshot of the sheet, so it can be edited while they run"""
+        if not self.sheet:
+            messagebox.showerror("Error", "No sheet data to export.")
+            return
+
+        file_path = filedialog.asksaveasfilename(title="Export All (the extension of each format is added)")
+        if file_path:
+            base_path = os.path.splitext(file_path)[0]
+            try:
+                self.export_futures = SheetLoader.export_all(
+                    self.sheet, [base_path + extension for extension in self.EXPORT_ALL_FORMATS],
+                    cell_colors=self.get_cell_colors())
+            except Exception as e:
+                messagebox.showerror("Error", f"An unexpected error occurred: {str(e)}")
+                return
+            self.poll_export_all()
+
+    def poll_export_all(self):
+        """Show the progress of "Export All" and report the files that could not be written"""
+        done = [future for future in self.export_futures.values() if future.done()]
+        self.export_label.config(text=f"Exporting: {len(done)} of {len(self.export_futures)} files written")
+        if len(done) < len(self.export_futures):
+            window.after(self.EXPORT_POLL_MS, self.poll_export_all)
+            return
+        failed = [str(future.exception()) for future in done if future.exception() is not None]
+        self.export_label.config(text="")
+        if failed:
+            messagebox.showerror("Error", "Some files could not be exported:\n" + "\n".join(failed))
+        else:
+            messagebox.showinfo("Success", "Sheet exported to:\n" + "\n".join(self.export_futures))
+
+    def show_profile(self):
+        """Open the "Profile" dialog: the slowest formulas, the range functions, the formula cache
+        and the recalculation passes, recorded while profiling is on"""
+        if self.profile_text is not None:
+            self.profile_text.winfo_toplevel().lift()
+            return
+        dialog = tk.Toplevel(window)
+        dialog.title("Profile")
+        self.profile_text = tk.Text(dialog, width=100, height=30, font=("Courier", 9))
+        self.profile_text.pack(fill="both", expand=True)
+        buttons = tk.Frame(dialog)
+        buttons.pack(fill="x")
+        self.profile_toggle = tk.Button(buttons, command=self.toggle_profiling)
+        self.profile_toggle.pack(side="left")
+        tk.Button(buttons, text="Reset", command=self.reset_profile).pack(side="left")
+        tk.Button(buttons, text="Refresh", command=self.refresh_profile).pack(side="left")
+        tk.Button(buttons, text="Dump...", command=self.dump_profile).pack(side="left")
+        dialog.protocol("WM_DELETE_WINDOW", lambda: self.close_profile(dialog))
+        self.refresh_profile()
+
+    def close_profile(self, dialog):
+        """Close the "Profile" dialog, profiling goes on until it is stopped"""
+        self.profile_text = self.profile_toggle = None
+        dialog.destroy()
+
+    def toggle_profiling(self):
+        """Start or stop recording"""
+        if FormulaParser.profiler() is None:
+            self.profiler = FormulaParser.start_profiling()
+        else:
+            FormulaParser.stop_profiling()
+        self.refresh_profile()
+
+    def reset_profile(self):
+        if self.profiler is not None:
+            self.profiler.reset()
+        self.refresh_profile()
+
+    def refresh_profile(self):
+        """Show what the profiler recorded so far"""
+        if self.profile_text is None:
+            return
+        recording = FormulaParser.profiler() is not None
+        self.profile_toggle.config(text="Stop" if recording else "Start")
+        if self.profiler is None:
+            report = "Profiling is off. Start it, edit or recalculate the sheet and refresh."
+        else:
+            report = ("Recording.\n\n" if recording else "Stopped.\n\n") + self.profiler.report()
+        self.profile_text.delete("1.0", tk.END)
+        self.profile_text.insert("1.0", report)
+
+    def dump_profile(self):
+        """Save what the profiler recorded to a JSON file, for offline analysis"""
+        if self.profiler is None:
+            messagebox.showerror("Error", "Nothing was profiled yet.")
+            return
+        file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON Files", "*.json")])
+        if file_path:
+            try:
+                self.profiler.dump(file_path)
+            except OSError as e:
+                messagebox.showerror("Error", f"The profile could not be saved: {str(e)}")
+
+def main(slice_ms=None):
+    global window
+    window = tk.Tk()
+    window.geometry("%dx%d" % UserInterface.WINDOW_SIZE)
+    window.title("sheet")
+    user_interface = UserInterface(slice_ms)
     user_interface.configure_menu_bar()
     window.mainloop()
 
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "--help":
         print("call 'main' to activate the program. Choose Sheet dimensions or import a file. Then,"
-              "you will be able to edit your sheet")
+              "you will be able to edit your sheet\n"
+              "call 'main --batch FILE... --to FORMAT' to recalculate and export many sheets "
+              "without the GUI ('main --batch --help' for details)\n"
+              "call 'main --slice-ms MS' to recalculate on the GUI thread in slices of at most MS "
+              "milliseconds instead of in a background thread")
+    elif len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        from batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    elif len(sys.argv) > 2 and sys.argv[1] == "--slice-ms":
+        main(float(sys.argv[2]))
     else:
         main()
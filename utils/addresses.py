@@ -0,0 +1,39 @@
+import string
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def column_label(col):
+    """converts a 0 based column index to its letters (0 -> A, 25 -> Z, 26 -> AA, ...)"""
+    if col < 0:
+        raise IndexError("Column index is out of range")
+    label = ''
+    col += 1
+    while col:
+        col, remainder = divmod(col - 1, 26)
+        label = string.ascii_uppercase[remainder] + label
+    return label
+
+
+def column_index(label):
+    """converts column letters to a 0 based column index (A -> 0, Z -> 25, AA -> 26, ...)"""
+    col = 0
+    for letter in label.upper():
+        if not ('A' <= letter <= 'Z'):
+            raise ValueError("Error: First part of the cell name must be a letter.")
+        col = col * 26 + ord(letter) - ord('A') + 1
+    return col - 1
+
+
+def split_cell_name(name):
+    """splits a cell name like 'AB12' to a (row, col) tuple of 0 based indices"""
+    name = name.strip()
+    letters_end = 0
+    while letters_end < len(name) and name[letters_end].isalpha():
+        letters_end += 1
+    if letters_end == 0:
+        raise ValueError("Error: First part of the cell name must be a letter.")
+    row = int(name[letters_end:])
+    if row < 1:
+        raise ValueError("Error: Row numbers start at 1.")
+    return row - 1, column_index(name[:letters_end])
@@ -0,0 +1,97 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+from import_export import FORMATS, SheetLoader
+
+# Formats the batch can export to (the exporters themselves are imported on first use)
+EXPORT_FORMATS = sorted(extension[1:] for extension, (_, exporter) in FORMATS.items() if exporter)
+
+
+def output_path_for(input_path, output_dir, output_format):
+    """the output file of an input file: same name, new extension, in output_dir (or next to the input)"""
+    base_name = os.path.splitext(os.path.basename(input_path))[0] + '.' + output_format
+    return os.path.join(output_dir or os.path.dirname(input_path), base_name)
+
+
+def convert_file(task):
+    """load one sheet, recalculate every formula and export it. runs in a worker process,
+    returns a dictionary with the timings (in seconds) or the error"""
+    input_path, output_path, output_format = task
+    result = {'input': input_path, 'output': output_path, 'formulas': 0, 'error': None}
+    started = time.perf_counter()
+    messages = io.StringIO()  # the loaders print their errors instead of raising, keep them out of the report
+    try:
+        with redirect_stdout(messages):
+            convert_sheet(input_path, output_path, output_format, result, started)
+    except Exception as e:
+        result['error'] = messages.getvalue().strip() or str(e)
+    result['total'] = time.perf_counter() - started
+    return result
+
+
+def convert_sheet(input_path, output_path, output_format, result, started):
+    """the steps of convert_file, timings are added to result"""
+    sheet = SheetLoader.load(input_path)
+    if sheet is None:
+        raise ValueError("The file could not be loaded.")
+    loaded = time.perf_counter()
+
+    result['formulas'] = len(sheet.recalculate())
+    recalculated = time.perf_counter()
+
+    # A failed export keeps the file an earlier run wrote
+    SheetLoader.export_replacing(sheet, output_path)
+    exported = time.perf_counter()
+
+    result.update(load=loaded - started, recalc=recalculated - loaded, export=exported - recalculated)
+
+
+def run_batch(input_paths, output_format, output_dir=None, processes=None):
+    """convert many files in a process pool (one process per core by default).
+    yields the result of every file as soon as it is done, in completion order"""
+    tasks = [(path, output_path_for(path, output_dir, output_format), output_format) for path in input_paths]
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    processes = min(processes or os.cpu_count() or 1, max(len(tasks), 1))
+    with Pool(processes) as pool:
+        yield from pool.imap_unordered(convert_file, tasks)
+
+
+def format_result(result):
+    if result['error']:
+        return f"FAILED {result['input']}: {result['error']} ({result['total']:.3f}s)"
+    return (f"{result['input']} -> {result['output']}: {result['formulas']} formulas, "
+            f"load {result['load']:.3f}s, recalc {result['recalc']:.3f}s, "
+            f"export {result['export']:.3f}s, total {result['total']:.3f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="main.py --batch",
+        description="Recalculate sheets and export them, using every core of the machine.")
+    parser.add_argument("files", nargs="+", help="sheets to convert (any format SheetLoader can load)")
+    parser.add_argument("--to", dest="output_format", choices=EXPORT_FORMATS, required=True,
+                        help="format to export to")
+    parser.add_argument("--output-dir", help="folder for the exported files (default: next to each input)")
+    parser.add_argument("--processes", type=int, help="number of worker processes (default: number of cores)")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per file instead of text")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    failed = 0
+    for result in run_batch(args.files, args.output_format, args.output_dir, args.processes):
+        failed += result['error'] is not None
+        print(json.dumps(result) if args.json else format_result(result), flush=True)
+    if not args.json:
+        print(f"{len(args.files) - failed} of {len(args.files)} files converted "
+              f"in {time.perf_counter() - started:.3f}s", flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""Benchmark suite of the sheet engine, the file formats and the paths the GUI repaints.
+
+Synthetic sheets are generated for every size in SIZES (cells, 10 columns wide) and every
+profile in PROFILES (the share of the columns holding formulas). On each sheet it times:
+
+    construct    Sheet() and writing every value cell
+    set_value    random writes, get_value: random reads
+    parse        compiling every formula text, with the formula cache cleared
+    recalc_full  recalculate() of every formula, recalc_incremental: one edit and its dependents
+    aggregates   SUM, AVERAGE, MAX and MIN over whole columns
+    viewport     the text of every cell of a screen of entries, at several scroll positions
+    export/load  every SheetLoader format (a format whose library is missing is skipped)
+
+Results are {'<size>/<profile>/<benchmark>': seconds}, the best of --repeat runs. Run it with
+'python benchmark.py' from the utils folder, --json writes the results and --baseline compares
+them with the results of an earlier run, the exit code is 1 when a benchmark regressed.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from addresses import column_label
+from formula_compiler import compile_cached, compile_formula
+from import_export import FORMATS, SheetLoader
+from sheet import Sheet
+
+COLUMNS = 10
+
+# Sheet sizes, in cells
+SIZES = {'1k': 1000, '10k': 10000, '100k': 100000, '1M': 1000000, '10M': 10000000}
+DEFAULT_SIZES = ('1k', '10k')  # up to 10M with --sizes, the slow formats (yaml, pdf) can be left out with --formats
+
+# Share of the columns holding formulas
+PROFILES = {'light': 0.1, 'heavy': 0.5}
+
+# Formats timed by default: one extension per loader (.yml is .yaml)
+DEFAULT_FORMATS = ('.hsheet', '.json', '.yaml', '.csv', '.xlsx', '.pdf')
+
+# Random reads and writes timed per sheet, at most
+ACCESSES = 100000
+
+# A benchmark regressed when it is slower than the baseline by more than the tolerance
+# (a ratio) and by more than MIN_DELTA seconds, so timer noise on tiny timings isn't flagged
+DEFAULT_TOLERANCE = 0.2
+MIN_DELTA = 0.001
+
+
+def formula_text(formula_col, row, rows):
+    """the formula of a cell of a synthetic sheet: arithmetic on the values of its row, a SUM
+    of the next ten rows, or a chain through the formula column on its left"""
+    kind = formula_col % 3
+    if kind == 0:
+        return f"=A{row + 1}+B{row + 1}*2"
+    if kind == 1:
+        return f"=SUM(A{row + 1}:B{min(row + 10, rows)})"
+    return f"={column_label(formula_col - 1)}{row + 1}+1"
+
+
+def generate_sheet(cells, formula_share):
+    """return (sheet, formula cells) of a synthetic sheet of about the given number of cells.
+    the first columns hold numbers (every tenth one a text), the last ones formulas"""
+    rows = max(cells // COLUMNS, 1)
+    formula_cols = max(1, round(COLUMNS * formula_share)) if formula_share else 0
+    value_cols = COLUMNS - formula_cols
+    sheet = Sheet(rows, COLUMNS)
+    fill_values(sheet, value_cols)
+    formula_cells = []
+    for col in range(value_cols, COLUMNS):
+        for row in range(rows):
+            sheet.set_formula(formula_text(col, row, rows), row, col)
+            formula_cells.append((row, col))
+    return sheet, formula_cells
+
+
+def fill_values(sheet, value_cols):
+    """write the value cells of a synthetic sheet"""
+    for col in range(value_cols):
+        for row in range(sheet.rows):
+            sheet.set_value(f"label {row}" if row % 10 == 9 else row * (col + 1) % 997 + 0.5 * col, row, col)
+
+
+def best_time(function, repeat):
+    """return the fastest of repeat runs of function(), in seconds"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def engine_benchmarks(sheet, formula_cells, repeat):
+    """time the engine on a synthetic sheet, returns {benchmark: seconds}"""
+    rows = sheet.rows
+    value_cols = min((col for _, col in formula_cells), default=COLUMNS)
+    accesses = min(rows * COLUMNS, ACCESSES)
+    generator = random.Random(0)
+    cells = [(generator.randrange(rows), generator.randrange(value_cols)) for _ in range(accesses)]
+    texts = [sheet.get_formula(row, col) for row, col in formula_cells]
+
+    def construct():
+        fill_values(Sheet(rows, COLUMNS), value_cols)
+
+    def write():
+        for row, col in cells:
+            sheet.set_value(row + 0.5, row, col)
+
+    def read():
+        for row, col in cells:
+            sheet.get_value(row, col)
+
+    def parse():
+        compile_cached.cache_clear()
+        for text in texts:
+            compile_formula(text)
+
+    def edit():
+        row = rows // 2
+        sheet.set_value(sheet.cells.number_at(row, 0) + 1, row, 0)
+        sheet.recalculate([(row, 0)])
+
+    aggregates = [f"{name}({column_label(col)}1:{column_label(col)}{rows})"
+                  for name in ('SUM', 'AVERAGE', 'MAX', 'MIN') for col in range(value_cols)]
+
+    def aggregate():
+        for text in aggregates:
+            compile_formula(text).evaluate(sheet)
+
+    def viewport():
+        # A screen of the default window: 15 rows of 8 entries, at the top, middle and bottom
+        for first in (0, max(rows // 2 - 7, 0), max(rows - 15, 0)):
+            for row in range(first, min(first + 15, rows)):
+                for col in range(min(8, COLUMNS)):
+                    value = sheet.get_value(row, col)
+                    str(value) if value is not None else str(sheet.get_formula(row, col))
+
+    results = {'construct': best_time(construct, repeat), 'set_value': best_time(write, repeat),
+               'get_value': best_time(read, repeat), 'parse': best_time(parse, repeat)}
+    if formula_cells:
+        results['recalc_full'] = best_time(sheet.recalculate, repeat)
+        results['recalc_incremental'] = best_time(edit, repeat)
+    results['aggregates'] = best_time(aggregate, repeat)
+    results['viewport'] = best_time(viewport, repeat)
+    return results
+
+
+def format_benchmarks(sheet, formats, directory, repeat):
+    """time the export and the load of every format, returns {benchmark: seconds}. formats whose
+    library is missing (or that fail) are left out, with a note on stderr"""
+    results = {}
+    for extension in formats:
+        loader, exporter = FORMATS[extension]
+        file_path = os.path.join(directory, 'benchmark' + extension)
+
+        def export():
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            SheetLoader.export(sheet, file_path)
+
+        messages = io.StringIO()  # SheetLoader prints its progress and errors
+        try:
+            with redirect_stdout(messages):
+                export_time = best_time(export, repeat)
+                if not os.path.exists(file_path):
+                    raise ValueError(messages.getvalue().strip() or "nothing was written")
+                results['export' + extension] = export_time
+                if loader:
+                    load_time = best_time(lambda: SheetLoader.load(file_path), repeat)
+                    results['load' + extension] = load_time
+        except (ImportError, ValueError) as e:
+            print(f"skipped {extension}: {e}", file=sys.stderr)
+    return results
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, profiles=tuple(PROFILES), formats=DEFAULT_FORMATS, repeat=3):
+    """run the suite, returns {'<size>/<profile>/<benchmark>': seconds}"""
+    results = {}
+    directory = tempfile.mkdtemp(prefix='sheet-benchmark-')
+    try:
+        for size in sizes:
+            for profile in profiles:
+                sheet, formula_cells = generate_sheet(SIZES[size], PROFILES[profile])
+                timings = engine_benchmarks(sheet, formula_cells, repeat)
+                timings.update(format_benchmarks(sheet, formats, directory, repeat))
+                for name, seconds in timings.items():
+                    results[f"{size}/{profile}/{name}"] = seconds
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """return [(benchmark, baseline seconds, seconds)] of the benchmarks slower than the baseline
+    by more than the tolerance. benchmarks missing from either side are not compared"""
+    regressions = []
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before is not None and seconds > before * (1 + tolerance) and seconds - before > MIN_DELTA:
+            regressions.append((name, before, seconds))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the sheet engine and the file formats on synthetic sheets.")
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES),
+                        help=f"comma separated sheet sizes, out of {', '.join(SIZES)}")
+    parser.add_argument('--profiles', default=','.join(PROFILES),
+                        help=f"comma separated formula profiles, out of {', '.join(PROFILES)}")
+    parser.add_argument('--formats', default=','.join(extension[1:] for extension in DEFAULT_FORMATS),
+                        help="comma separated file formats to time, 'none' for the engine only")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of every benchmark, the fastest is kept")
+    parser.add_argument('--json', dest='output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare with the results of an earlier run (a --json file)")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="slowdown ratio allowed before a benchmark counts as a regression")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes.split(',')
+    profiles = args.profiles.split(',')
+    formats = [] if args.formats == 'none' else ['.' + name.lstrip('.') for name in args.formats.split(',')]
+    unknown = ([size for size in sizes if size not in SIZES] + [profile for profile in profiles if profile not in PROFILES]
+               + [extension for extension in formats if extension not in FORMATS])
+    if unknown:
+        parser.error(f"unknown sizes, profiles or formats: {', '.join(unknown)}")
+
+    results = run_benchmarks(sizes, profiles, formats, args.repeat)
+    for name, seconds in results.items():
+        print(f"{name}: {seconds:.6f}s")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                       'results': results}, file, indent=2)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)['results']
+    regressions = compare(results, baseline, args.tolerance)
+    for name, before, seconds in regressions:
+        print(f"REGRESSION: {name} took {seconds:.6f}s, the baseline is {before:.6f}s ({seconds / before:.2f}x)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,84 +1,42 @@
-from tkinter import messagebox
 from sheet import Cell
-import re
+import profiling
+from formula_compiler import FUNCTIONS, FormulaReferenceError, compile_formula
 
 class FormulaParser:
+    @staticmethod
+    def compile(formula):
+        """compile a formula once, later calls with the same text come from the cache"""
+        return compile_formula(formula)
+
     @staticmethod
     def evaluate_formula(formula, sheet):
-        """evaluating mathematical formulas"""
-        formula = formula.lstrip('=').strip()
-
-        # Split formula into function name and arguments
-        parts = formula.split("(")
-        if len(parts) < 2:
-            messagebox.showerror("Error", "Invalid formula format!")
-            return None
-
-        function_name = parts[0].upper()
-        arguments = parts[1].rstrip(")")  # Extract arguments (remove closing parenthesis)
-
-        # Call the appropriate method from FunctionLibrary based on function name
-        if function_name == "SUM":
-            return FunctionLibrary.calc_sum(arguments, sheet)
-        elif function_name == "AVERAGE":
-            return FunctionLibrary.average(arguments, sheet)
-        elif function_name == "MAX":
-            return FunctionLibrary.find_max(arguments, sheet)
-        elif function_name == "MIN":
-            return FunctionLibrary.find_min(arguments, sheet)
-        else:
-            # Handle unsupported function
-            messagebox.showerror("Error", "Unsupported function: " + function_name)
-            return None
+        """evaluating mathematical formulas, raises a FormulaError (a ValueError) if the formula
+        is invalid or can't be calculated"""
+        compiled = compile_formula(formula)
+        if profiling.active is not None:
+            return profiling.active.evaluate(compiled, sheet)
+        return compiled.evaluate(sheet)
+
+    @staticmethod
+    def start_profiling():
+        """record formula evaluations, range functions and recalculation passes (see profiling),
+        returns the active Profiler"""
+        return profiling.enable()
+
+    @staticmethod
+    def stop_profiling():
+        """stop recording, returns the Profiler with what it recorded (None if profiling was off)"""
+        return profiling.disable()
+
+    @staticmethod
+    def profiler():
+        """the active Profiler, None when profiling is off"""
+        return profiling.active
 
     @staticmethod
     def convert_to_math_formula(formula, sheet):
-        """Split the formula into its components"""
-        parts = formula.split()
-        print("parts,", parts)
-        if len(parts) == 1:
-            cell_name1 = parts[0]  # copy the value from the cell
-            coeff1, cell_name1 = FormulaParser.extract_coefficient(cell_name1)
-            result = coeff1 * FormulaParser.evaluate_cell_reference(cell_name1, sheet)
-            return result
-        elif len(parts) != 3:
-            raise ValueError("Invalid formula format! Formula should be in the form '<cell1> <operation> <cell2>"
-                             "for example, '=A2 + B4'")
-
-        cell1, operation, cell2 = parts
-
-        # Extract coefficients from cell names
-        coeff1, cell_name1 = FormulaParser.extract_coefficient(cell1)
-        coeff2, cell_name2 = FormulaParser.extract_coefficient(cell2)
-
-        # Process cell references to get their values
-        value1 = FormulaParser.evaluate_cell_reference(cell_name1, sheet)
-        value2 = FormulaParser.evaluate_cell_reference(cell_name2, sheet)
-
-        # Apply coefficients after checking for None
-        if value1 is not None:
-            value1 *= coeff1
-        if value2 is not None:
-            value2 *= coeff2
-
-        try:
-            # Perform the mathematical operation based on the provided operation
-            if operation == '+':
-                result = value1 + value2
-            elif operation == '-':
-                result = value1 - value2
-            elif operation == '*':
-                result = value1 * value2
-            elif operation == '/':
-                if value2 == 0:
-                    raise ZeroDivisionError  # Raise ZeroDivisionError explicitly
-                result = value1 / value2
-            else:
-                raise ValueError("Invalid mathematical operation specified!")
-
-            return result
-        except ZeroDivisionError:  # Catch ZeroDivisionError
-            raise ValueError("Division by zero error!")
+        """Evaluate a mathematical expression like '2A1 + (B4 - 3) * C2'"""
+        return compile_formula(formula).evaluate(sheet)
 
     @staticmethod
     def evaluate_cell_reference(cell_name, sheet):
@@ -88,7 +46,7 @@ class FormulaParser:
             # Otherwise, directly retrieve the value from the sheet
             row, col = Cell().cell_loc(cell_name)
             if row < 0 or row >= sheet.rows or col < 0 or col >= sheet.cols:
-                raise ValueError(f"Cell '{cell_name}' is out of sheet dimensions.")
+                raise FormulaReferenceError(f"Cell '{cell_name}' is out of sheet dimensions.")
             value = sheet.get_value(row, col)
             # Return 0 if the cell has no value or contains a string
             return float(value) if isinstance(value, (int, float)) else 0
@@ -111,12 +69,22 @@ class FormulaParser:
 
 class FunctionLibrary:
     @staticmethod
-    def is_valid_range(cell_range, sheet):
-        """Check if the given cell range is valid within the sheet dimensions."""
+    def get_range_bounds(cell_range):
+        """Convert a range like 'A1:B3' to a (start_row, start_col, end_row, end_col) tuple."""
         start, end = cell_range.split(":")
         start_row, start_col = Cell().cell_loc(start)
         end_row, end_col = Cell().cell_loc(end)
+        return start_row, start_col, end_row, end_col
 
+    @staticmethod
+    def is_valid_range(cell_range, sheet):
+        """Check if the given cell range is valid within the sheet dimensions."""
+        return FunctionLibrary.is_valid_bounds(FunctionLibrary.get_range_bounds(cell_range), sheet)
+
+    @staticmethod
+    def is_valid_bounds(bounds, sheet):
+        """Check if the given (start_row, start_col, end_row, end_col) range is within the sheet dimensions."""
+        start_row, start_col, end_row, end_col = bounds
         if (start_row < 0 or start_row >= sheet.rows or start_col < 0 or start_col >= sheet.cols
                 or end_row < 0 or end_row >= sheet.rows or end_col < 0 or end_col >= sheet.cols):
             return False
@@ -125,72 +93,143 @@ class FunctionLibrary:
     @staticmethod
     def calc_sum(cell_range, sheet):
         """Calculate the sum of values within the given cell range."""
-        if not FunctionLibrary.is_valid_range(cell_range, sheet):
-            raise ValueError("Invalid cell range.")
-        start, end = cell_range.split(":")
-        start_row, start_col = Cell().cell_loc(start)
-        end_row, end_col = Cell().cell_loc(end)
-        total = 0
-        for row in range(start_row, end_row + 1):
-            for col in range(start_col, end_col + 1):
-                current_val = sheet.get_value(row, col)
-                if current_val is not None and (type(current_val) == int or type(current_val) == float):
-                    total += current_val
-        return total
+        return FunctionLibrary.sum_range(FunctionLibrary.get_range_bounds(cell_range), sheet)
+
+    @staticmethod
+    def sum_range(bounds, sheet):
+        """Calculate the sum of values within a (start_row, start_col, end_row, end_col) range."""
+        if not FunctionLibrary.is_valid_bounds(bounds, sheet):
+            raise FormulaReferenceError("Invalid cell range.")
+        if sheet.sum_index is not None and sheet.sum_index.covers(bounds):
+            total = sheet.sum_index.query(bounds)[0]
+            if total is not None:
+                return total
+        # Reduced one column block at a time by the cell store instead of cell by cell
+        return sheet.cells.range_sum(*bounds)
+
+    @staticmethod
+    def count_numbers(bounds, sheet):
+        """Count the numeric cells within a (start_row, start_col, end_row, end_col) range."""
+        if not FunctionLibrary.is_valid_bounds(bounds, sheet):
+            raise FormulaReferenceError("Invalid cell range.")
+        if sheet.sum_index is not None and sheet.sum_index.covers(bounds):
+            return sheet.sum_index.query(bounds)[1]
+        return sheet.cells.range_count(*bounds)
 
     @staticmethod
     def find_cell_len(cell_range):
         """Calculates how many cells are in a range"""
-        start, end = cell_range.split(":")
-        start_row, start_col = Cell().cell_loc(start)
-        end_row, end_col = Cell().cell_loc(end)
-        return (end_row - start_row + 1) * (end_col - start_col + 1)
+        return FunctionLibrary.count_range(FunctionLibrary.get_range_bounds(cell_range))
 
-        # Calculate the total number of cells in the range
-        total = num_rows * num_cols
-        return total
+    @staticmethod
+    def count_range(bounds):
+        """Calculates how many cells are in a (start_row, start_col, end_row, end_col) range"""
+        start_row, start_col, end_row, end_col = bounds
+        return (end_row - start_row + 1) * (end_col - start_col + 1)
 
     @staticmethod
     def average(cell_range, sheet):
         """Calculate the average of values within the given cell range."""
-        if not FunctionLibrary.is_valid_range(cell_range, sheet):
-            raise ValueError("Invalid cell range.")
-        cell_sum = FunctionLibrary.calc_sum(cell_range, sheet)
-        num_of_cells = FunctionLibrary.find_cell_len(cell_range)
-        return cell_sum / num_of_cells
+        return FunctionLibrary.average_range(FunctionLibrary.get_range_bounds(cell_range), sheet)
+
+    @staticmethod
+    def average_range(bounds, sheet):
+        """Calculate the average of the numeric cells within a (start_row, start_col, end_row, end_col) range."""
+        if not FunctionLibrary.is_valid_bounds(bounds, sheet):
+            raise FormulaReferenceError("Invalid cell range.")
+        if sheet.sum_index is not None and sheet.sum_index.covers(bounds):
+            # The numerator and the count come from the same summed-area table
+            cell_sum, num_of_cells = sheet.sum_index.query(bounds)
+            if cell_sum is None:
+                cell_sum = sheet.cells.range_sum(*bounds)
+        else:
+            cell_sum = FunctionLibrary.sum_range(bounds, sheet)
+            num_of_cells = FunctionLibrary.count_numbers(bounds, sheet)
+        return cell_sum / num_of_cells if num_of_cells else 0
 
     @staticmethod
     def find_max(cell_range, sheet):
         """Find the maximum value within the given cell range."""
-        if not FunctionLibrary.is_valid_range(cell_range, sheet):
-            raise ValueError("Invalid cell range.")
-        start, end = cell_range.split(":")
-        start_row, start_col = Cell().cell_loc(start)
-        end_row, end_col = Cell().cell_loc(end)
+        return FunctionLibrary.max_range(FunctionLibrary.get_range_bounds(cell_range), sheet)
 
-        max_value = max(
-            sheet.get_value(row, col)
-            for row in range(start_row, end_row + 1)
-            for col in range(start_col, end_col + 1)
-            if isinstance(sheet.get_value(row, col), (int, float))
-        )
+    @staticmethod
+    def max_range(bounds, sheet):
+        """Find the maximum value within a (start_row, start_col, end_row, end_col) range."""
+        if not FunctionLibrary.is_valid_bounds(bounds, sheet):
+            raise FormulaReferenceError("Invalid cell range.")
+        start_row, start_col, end_row, end_col = bounds
+        if all(col in sheet.minmax_index for col in range(start_col, end_col + 1)):
+            # Combine the O(log n) answers of the columns of the range
+            return max(sheet.minmax_index[col].query(start_row, end_row)[1]
+                       for col in range(start_col, end_col + 1))
+        max_value = sheet.cells.range_max(*bounds)
         return max_value if max_value is not None else float('-inf')
 
     @staticmethod
     def find_min(cell_range, sheet):
         """Find the minimum value within the given cell range."""
-        if not FunctionLibrary.is_valid_range(cell_range, sheet):
-            raise ValueError("Invalid cell range.")
-        start, end = cell_range.split(":")
-        start_row, start_col = Cell().cell_loc(start)
-        end_row, end_col = Cell().cell_loc(end)
-
-        min_value = min(
-            sheet.get_value(row, col)
-            for row in range(start_row, end_row + 1)
-            for col in range(start_col, end_col + 1)
-            if isinstance(sheet.get_value(row, col), (int, float))
-        )
+        return FunctionLibrary.min_range(FunctionLibrary.get_range_bounds(cell_range), sheet)
 
+    @staticmethod
+    def min_range(bounds, sheet):
+        """Find the minimum value within a (start_row, start_col, end_row, end_col) range."""
+        if not FunctionLibrary.is_valid_bounds(bounds, sheet):
+            raise FormulaReferenceError("Invalid cell range.")
+        start_row, start_col, end_row, end_col = bounds
+        if all(col in sheet.minmax_index for col in range(start_col, end_col + 1)):
+            # Combine the O(log n) answers of the columns of the range
+            return min(sheet.minmax_index[col].query(start_row, end_row)[0]
+                       for col in range(start_col, end_col + 1))
+        min_value = sheet.cells.range_min(*bounds)
         return min_value if min_value is not None else float('inf')
 
+    # The functions below are called by compiled formulas. Each argument is either a
+    # number or a (start_row, start_col, end_row, end_col) range tuple.
+
+    @staticmethod
+    def sum_arguments(arguments, sheet):
+        """SUM(...) over any mix of ranges and numbers"""
+        if profiling.active is not None:
+            profiling.active.record_range("SUM", arguments, sheet)
+        total = 0
+        for argument in arguments:
+            total += FunctionLibrary.sum_range(argument, sheet) if isinstance(argument, tuple) else argument
+        return total
+
+    @staticmethod
+    def average_arguments(arguments, sheet):
+        """AVERAGE(...) over any mix of ranges and numbers"""
+        if profiling.active is not None:
+            profiling.active.record_range("AVERAGE", arguments, sheet)
+        if len(arguments) == 1 and isinstance(arguments[0], tuple):
+            return FunctionLibrary.average_range(arguments[0], sheet)
+        num_of_cells = sum(FunctionLibrary.count_numbers(argument, sheet) if isinstance(argument, tuple) else 1
+                           for argument in arguments)
+        if num_of_cells == 0:
+            return 0
+        return sum(FunctionLibrary.sum_range(argument, sheet) if isinstance(argument, tuple) else argument
+                   for argument in arguments) / num_of_cells
+
+    @staticmethod
+    def max_arguments(arguments, sheet):
+        """MAX(...) over any mix of ranges and numbers"""
+        if profiling.active is not None:
+            profiling.active.record_range("MAX", arguments, sheet)
+        return max(FunctionLibrary.max_range(argument, sheet) if isinstance(argument, tuple) else argument
+                   for argument in arguments)
+
+    @staticmethod
+    def min_arguments(arguments, sheet):
+        """MIN(...) over any mix of ranges and numbers"""
+        if profiling.active is not None:
+            profiling.active.record_range("MIN", arguments, sheet)
+        return min(FunctionLibrary.min_range(argument, sheet) if isinstance(argument, tuple) else argument
+                   for argument in arguments)
+
+
+FUNCTIONS.update({
+    "SUM": FunctionLibrary.sum_arguments,
+    "AVERAGE": FunctionLibrary.average_arguments,
+    "MAX": FunctionLibrary.max_arguments,
+    "MIN": FunctionLibrary.min_arguments,
+})
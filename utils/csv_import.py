@@ -0,0 +1,91 @@
+import csv
+import math
+from array import array
+from itertools import islice, zip_longest
+from sheet import Sheet
+from storage import CellStore, NUMBER_START
+
+
+def read_csv(file_path):
+    """load a sheet from a CSV file, one block of CellStore.BLOCK_ROWS rows at a time.
+
+    Every column of a block is typed at once: a column that holds only numbers is converted
+    with a single array('d', map(float, ...)), only columns mixing numbers, text, formulas
+    and empty fields are looked at field by field. The typed blocks go straight to the
+    CellStore of the sheet, so memory holds one block of text rows at a time"""
+    cells = CellStore(0, 0)
+    formulas = []  # (formula, row, col), registered once the sheet exists
+    rows = cols = 0
+    with open(file_path, 'r', newline='') as file:
+        reader = csv.reader(file)
+        while True:
+            chunk = list(islice(reader, cells.BLOCK_ROWS))
+            if not chunk:
+                break
+            block_index = rows // cells.BLOCK_ROWS
+            for col, fields in enumerate(zip_longest(*chunk, fillvalue='')):
+                numbers, tags, texts = type_column(fields, cells.BLOCK_ROWS)
+                if not texts and not any(tags):
+                    continue
+                cells.columns.setdefault(col, {})[block_index] = (numbers, tags)
+                for offset, text in texts:
+                    if text[0] == '=' and not text[1:].strip().startswith('clr'):
+                        formulas.append((text, rows + offset, col))
+                    else:
+                        # typed like any written text: TRUE/FALSE, error values or text
+                        cells.set_value(rows + offset, col, text)
+                cols = max(cols, col + 1)
+            rows += len(chunk)
+
+    # An empty file loads as a sheet of one empty cell
+    rows, cols = max(rows, 1), max(cols, 1)
+    sheet = Sheet(rows, cols)
+    cells.rows, cells.cols = rows, cols
+    sheet.cells = cells
+    for formula, row, col in formulas:
+        sheet.set_formula(formula, row, col)
+    return sheet
+
+
+# bytes.translate table from float.is_integer results to the CellStore tags
+NUMBER_TAGS = bytes([CellStore.FLOAT, CellStore.INT]) + bytes(254)
+
+
+def type_column(fields, size):
+    """type the fields of a column block. returns (numbers, tags, texts): the array('d') and the
+    tags of a CellStore block of the given size, and [(offset, text)] for the text fields, whose
+    cells are left empty"""
+    try:
+        # A column of numbers only: converted and tagged without a Python loop per field
+        numbers = array('d', map(float, fields))
+        if not all(map(math.isfinite, numbers)):
+            raise ValueError("'nan' and 'inf' are kept as text")
+        if '_' in ''.join(fields):
+            raise ValueError("float() reads '1_000', typed_value keeps it as text")
+        if max(map(abs, numbers)) > 2 ** 53:
+            raise ValueError("integral numbers above 2 ** 53 are not exact, they are kept as floats")
+        tags = bytearray(bytes(map(float.is_integer, numbers)).translate(NUMBER_TAGS))
+        texts = []
+    except ValueError:
+        numbers = array('d', bytes(8 * len(fields)))
+        tags = bytearray(len(fields))
+        texts = []
+        for offset, field in enumerate(fields):
+            if not field:
+                continue
+            if field[0] in NUMBER_START and '_' not in field:
+                try:
+                    number = float(field)
+                except ValueError:
+                    number = math.nan
+            else:
+                number = math.nan  # text, without paying for a failed float()
+            if math.isfinite(number):
+                numbers[offset] = number
+                # like typed_value: an int only while it is exact in a double
+                tags[offset] = CellStore.INT if number.is_integer() and abs(number) <= 2 ** 53 else CellStore.FLOAT
+            else:
+                texts.append((offset, field))  # left empty, the caller stores them
+    numbers.extend(array('d', bytes(8 * (size - len(fields)))))
+    tags.extend(bytes(size - len(tags)))
+    return numbers, tags, texts
@@ -0,0 +1,125 @@
+from collections import deque
+
+
+class DependencyGraph:
+    """Links precedent cells and ranges to the formula cells that read them.
+
+    Single cell references are kept in a dictionary (row, col) -> dependents.
+    Ranges are kept per column as dependent -> [(start_row, end_row), ...], so a
+    big range costs one entry per column instead of one entry per cell. Only the
+    columns of the sheet (below cols) get entries, the columns past them are empty.
+    """
+
+    def __init__(self, cols):
+        self.cols = cols
+        self.formulas = {}  # formula cell -> CompiledFormula (None if it does not compile)
+        self.cell_dependents = {}  # (row, col) -> set of formula cells
+        self.range_dependents = {}  # col -> {formula cell: [(start_row, end_row), ...]}
+        # Once the graph was copied, its sets and columns are shared with the copy until they change
+        self.shared = False
+        self.owned = set()  # keys of the sets and columns copied (or created) since the last copy()
+
+    def copy(self):
+        """return an independent copy of the graph. Only the dictionaries are copied: the sets of
+        cell_dependents and the columns of range_dependents are shared by both graphs, and copied
+        by the first one that changes them (compiled formulas are immutable and shared)"""
+        graph = DependencyGraph(self.cols)
+        graph.formulas = dict(self.formulas)
+        graph.cell_dependents = dict(self.cell_dependents)
+        graph.range_dependents = dict(self.range_dependents)
+        self.shared = graph.shared = True
+        self.owned = set()
+        return graph
+
+    def writable(self, table, key, empty):
+        """return the set or column of table[key] for writing, created with empty() if missing and
+        copied first if it is shared with a copy of the graph"""
+        value = table.get(key)
+        if self.shared and key not in self.owned:
+            self.owned.add(key)
+            value = table[key] = empty() if value is None else value.copy()
+        elif value is None:
+            value = table[key] = empty()
+        return value
+
+    def set_formula(self, cell, compiled):
+        """register the precedents of a formula cell, replacing the ones it had before"""
+        self.remove_formula(cell)
+        self.formulas[cell] = compiled
+        if compiled is None:
+            return
+        for precedent in compiled.cells:
+            self.writable(self.cell_dependents, precedent, set).add(cell)
+        for start_row, start_col, end_row, end_col in compiled.ranges:
+            for col in self.range_columns(start_col, end_col):
+                # remove_formula dropped the spans of the cell, the list is created here
+                self.writable(self.range_dependents, col, dict).setdefault(cell, []).append((start_row, end_row))
+
+    def remove_formula(self, cell):
+        """forget a formula cell and every edge leading to it"""
+        compiled = self.formulas.pop(cell, None)
+        if compiled is None:
+            return
+        for precedent in compiled.cells:
+            if precedent in self.cell_dependents:
+                dependents = self.writable(self.cell_dependents, precedent, set)
+                dependents.discard(cell)
+                if not dependents:
+                    del self.cell_dependents[precedent]
+        for _, start_col, _, end_col in compiled.ranges:
+            for col in self.range_columns(start_col, end_col):
+                if col in self.range_dependents:
+                    column = self.writable(self.range_dependents, col, dict)
+                    column.pop(cell, None)
+                    if not column:
+                        del self.range_dependents[col]
+
+    def range_columns(self, start_col, end_col):
+        """return the columns of a range that are inside the sheet"""
+        return range(start_col, min(end_col, self.cols - 1) + 1)
+
+    def dependents_of(self, cell):
+        """return the formula cells that read the given cell directly"""
+        row, col = cell
+        dependents = set(self.cell_dependents.get(cell, ()))
+        for dependent, spans in self.range_dependents.get(col, {}).items():
+            for start_row, end_row in spans:
+                if start_row <= row <= end_row:
+                    dependents.add(dependent)
+                    break
+        return dependents
+
+    def dirty_cells(self, changed):
+        """return every formula cell that depends, directly or not, on the changed cells"""
+        dirty = {}
+        queue = deque(changed)
+        while queue:
+            for dependent in self.dependents_of(queue.popleft()):
+                if dependent not in dirty:
+                    dirty[dependent] = True
+                    queue.append(dependent)
+        return list(dirty)
+
+    def recalc_order(self, dirty):
+        """sort formula cells so every cell comes after the cells it reads (Kahn's algorithm).
+        returns (order, cyclic) where cyclic holds the cells that are on a cycle or read one,
+        found in time linear in the number of cells and edges"""
+        dirty = set(dirty)
+        dependents = {}
+        waiting = dict.fromkeys(dirty, 0)  # number of dirty precedents not evaluated yet
+        for cell in dirty:
+            dependents[cell] = [dependent for dependent in self.dependents_of(cell) if dependent in dirty]
+            for dependent in dependents[cell]:
+                waiting[dependent] += 1
+
+        ready = deque(cell for cell, count in waiting.items() if count == 0)
+        order = []
+        while ready:
+            cell = ready.popleft()
+            order.append(cell)
+            for dependent in dependents[cell]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+        cyclic = [cell for cell, count in waiting.items() if count > 0]
+        return order, cyclic
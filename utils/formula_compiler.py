@@ -0,0 +1,259 @@
+import re
+from functools import lru_cache
+from addresses import split_cell_name
+
+# Spreadsheet functions by upper case name. Every function is called as
+# function(args, sheet) where each argument is either a number or a range given
+# as a (start_row, start_col, end_row, end_col) tuple. calculates.py registers
+# the built-in functions (SUM, AVERAGE, MAX, MIN).
+FUNCTIONS = {}
+
+TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+      | (?P<name>[A-Za-z]+\d*)
+      | (?P<op>[-+*/(),:])
+    )""", re.VERBOSE)
+
+
+class FormulaError(ValueError):
+    """base of the errors a formula can raise. error_value is the text the cell shows instead of a result"""
+    error_value = '#VALUE!'
+
+
+class FormulaSyntaxError(FormulaError):
+    """raised when a formula can not be tokenized or parsed"""
+    error_value = '#NAME?'
+
+
+class FormulaReferenceError(FormulaError):
+    """raised when a formula reads a cell or a range outside of the sheet"""
+    error_value = '#REF!'
+
+
+class FormulaDivisionError(FormulaError):
+    """raised when a formula divides by zero"""
+    error_value = '#DIV/0!'
+
+
+class FormulaCycleError(FormulaError):
+    """the formula depends on itself"""
+    error_value = '#CYCLE!'
+
+
+# Error values a cell can hold, a formula reading one of them fails with the same error
+ERRORS = {error.error_value: error for error in
+          (FormulaError, FormulaSyntaxError, FormulaReferenceError, FormulaDivisionError, FormulaCycleError)}
+
+
+def tokenize(text):
+    """splits a formula to a list of (kind, value, glued) tokens.
+    kind is one of 'number', 'cell', 'function' or 'op'. glued is True when the token
+    directly follows the previous one without spaces (used for coefficients like 2A1)"""
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise FormulaSyntaxError(f"Invalid character in formula: '{text[position:].strip()[0]}'")
+        glued = match.start(match.lastindex) == position
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = int(value) if value.isdigit() else float(value)
+        elif kind == 'name':
+            if text[position:].lstrip().startswith('('):
+                kind, value = 'function', value.upper()
+            elif re.fullmatch(r"[A-Za-z]+\d+", value):
+                kind, value = 'cell', value.upper()
+            else:
+                raise FormulaSyntaxError(f"Invalid cell name: '{value}'")
+        tokens.append((kind, value, glued))
+    return tokens
+
+
+class CompiledFormula:
+    """a formula compiled once to a closure. evaluate(sheet) runs it, cells and ranges
+    hold the (row, col) cells and (start_row, start_col, end_row, end_col) ranges it reads
+    and calls holds a (function name, range) pair for every range passed to a function"""
+    __slots__ = ('text', 'evaluate', 'cells', 'ranges', 'calls')
+
+    def __init__(self, text, evaluate, cells, ranges, calls=()):
+        self.text = text
+        self.evaluate = evaluate
+        self.cells = cells
+        self.ranges = ranges
+        self.calls = calls
+
+
+class Parser:
+    """recursive descent parser that turns tokens into closures.
+
+    expression := term (('+' | '-') term)*
+    term       := unary (('*' | '/') unary)*
+    unary      := ('-' | '+') unary | primary
+    primary    := number [cell] | cell | function '(' [argument (',' argument)*] ')' | '(' expression ')'
+    argument   := cell ':' cell | expression
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.position = 0
+        self.cells = []
+        self.ranges = []
+        self.calls = []
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None, False)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise FormulaSyntaxError("Unexpected end of formula")
+        self.position += 1
+        return token
+
+    def expect(self, op):
+        kind, value, _ = self.next()
+        if kind != 'op' or value != op:
+            raise FormulaSyntaxError(f"Expected '{op}' but found '{value}'")
+
+    def parse(self):
+        if not self.tokens:
+            raise FormulaSyntaxError("Empty formula")
+        evaluate = self.expression()
+        if self.peek()[0] is not None:
+            raise FormulaSyntaxError(f"Unexpected '{self.peek()[1]}' in formula")
+        return evaluate
+
+    def expression(self):
+        evaluate = self.term()
+        while self.peek()[0] == 'op' and self.peek()[1] in '+-':
+            operation = self.next()[1]
+            evaluate = binary_operation(operation, evaluate, self.term())
+        return evaluate
+
+    def term(self):
+        evaluate = self.unary()
+        while self.peek()[0] == 'op' and self.peek()[1] in '*/':
+            operation = self.next()[1]
+            evaluate = binary_operation(operation, evaluate, self.unary())
+        return evaluate
+
+    def unary(self):
+        kind, value, _ = self.peek()
+        if kind == 'op' and value in '+-':
+            self.next()
+            operand = self.unary()
+            if value == '+':
+                return operand
+            return lambda sheet: -operand(sheet)
+        return self.primary()
+
+    def primary(self):
+        kind, value, _ = self.next()
+        if kind == 'number':
+            next_kind, _, glued = self.peek()
+            if next_kind == 'cell' and glued:
+                # a coefficient written in front of a cell, like 2A1
+                return binary_operation('*', lambda sheet: value, self.cell(self.next()[1]))
+            return lambda sheet: value
+        if kind == 'cell':
+            return self.cell(value)
+        if kind == 'function':
+            return self.function(value)
+        if kind == 'op' and value == '(':
+            evaluate = self.expression()
+            self.expect(')')
+            return evaluate
+        raise FormulaSyntaxError(f"Unexpected '{value}' in formula")
+
+    def cell(self, name):
+        row, col = split_cell_name(name)
+        self.cells.append((row, col))
+
+        def evaluate(sheet):
+            if row >= sheet.rows or col >= sheet.cols:
+                raise FormulaReferenceError(f"Cell '{name}' is out of sheet dimensions.")
+            number = sheet.cells.number_at(row, col)
+            if number is not None:
+                return number
+            value = sheet.cells.get_value(row, col, None)
+            if isinstance(value, bool):
+                return float(value)
+            if value in ERRORS:
+                raise ERRORS[value](f"Cell '{name}' holds the error {value}")
+            # Cells without a number count as 0
+            return 0
+        return evaluate
+
+    def function(self, name):
+        if name not in FUNCTIONS:
+            raise FormulaSyntaxError("Unsupported function: " + name)
+        function = FUNCTIONS[name]
+        self.expect('(')
+        if self.peek()[0] == 'op' and self.peek()[1] == ')':
+            raise FormulaSyntaxError(f"{name}() needs at least one argument")
+        arguments = [self.argument()]
+        while self.peek()[0] == 'op' and self.peek()[1] == ',':
+            self.next()
+            arguments.append(self.argument())
+        self.expect(')')
+
+        ranges = tuple(argument for argument in arguments if isinstance(argument, tuple))
+        self.calls.extend((name, cell_range) for cell_range in ranges)
+        if len(ranges) == len(arguments):
+            # only ranges, nothing to evaluate before the call
+            return lambda sheet: function(ranges, sheet)
+        return lambda sheet: function([argument if isinstance(argument, tuple) else argument(sheet)
+                                       for argument in arguments], sheet)
+
+    def argument(self):
+        kind, value, _ = self.peek()
+        following = self.tokens[self.position + 1] if self.position + 1 < len(self.tokens) else None
+        if kind == 'cell' and following is not None and following[:2] == ('op', ':'):
+            self.position += 2
+            end_kind, end_value, _ = self.next()
+            if end_kind != 'cell':
+                raise FormulaSyntaxError(f"Invalid cell range: '{value}:{end_value}'")
+            start_row, start_col = split_cell_name(value)
+            end_row, end_col = split_cell_name(end_value)
+            cell_range = (min(start_row, end_row), min(start_col, end_col),
+                          max(start_row, end_row), max(start_col, end_col))
+            self.ranges.append(cell_range)
+            return cell_range
+        return self.expression()
+
+
+def binary_operation(operation, left, right):
+    """build the closure of a binary mathematical operation"""
+    if operation == '+':
+        return lambda sheet: left(sheet) + right(sheet)
+    if operation == '-':
+        return lambda sheet: left(sheet) - right(sheet)
+    if operation == '*':
+        return lambda sheet: left(sheet) * right(sheet)
+
+    def divide(sheet):
+        divisor = right(sheet)
+        if divisor == 0:
+            raise FormulaDivisionError("Division by zero error!")
+        return left(sheet) / divisor
+    return divide
+
+
+@lru_cache(maxsize=4096)
+def compile_cached(text):
+    parser = Parser(text)
+    evaluate = parser.parse()
+    return CompiledFormula(text, evaluate, tuple(parser.cells), tuple(parser.ranges), tuple(parser.calls))
+
+
+def compile_formula(formula):
+    """compiles a formula (with or without the leading '=') to a CompiledFormula.
+    Compiled formulas are cached by their text so every formula is parsed only once."""
+    return compile_cached(formula.lstrip('=').strip())
@@ -1,30 +1,136 @@
+import datetime
+import decimal
 import json
-from sheet import Sheet
-import yaml
-from openpyxl import Workbook
+import os
+from sheet import Sheet, Cell
+from json_stream import JsonStreamReader
 import csv
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
-from reportlab.lib import colors
+
+# yaml, openpyxl and reportlab are imported inside the methods that use them, so importing
+# this module (and starting the GUI or a batch worker) doesn't pay for formats it never uses.
+
+# Supported file formats: extension -> (loader, exporter) method names of SheetLoader, None if missing.
+# The exporters raise when the file can't be written (export_to_csv, export_to_excel and export_to_pdf
+# print their errors for the menu, the formats use the write_ methods under them)
+FORMATS = {
+    '.hsheet': ('load_from_native', 'export_to_native'),
+    '.json': ('load_from_json', 'export_to_json'),
+    '.yaml': ('load_from_yaml', 'export_to_yaml'),
+    '.yml': ('load_from_yaml', 'export_to_yaml'),
+    '.csv': ('load_from_csv', 'write_csv'),
+    '.xlsx': ('load_from_excel', 'write_excel'),
+    '.pdf': (None, 'write_pdf'),
+}
+
+
+def export_snapshot(task):
+    """export a snapshot of a sheet to one file, runs in a worker process of SheetLoader.export_all.
+    returns the file path"""
+    rows, cols, cells, file_path, options = task
+    sheet = Sheet(rows, cols)
+    sheet.cells = cells
+    # A failed export raises and keeps the file that was there before
+    SheetLoader.export_replacing(sheet, file_path, **options)
+    return file_path
+
 
 class SheetLoader:
+    @staticmethod
+    def get_format(file_path, exporting):
+        """return the SheetLoader method that loads or exports a file, based on its extension"""
+        extension = os.path.splitext(file_path)[1].lower()
+        loader, exporter = FORMATS.get(extension, (None, None))
+        name = exporter if exporting else loader
+        if name is None:
+            raise ValueError(f"Unsupported file format: '{extension}'")
+        return getattr(SheetLoader, name)
+
+    @staticmethod
+    def load(file_path):
+        """Load a sheet from any supported file format"""
+        return SheetLoader.get_format(file_path, exporting=False)(file_path)
+
+    @staticmethod
+    def export(sheet, file_path, **options):
+        """Export a sheet to any supported file format, options go to the exporter (like cell_colors for PDF)"""
+        return SheetLoader.get_format(file_path, exporting=True)(sheet, file_path, **options)
+
+    @staticmethod
+    def export_replacing(sheet, file_path, **options):
+        """Export a sheet like export(), to a temporary file next to file_path that replaces it only
+        once the export succeeded, so a failed export leaves the previous file as it was.
+        raises what the exporter raised"""
+        root, extension = os.path.splitext(file_path)
+        temporary_path = f"{root}.{os.getpid()}.tmp{extension}"
+        try:
+            SheetLoader.export(sheet, temporary_path, **options)
+            os.replace(temporary_path, file_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    @staticmethod
+    def export_all(sheet, file_paths, cell_colors=None, max_workers=None):
+        """Export one snapshot of a sheet to several files (any supported formats) at the same time,
+        each in its own worker process. The sheet can be edited as soon as this returns.
+        cell_colors ({(row, col): color}) goes to the PDF exports.
+        returns {file path: concurrent.futures.Future}, a future's result is the file path"""
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        for file_path in file_paths:
+            SheetLoader.get_format(file_path, exporting=True)  # unsupported formats fail here
+        cells = sheet.cells.copy()
+        colors = dict(cell_colors or {})
+        # spawn: forking a process that runs Tk and the recalculation thread is not safe
+        executor = ProcessPoolExecutor(max_workers=min(max_workers or os.cpu_count() or 1, len(file_paths)),
+                                       mp_context=multiprocessing.get_context('spawn'))
+        futures = {}
+        for file_path in file_paths:
+            options = {'cell_colors': colors} if file_path.lower().endswith('.pdf') else {}
+            futures[file_path] = executor.submit(export_snapshot, (sheet.rows, sheet.cols, cells, file_path, options))
+        executor.shutdown(wait=False)  # the workers exit once their exports are done
+        return futures
+
+    @staticmethod
+    def set_cell(sheet, value, row, col):
+        """Put a loaded value in the sheet, text starting with '=' is loaded as a formula"""
+        if isinstance(value, str) and value.startswith('=') and not value[1:].strip().startswith('clr'):
+            sheet.set_formula(value, row, col)
+        else:
+            sheet.set_value(value, row, col)
+
     @staticmethod
     def load_from_json(file_path):
-        """Load sheet from imported json file"""
+        """Load sheet from imported json file. The cells are read one at a time, so memory
+        doesn't grow with the size of the file. Loads the sparse files written by export_to_json
+        as well as the older files that list every cell"""
         try:
             with open(file_path, 'r') as file:
-                data = json.load(file)
-                rows = data.get('rows', 0)
-                cols = data.get('cols', 0)
-                # Create a new Sheet object with the appropriate dimensions
-                sheet = Sheet(rows, cols)
-
-                # Iterate over the data and set values in the sheet
-                for cell_data in data.get('cells', []):
-                    row_index = cell_data.get('row', 0)
-                    col_index = cell_data.get('col', 0)
-                    value = cell_data.get('value')
-                    sheet.set_value(value, row_index, col_index)
+                reader = JsonStreamReader(file)
+                rows = cols = 0
+                sheet = None
+                early_cells = []  # cells listed before the dimensions of the sheet, if any
+                for key in reader.members():
+                    if key == 'cells':
+                        for cell_data in reader.items():
+                            if sheet is None:
+                                early_cells.append(cell_data)
+                            else:
+                                SheetLoader.set_json_cell(sheet, cell_data)
+                    elif key in ('rows', 'cols'):
+                        if key == 'rows':
+                            rows = reader.value()
+                        else:
+                            cols = reader.value()
+                        if sheet is None and rows and cols:
+                            # Create a new Sheet object with the appropriate dimensions
+                            sheet = Sheet(rows, cols)
+                    else:
+                        reader.value()
+                if sheet is None:
+                    sheet = Sheet(rows, cols)
+                for cell_data in early_cells:
+                    SheetLoader.set_json_cell(sheet, cell_data)
                 return sheet
         except FileNotFoundError:
             print(f"Error: File '{file_path}' not found.")
@@ -33,20 +139,73 @@ class SheetLoader:
         except Exception as e:
             print(f"Error: An unexpected error occurred: {str(e)}")
 
+    @staticmethod
+    def set_json_cell(sheet, cell_data):
+        """Put a cell of a json file in the sheet: {"row", "col", "value"} and, for formula cells,
+        "formula" (the value is then the last calculated result, or null)"""
+        row_index = cell_data.get('row', 0)
+        col_index = cell_data.get('col', 0)
+        value = cell_data.get('value')
+        formula = cell_data.get('formula')
+        if formula is not None:
+            sheet.set_formula(formula, row_index, col_index)
+            if value is not None:
+                sheet.set_value(value, row_index, col_index)
+        elif value is not None and value != Cell.EMPTY:
+            # The older files list the empty cells too, they are left out of the sheet
+            SheetLoader.set_cell(sheet, value, row_index, col_index)
+
     @staticmethod
     def export_to_json(sheet, file_path):
-        """Export sheet to a json file"""
-        data = {"rows": sheet.rows, "cols": sheet.cols, "cells": []}
-        for row_index in range(sheet.rows):
-            for col_index in range(sheet.cols):
-                cell_data = {"row": row_index, "col": col_index, "value": sheet.get_value(row_index, col_index)}
-                data["cells"].append(cell_data)
+        """Export sheet to a json file, one line per cell. Empty cells are skipped and formula
+        cells keep their formula next to their value. The cells are written as they are read,
+        nothing is built in memory"""
         with open(file_path, 'w') as file:
-            json.dump(data, file, indent=4)
+            file.write(f'{{"rows": {sheet.rows}, "cols": {sheet.cols}, "cells": [')
+            separator = '\n'
+            for row_index, col_index, value, formula in sheet.used_cells():
+                cell_data = {"row": row_index, "col": col_index, "value": value}
+                if formula is not None:
+                    cell_data["formula"] = formula
+                file.write(separator + json.dumps(cell_data))
+                separator = ',\n'
+            file.write('\n]}\n')
+
+    @staticmethod
+    def load_from_native(file_path):
+        """Load sheet from a native .hsheet file (memory-mapped, see native_format)"""
+        import native_format
+        try:
+            return native_format.read_sheet(file_path)
+        except FileNotFoundError:
+            print(f"Error: File '{file_path}' not found.")
+        except Exception as e:
+            print(f"Error: An unexpected error occurred: {str(e)}")
+
+    @staticmethod
+    def export_to_native(sheet, file_path, compression=None):
+        """Export sheet to a native .hsheet file, compression is None, 'zlib' or 'lzma'"""
+        import native_format
+        native_format.write_sheet(sheet, file_path, compression)
+
+    @staticmethod
+    def load_from_csv(file_path):
+        """Load sheet from a CSV file, in blocks of rows with the types inferred a column at a time
+        (see csv_import). Fields starting with '=' are loaded as formulas"""
+        import csv_import
+        try:
+            return csv_import.read_csv(file_path)
+        except FileNotFoundError:
+            print(f"Error: File '{file_path}' not found.")
+        except csv.Error as e:
+            print(f"Error: Failed to read CSV file '{file_path}': {str(e)}")
+        except Exception as e:
+            print(f"Error: An unexpected error occurred: {str(e)}")
 
     @staticmethod
     def load_from_yaml(file_path):
         """Load sheet from a yaml file"""
+        import yaml
         try:
             with open(file_path, 'r') as file:
                 data = yaml.safe_load(file)
@@ -59,7 +218,7 @@ class SheetLoader:
                     row_index = cell_data.get('row', 0)
                     col_index = cell_data.get('col', 0)
                     value = cell_data.get('value')
-                    sheet.set_value(value, row_index, col_index)
+                    SheetLoader.set_cell(sheet, value, row_index, col_index)
                 return sheet
         except FileNotFoundError:
             print(f"Error: File '{file_path}' not found.")
@@ -71,6 +230,7 @@ class SheetLoader:
     @staticmethod
     def export_to_yaml(sheet, file_path):
         """Export a sheet to a yaml file"""
+        import yaml
         data = {"rows": sheet.rows, "cols": sheet.cols, "cells": []}
         for row_index in range(sheet.rows):
             for col_index in range(sheet.cols):
@@ -80,69 +240,97 @@ class SheetLoader:
             yaml.dump(data, file)
 
     @staticmethod
-    def export_to_pdf(sheet, file_path, cell_colors):
-        """Export sheet to a PDF file"""
-        try:
-            # Create a new PDF document
-            doc = SimpleDocTemplate(file_path, pagesize=letter)
-            elements = []
-
-            # Convert sheet data and cell colors to a list of lists (2D arrays)
-            data = []
-            for row_index in range(sheet.rows):
-                row_data = []
-                for col_index in range(sheet.cols):
-                    value = sheet.get_value(row_index, col_index)
-                    row_data.append(value)
-                data.append(row_data)
-
-            # Create a table from the sheet data
-            table = Table(data)
-
-            # Define table style with cell colors
-            style = TableStyle([('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-                                ('GRID', (0, 0), (-1, -1), 1, colors.black)])
-
-            for row_index, row_colors in enumerate(cell_colors):
-                for col_index, cell_color in enumerate(row_colors):
-                    if cell_color:
-                        style.add('BACKGROUND', (col_index, row_index), (col_index, row_index), cell_color)
-
-            table.setStyle(style)
-            elements.append(table)
-
-            # Build PDF document
-            doc.build(elements)
+    def write_pdf(sheet, file_path, cell_colors=()):
+        """Write sheet to a PDF file, a page-sized table at a time (see pdf_export).
+        cell_colors is {(row, col): color} for the colored cells. raises when the file can't be written"""
+        import pdf_export
+        pdf_export.write_pdf(sheet, file_path, cell_colors)
 
+    @staticmethod
+    def export_to_pdf(sheet, file_path, cell_colors=()):
+        """Export sheet to a PDF file (see write_pdf), printing the result instead of raising"""
+        try:
+            SheetLoader.write_pdf(sheet, file_path, cell_colors)
             print(f"Sheet exported to PDF: {file_path}")
         except Exception as e:
             print(f"Error: An unexpected error occurred: {str(e)}")
 
+    @staticmethod
+    def write_csv(sheet, file_path):
+        """Write sheet to a CSV file, up to its last used row and column. raises when the file can't be written"""
+        with open(file_path, 'w', newline='') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            # The stored values of the used rows, as they are read
+            csvwriter.writerows(sheet.iter_rows())
+
     @staticmethod
     def export_to_csv(sheet, file_path):
-        """Export sheet to a CSV file"""
+        """Export sheet to a CSV file (see write_csv), printing the result instead of raising"""
         try:
-            with open(file_path, 'w', newline='') as csvfile:
-                csvwriter = csv.writer(csvfile)
-                for row_index in range(sheet.rows):
-                    row_data = [sheet.get_value(row_index, col_index) for col_index in range(sheet.cols)]
-                    csvwriter.writerow(row_data)
+            SheetLoader.write_csv(sheet, file_path)
             print(f"Sheet exported to CSV: {file_path}")
         except Exception as e:
             print(f"Error: An unexpected error occurred: {str(e)}")
 
-    def export_to_excel(sheet: Sheet, file_path):
-        """Export sheet to an Excel (XLSX) file"""
-        try:
-            wb = Workbook()
-            ws = wb.active
+    @staticmethod
+    def write_excel(sheet, file_path):
+        """Write sheet to an Excel (XLSX) file. The workbook is write-only: rows are streamed to the
+        file as they are made, formula cells are written as formulas. raises when the file can't be written"""
+        from openpyxl import Workbook
 
-            for row_index in range(sheet.rows):
-                for col_index in range(sheet.cols):
-                    value = sheet.get_value(row_index, col_index)
-                    ws.cell(row=row_index + 1, column=col_index + 1).value = value
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        for row_data in sheet.iter_rows(formulas=True, empty=None):
+            ws.append(row_data)
 
-            wb.save(file_path)
+        wb.save(file_path)
+
+    @staticmethod
+    def export_to_excel(sheet, file_path):
+        """Export sheet to an Excel (XLSX) file (see write_excel), printing the result instead of raising"""
+        try:
+            SheetLoader.write_excel(sheet, file_path)
             print(f"Sheet exported to Excel: {file_path}")
         except Exception as e:
-            print(f"Error: An unexpected error occurred: {str(e)}")
\ No newline at end of file
+            print(f"Error: An unexpected error occurred: {str(e)}")
+
+    @staticmethod
+    def excel_value(value):
+        """A value read by openpyxl as a value the formats can write: dates and times become their
+        ISO text ('2024-01-02T00:00:00'), decimals a float, anything else that isn't a number,
+        a boolean or text its str()"""
+        if isinstance(value, (str, int, float)):  # bool is an int
+            return value
+        if isinstance(value, decimal.Decimal):
+            return float(value)
+        if isinstance(value, (datetime.date, datetime.time)):  # datetime is a date
+            return value.isoformat()
+        return str(value)
+
+    @staticmethod
+    def load_from_excel(file_path):
+        """Load sheet from the first worksheet of an Excel (XLSX) file, streaming its rows in read-only
+        mode. Formulas are loaded as formulas"""
+        try:
+            from openpyxl import load_workbook
+
+            wb = load_workbook(file_path, read_only=True)
+            try:
+                ws = wb.worksheets[0]
+                # The dimensions are only known once every row was read
+                sheet = Sheet(Sheet.MAX_ROWS, Sheet.MAX_COLS)
+                rows = cols = 0
+                for row_index, row_data in enumerate(ws.iter_rows(values_only=True)):
+                    for col_index, value in enumerate(row_data):
+                        if value is not None:
+                            SheetLoader.set_cell(sheet, SheetLoader.excel_value(value), row_index, col_index)
+                            rows = row_index + 1
+                            cols = max(cols, col_index + 1)
+            finally:
+                wb.close()
+            sheet.resize(max(rows, 1), max(cols, 1))
+            return sheet
+        except FileNotFoundError:
+            print(f"Error: File '{file_path}' not found.")
+        except Exception as e:
+            print(f"Error: An unexpected error occurred: {str(e)}")
@@ -0,0 +1,220 @@
+from array import array
+from itertools import accumulate
+from operator import add
+import storage
+
+
+class SummedAreaTable:
+    """2-D prefix sums over a rectangle of a sheet.
+
+    Once built, the sum and the number of numeric cells of any rectangle inside
+    the indexed region are read with four lookups each. Writes inside the region
+    only mark the table as stale, it is rebuilt on the next query.
+    Float prefix sums lose the small values added to large ones (1e20 + 1 - 1e20 is 0),
+    so next to every prefix sum the table keeps a bound of its rounding error. A sum
+    whose error bound is not below TOLERANCE of its value is not answered (query returns
+    None for it) and the caller scans the range. Sums of integers below 2 ** 53 are exact.
+    """
+    TOLERANCE = 1e-12
+    UNIT_ROUNDOFF = 2.0 ** -53
+
+    def __init__(self, cells, start_row, start_col, end_row, end_col):
+        self.cells = cells
+        self.bounds = (start_row, start_col, end_row, end_col)
+        self.stale = True
+        self.rebuilds = 0
+        self.sums = None  # sums[col + 1][row + 1] = sum of the region up to (row, col), relative to its corner
+        self.errors = None  # the same for the bound of the rounding error of sums
+        self.counts = None  # the same for the number of numeric cells
+        self.exact = False  # True when the region holds integers only and no sum can be rounded
+
+    def copy(self, cells):
+        """return the table of a copy of the cells (see Sheet.snapshot). the tables are shared:
+        build() replaces them instead of writing to them"""
+        table = SummedAreaTable(cells, *self.bounds)
+        table.stale, table.rebuilds, table.exact = self.stale, self.rebuilds, self.exact
+        table.sums, table.errors, table.counts = self.sums, self.errors, self.counts
+        return table
+
+    def covers(self, bounds):
+        start_row, start_col, end_row, end_col = self.bounds
+        return (start_row <= bounds[0] and start_col <= bounds[1]
+                and bounds[2] <= end_row and bounds[3] <= end_col)
+
+    def touch(self, row, col):
+        """called on every write to the sheet, marks the table stale if the cell is inside it"""
+        start_row, start_col, end_row, end_col = self.bounds
+        if start_row <= row <= end_row and start_col <= col <= end_col:
+            self.stale = True
+
+    def build(self):
+        start_row, start_col, end_row, end_col = self.bounds
+        height = end_row - start_row + 1
+        width = end_col - start_col + 1
+        unit = self.UNIT_ROUNDOFF
+        np = storage.load_numpy()
+        if np is not None:
+            values = np.zeros((width, height))
+            numeric = np.zeros((width, height), dtype=np.int64)
+            for block_values, mask, col, first_row in self.cells.numeric_slices(*self.bounds):
+                offset = first_row - start_row
+                values[col - start_col, offset:offset + len(mask)] = block_values
+                numeric[col - start_col, offset:offset + len(mask)] = mask
+            # Every addition of a cumulative sum may be off by unit * |partial sum|
+            column_sums = values.cumsum(axis=1)
+            sums = column_sums.cumsum(axis=0)
+            errors = (unit * np.abs(column_sums).cumsum(axis=1)).cumsum(axis=0) + unit * np.abs(sums).cumsum(axis=0)
+            self.sums = np.zeros((width + 1, height + 1))
+            self.sums[1:, 1:] = sums
+            self.errors = np.zeros((width + 1, height + 1))
+            self.errors[1:, 1:] = errors
+            self.counts = np.zeros((width + 1, height + 1), dtype=np.int64)
+            self.counts[1:, 1:] = numeric.cumsum(axis=1).cumsum(axis=0)
+            self.exact = bool(np.all(values == np.trunc(values))) and float(np.abs(values).sum()) < 2 ** 53
+        else:
+            columns = {}
+            for block_values, mask, col, first_row in self.cells.numeric_slices(*self.bounds):
+                if col not in columns:
+                    columns[col] = (array('d', bytes(8 * height)), array('d', bytes(8 * height)))
+                offset = first_row - start_row
+                columns[col][0][offset:offset + len(mask)] = block_values
+                columns[col][1][offset:offset + len(mask)] = array('d', map(float, mask))
+            # sums[col + 1] = prefix sums of the region columns up to col, row by row
+            self.sums = [array('d', bytes(8 * (height + 1)))]
+            self.errors = [array('d', bytes(8 * (height + 1)))]
+            self.counts = [array('d', bytes(8 * (height + 1)))]
+            magnitude = 0.0
+            self.exact = True
+            for col in range(start_col, end_col + 1):
+                if col in columns:
+                    values, numeric = columns[col]
+                    column_sums = array('d', accumulate(values, initial=0))
+                    sums = array('d', map(add, self.sums[-1], column_sums))
+                    column_errors = accumulate(map(abs, column_sums))
+                    self.errors.append(array('d', [error + unit * (column_error + total) for error, column_error, total
+                                                   in zip(self.errors[-1], column_errors, accumulate(map(abs, sums)))]))
+                    self.sums.append(sums)
+                    self.counts.append(array('d', map(add, self.counts[-1], accumulate(numeric, initial=0))))
+                    magnitude += sum(map(abs, values))
+                    self.exact = self.exact and all(value.is_integer() for value in values)
+                else:
+                    self.sums.append(self.sums[-1])
+                    self.errors.append(self.errors[-1])
+                    self.counts.append(self.counts[-1])
+            self.exact = self.exact and magnitude < 2 ** 53
+        self.stale = False
+        self.rebuilds += 1
+
+    def query(self, bounds):
+        """return (sum, numeric cell count) of a rectangle inside the region. sum is None when
+        rounding may have changed it, the range must be scanned then"""
+        if self.stale:
+            self.build()
+        row0 = bounds[0] - self.bounds[0]
+        col0 = bounds[1] - self.bounds[1]
+        row1 = bounds[2] - self.bounds[0] + 1
+        col1 = bounds[3] - self.bounds[1] + 1
+        sums, counts = self.sums, self.counts
+        corners = (sums[col1][row1], sums[col0][row1], sums[col1][row0], sums[col0][row0])
+        total = float(corners[0] - corners[1] - corners[2] + corners[3])
+        count = counts[col1][row1] - counts[col0][row1] - counts[col1][row0] + counts[col0][row0]
+        if not self.exact:
+            errors = self.errors
+            bound = (float(errors[col1][row1] + errors[col0][row1] + errors[col1][row0] + errors[col0][row0])
+                     + 3 * self.UNIT_ROUNDOFF * max(abs(float(corner)) for corner in corners))
+            if bound > self.TOLERANCE * abs(total):
+                total = None
+        return total, int(count)
+
+
+class RangeMinMax:
+    """Segment trees answering MIN and MAX over row ranges of one column.
+
+    levels[0] holds one leaf per row (inf / -inf for cells without a number) and
+    every level above holds the min / max of pairs of the level below, so a query
+    or a point update touches O(log n) entries. The trees are built the first time
+    they are queried and grow (by rebuilding) when a write lands past their end.
+    The trees of a copy (see copy) are shared until one of the indexes is updated.
+    """
+    INF = float('inf')
+
+    def __init__(self, cells, col):
+        self.cells = cells
+        self.col = col
+        self.size = 0
+        self.stale = True
+        self.shared = False  # the levels are shared with a copy, update() copies them first
+        self.min_levels = None
+        self.max_levels = None
+
+    def copy(self, cells):
+        """return the index of the same column of a copy of the cells (see Sheet.snapshot)"""
+        index = RangeMinMax(cells, self.col)
+        index.size, index.stale = self.size, self.stale
+        index.min_levels, index.max_levels = self.min_levels, self.max_levels
+        index.shared = self.shared = not self.stale
+        return index
+
+    def build(self):
+        column = self.cells.columns.get(self.col, {})
+        rows_used = (max(column) + 1) * self.cells.BLOCK_ROWS if column else 1
+        size = 1
+        while size < rows_used:
+            size *= 2
+        mins = array('d', [self.INF]) * size
+        maxs = array('d', [-self.INF]) * size
+        for values, mask, col, first_row in self.cells.numeric_slices(0, self.col, size - 1, self.col):
+            for offset, numeric in enumerate(mask):
+                if numeric:
+                    mins[first_row + offset] = maxs[first_row + offset] = values[offset]
+        self.min_levels = [mins]
+        self.max_levels = [maxs]
+        while len(mins) > 1:
+            mins = array('d', map(min, mins[0::2], mins[1::2]))
+            maxs = array('d', map(max, maxs[0::2], maxs[1::2]))
+            self.min_levels.append(mins)
+            self.max_levels.append(maxs)
+        self.size = size
+        self.stale = False
+        self.shared = False
+
+    def update(self, row):
+        """called on every write to the column, refreshes the leaf of the row and its parents"""
+        if self.stale:
+            return
+        if row >= self.size:
+            self.stale = True
+            return
+        if self.shared:
+            self.min_levels = [level[:] for level in self.min_levels]
+            self.max_levels = [level[:] for level in self.max_levels]
+            self.shared = False
+        number = self.cells.number_at(row, self.col)
+        self.min_levels[0][row] = self.INF if number is None else number
+        self.max_levels[0][row] = -self.INF if number is None else number
+        for level in range(1, len(self.min_levels)):
+            row //= 2
+            below_min, below_max = self.min_levels[level - 1], self.max_levels[level - 1]
+            self.min_levels[level][row] = min(below_min[2 * row], below_min[2 * row + 1])
+            self.max_levels[level][row] = max(below_max[2 * row], below_max[2 * row + 1])
+
+    def query(self, start_row, end_row):
+        """return (min, max) of the numbers between two rows (inclusive), (inf, -inf) if there are none"""
+        if self.stale:
+            self.build()
+        low, high = start_row, min(end_row + 1, self.size)
+        smallest, largest = self.INF, -self.INF
+        level = 0
+        while low < high:
+            if low & 1:
+                smallest = min(smallest, self.min_levels[level][low])
+                largest = max(largest, self.max_levels[level][low])
+                low += 1
+            if high & 1:
+                high -= 1
+                smallest = min(smallest, self.min_levels[level][high])
+                largest = max(largest, self.max_levels[level][high])
+            low //= 2
+            high //= 2
+            level += 1
+        return smallest, largest
@@ -0,0 +1,83 @@
+import json
+
+
+class JsonStreamReader:
+    """Reads a JSON document from a text file a value at a time.
+
+    Only a window of the file is kept in memory: the containers the caller steps into
+    with members() and items() are never decoded as a whole, every value the caller
+    asks for with value() is decoded on its own with json.JSONDecoder.raw_decode.
+    """
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ''
+        self.pos = 0
+        self.exhausted = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        """read the next chunk, dropping what was already consumed. returns False at the end of the file"""
+        if self.exhausted:
+            return False
+        chunk = self.file.read(self.CHUNK_SIZE)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.exhausted = not chunk
+        return bool(chunk)
+
+    def peek(self):
+        """return the next character that is not whitespace ('' at the end of the file)"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, characters):
+        """consume the next character, which must be one of characters"""
+        character = self.peek()
+        if not character or character not in characters:
+            raise json.JSONDecodeError(f"Expecting one of {characters!r}", self.buffer, self.pos)
+        self.pos += 1
+        return character
+
+    def value(self):
+        """decode the next value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue  # the value goes on in the next chunk
+                raise
+            if end == len(self.buffer) and self.fill():
+                continue  # a number may go on in the next chunk
+            self.pos = end
+            return value
+
+    def members(self):
+        """step into an object and yield its keys, the caller must read the value of every key"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def items(self):
+        """step into an array and yield its values one at a time"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
@@ -0,0 +1,166 @@
+"""Native binary file format of the sheets (.hsheet).
+
+Layout, all integers and numbers little endian (swapped on big endian machines):
+
+    header        HEADER: magic, dimensions, compression, table sizes and offsets
+    blocks        the numbers (8 bytes per row) and the type tags (1 byte per row) of every
+                  allocated CellStore block, each aligned to 8 bytes, compressed or not
+    block index   one BLOCK_ENTRY per block: col, block index, offset, stored sizes
+    string table  STRING_COUNT lengths (uint32) followed by the JSON encoded strings
+    object table  one CELL_ENTRY per text, error (or other object) cell: row, col, string index
+    formula table one CELL_ENTRY per formula cell: row, col, string index
+
+Uncompressed files are memory-mapped: the blocks of the loaded sheet are views of the
+file until a cell of the block is written, so opening a file doesn't read its numbers.
+A file is written to a temporary file next to it that replaces it once it is complete, so
+a sheet can be saved over the file its blocks are mapped from.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from sheet import Sheet
+
+MAGIC = b'HSHEET\x00\x01'
+HEADER = struct.Struct('<8sIIIB3xIIIIQQQQ')
+BLOCK_ENTRY = struct.Struct('<IIQII')
+CELL_ENTRY = struct.Struct('<III')
+
+# Block compression, stored in the header: name -> code
+COMPRESSIONS = {None: 0, 'zlib': 1, 'lzma': 2}
+
+
+def compressor(code):
+    """return (compress, decompress) functions of a compression code, zlib and lzma are imported on use"""
+    if code == 0:
+        return bytes, bytes
+    if code == 1:
+        import zlib
+        return zlib.compress, zlib.decompress
+    if code == 2:
+        import lzma
+        return lzma.compress, lzma.decompress
+    raise ValueError(f"Unknown compression code: {code}")
+
+
+def write_sheet(sheet, file_path, compression=None):
+    """write a sheet to a native file, compression is None, 'zlib' or 'lzma'"""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression: '{compression}'")
+    code = COMPRESSIONS[compression]
+    compress = compressor(code)[0]
+    temporary_path = f"{file_path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, 'wb') as file:
+            write_tables(sheet, file, code, compress)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def write_tables(sheet, file, code, compress):
+    """the steps of write_sheet, writes the whole file to an open binary file"""
+    cells = sheet.cells
+    strings = {}  # JSON encoded string -> index in the string table
+
+    def string_index(value):
+        return strings.setdefault(json.dumps(value), len(strings))
+
+    file.write(bytes(HEADER.size))
+    block_entries = []
+    for col in sorted(cells.columns):
+        for index, (numbers, tags) in sorted(cells.columns[col].items()):
+            stored_numbers = compress(little_endian(numbers))
+            stored_tags = compress(bytes(tags))
+            file.write(bytes(-file.tell() % 8))
+            block_entries.append((col, index, file.tell(), len(stored_numbers), len(stored_tags)))
+            file.write(stored_numbers)
+            file.write(stored_tags)
+
+    object_entries = [(row, col, string_index(value)) for (row, col), value in cells.objects.items()]
+    formula_entries = [(row, col, string_index(formula)) for (row, col), formula in cells.formulas.items()]
+
+    block_index_offset = file.tell()
+    for entry in block_entries:
+        file.write(BLOCK_ENTRY.pack(*entry))
+    string_table_offset = file.tell()
+    encoded = [string.encode('utf-8') for string in strings]
+    lengths = array('I', map(len, encoded))
+    if sys.byteorder == 'big':
+        lengths.byteswap()
+    file.write(lengths.tobytes())
+    file.write(b''.join(encoded))
+    object_table_offset = file.tell()
+    for entry in object_entries:
+        file.write(CELL_ENTRY.pack(*entry))
+    formula_table_offset = file.tell()
+    for entry in formula_entries:
+        file.write(CELL_ENTRY.pack(*entry))
+
+    file.seek(0)
+    file.write(HEADER.pack(MAGIC, sheet.rows, sheet.cols, cells.BLOCK_ROWS, code,
+                           len(block_entries), len(strings), len(object_entries), len(formula_entries),
+                           block_index_offset, string_table_offset, object_table_offset,
+                           formula_table_offset))
+
+
+def little_endian(numbers):
+    """the bytes of the numbers of a block, in the byte order of the files"""
+    if sys.byteorder == 'little':
+        return bytes(numbers)
+    swapped = array('d', bytes(numbers))
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def read_sheet(file_path):
+    """load a sheet from a native file"""
+    with open(file_path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, rows, cols, block_rows, code, block_count, string_count, object_count, formula_count,
+     block_index_offset, string_table_offset, object_table_offset, formula_table_offset) = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a sheet file (or written by a newer version).")
+    sheet = Sheet(rows, cols)
+    cells = sheet.cells
+    if block_rows != cells.BLOCK_ROWS:
+        raise ValueError(f"Blocks of {block_rows} rows are not supported.")
+    decompress = compressor(code)[1]
+
+    view = memoryview(data)
+    block_index = view[block_index_offset:block_index_offset + block_count * BLOCK_ENTRY.size]
+    for col, index, offset, numbers_size, tags_size in BLOCK_ENTRY.iter_unpack(block_index):
+        numbers = view[offset:offset + numbers_size]
+        tags = view[offset + numbers_size:offset + numbers_size + tags_size]
+        if code:
+            numbers = array('d')
+            numbers.frombytes(decompress(view[offset:offset + numbers_size]))
+            tags = bytearray(decompress(tags))
+        elif sys.byteorder == 'big':
+            numbers = array('d', numbers.tobytes())
+        else:
+            numbers = numbers.cast('d')  # no copy, the block is read from the file when it is used
+        if sys.byteorder == 'big':
+            numbers.byteswap()
+        cells.columns.setdefault(col, {})[index] = (numbers, tags)
+
+    lengths = array('I')
+    lengths.frombytes(view[string_table_offset:string_table_offset + 4 * string_count])
+    if sys.byteorder == 'big':
+        lengths.byteswap()
+    strings = []
+    position = string_table_offset + 4 * string_count
+    for length in lengths:
+        strings.append(json.loads(bytes(view[position:position + length])))
+        position += length
+
+    for row, col, string in CELL_ENTRY.iter_unpack(
+            view[object_table_offset:object_table_offset + object_count * CELL_ENTRY.size]):
+        cells.objects[(row, col)] = strings[string]
+    for row, col, string in CELL_ENTRY.iter_unpack(
+            view[formula_table_offset:formula_table_offset + formula_count * CELL_ENTRY.size]):
+        sheet.register_formula(strings[string], row, col)
+    return sheet
@@ -0,0 +1,105 @@
+"""PDF export, one page at a time.
+
+The used part of the sheet is cut into pages of ROWS_PER_PAGE rows and COLS_PER_PAGE
+columns (top to bottom, then left to right). Every page is a small reportlab Table with
+the column labels repeated on its first row and the row numbers on its first column,
+drawn straight on the canvas, so only one page is laid out and held at a time. Cell
+colors are sparse and are styled as rectangles: runs of a color along a row, merged
+with the same run on the rows below.
+"""
+from addresses import column_label
+
+ROWS_PER_PAGE = 40
+COLS_PER_PAGE = 8
+DEFAULT_COLORS = ('', '#FFFFFF', '#ffffff')
+
+
+def sparse_colors(cell_colors):
+    """return {row: [(col, color), ...] sorted by col} of the colored cells. cell_colors is
+    {(row, col): color} or a 2-D list of colors (the older export_to_pdf argument)"""
+    if isinstance(cell_colors, dict):
+        items = cell_colors.items()
+    else:
+        items = (((row, col), color) for row, row_colors in enumerate(cell_colors)
+                 for col, color in enumerate(row_colors))
+    colors_by_row = {}
+    for (row, col), color in items:
+        if color not in DEFAULT_COLORS:
+            colors_by_row.setdefault(row, []).append((col, color))
+    for row_colors in colors_by_row.values():
+        row_colors.sort()
+    return colors_by_row
+
+
+def color_ranges(colors_by_row, start_row, end_row, start_col, end_col):
+    """return [(color, first_row, first_col, last_row, last_col)] covering the colored cells of a
+    rectangle (end excluded): runs of one color along a row, merged with identical runs below"""
+    ranges = []
+    open_ranges = {}  # (first_col, last_col, color) -> index in ranges of a rectangle ending on the row above
+    for row in range(start_row, end_row):
+        runs = []
+        for col, color in colors_by_row.get(row, ()):
+            if start_col <= col < end_col:
+                if runs and runs[-1][2] == color and runs[-1][1] == col - 1:
+                    runs[-1][1] = col
+                else:
+                    runs.append([col, col, color])
+        still_open = {}
+        for first_col, last_col, color in runs:
+            key = (first_col, last_col, color)
+            if key in open_ranges:
+                index = open_ranges[key]
+                first_row = ranges[index][1]
+                ranges[index] = (color, first_row, first_col, row, last_col)
+            else:
+                index = len(ranges)
+                ranges.append((color, row, first_col, row, last_col))
+            still_open[key] = index
+        open_ranges = still_open
+    return ranges
+
+
+def write_pdf(sheet, file_path, cell_colors=()):
+    """write the used part of a sheet to a PDF file, cell_colors as in sparse_colors"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen.canvas import Canvas
+    from reportlab.platypus import Table, TableStyle
+
+    colors_by_row = sparse_colors(cell_colors)
+    rows, cols = sheet.cells.used_bounds()
+    if colors_by_row:
+        rows = max(rows, max(colors_by_row) + 1)
+        cols = max(cols, max(col for row_colors in colors_by_row.values() for col, _ in row_colors) + 1)
+    rows, cols = min(max(rows, 1), sheet.rows), min(max(cols, 1), sheet.cols)
+
+    page_width, page_height = letter
+    margin = 36
+    column_width = (page_width - 2 * margin) / (COLS_PER_PAGE + 1)
+    row_height = (page_height - 2 * margin) / (ROWS_PER_PAGE + 1)
+    canvas = Canvas(file_path, pagesize=letter)
+    for start_col in range(0, cols, COLS_PER_PAGE):
+        end_col = min(start_col + COLS_PER_PAGE, cols)
+        header = [''] + [column_label(col) for col in range(start_col, end_col)]
+        for start_row in range(0, rows, ROWS_PER_PAGE):
+            end_row = min(start_row + ROWS_PER_PAGE, rows)
+            data = [header]
+            for row in range(start_row, end_row):
+                data.append([row + 1] + [sheet.cells.get_value(row, col, '') for col in range(start_col, end_col)])
+
+            style = [('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+                     ('GRID', (0, 0), (-1, -1), 1, colors.black),
+                     ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+                     ('BACKGROUND', (0, 1), (0, -1), colors.lightgrey)]
+            # Table coordinates are (col, row), shifted by the header row and the row number column
+            for color, first_row, first_col, last_row, last_col in color_ranges(
+                    colors_by_row, start_row, end_row, start_col, end_col):
+                style.append(('BACKGROUND', (first_col - start_col + 1, first_row - start_row + 1),
+                              (last_col - start_col + 1, last_row - start_row + 1), color))
+
+            table = Table(data, colWidths=column_width, rowHeights=row_height)
+            table.setStyle(TableStyle(style))
+            _, table_height = table.wrapOn(canvas, page_width - 2 * margin, page_height - 2 * margin)
+            table.drawOn(canvas, margin, page_height - margin - table_height)
+            canvas.showPage()
+    canvas.save()
@@ -0,0 +1,165 @@
+"""Opt-in instrumentation of the formula engine and the recalculation.
+
+While a Profiler is active (enable() until disable()) it records:
+
+    formulas   evaluations and cumulative seconds of every formula, by cell (formulas the
+               GUI evaluates on entry have no cell)
+    ranges     calls of every range function, the cells their ranges cover and how many
+               calls an index (the summed-area table, the min/max trees) could answer
+    cache      hits and misses of the compiled formula cache since enable()
+    passes     recalculation passes: count, formulas, seconds spent evaluating them
+
+When profiling is off the engine only checks 'active is None', once per recalculation pass
+and once per range function call. The passes of the background thread are recorded too,
+the counters are guarded by a lock.
+"""
+import json
+import threading
+import time
+from collections import deque
+from addresses import column_label
+from formula_compiler import compile_cached
+
+active = None  # the recording Profiler, None when profiling is off
+
+
+def enable():
+    """start profiling (or keep the profiler already recording), returns the active Profiler"""
+    global active
+    if active is None:
+        active = Profiler()
+    return active
+
+
+def disable():
+    """stop profiling, returns the Profiler that was recording (its counters stay readable) or None"""
+    global active
+    profiler, active = active, None
+    return profiler
+
+
+class Profiler:
+    RECENT_PASSES = 100  # passes kept one by one for the dumps, the totals cover all of them
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """forget everything recorded so far"""
+        with self.lock:
+            self.formulas = {}  # (address or None, formula) -> [evaluations, seconds]
+            self.ranges = {}  # function name -> [calls, cells, calls an index could answer]
+            self.passes = {'count': 0, 'cancelled': 0, 'formulas': 0, 'total': 0.0, 'max': 0.0}
+            self.recent_passes = deque(maxlen=self.RECENT_PASSES)  # (formulas, seconds, completed)
+            self.cache_start = compile_cached.cache_info()
+
+    def record_formula(self, cell, formula, seconds):
+        """count one evaluation of a formula, cell is (row, col) or None"""
+        key = (None if cell is None else f"{column_label(cell[1])}{cell[0] + 1}", formula)
+        with self.lock:
+            entry = self.formulas.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def evaluate(self, compiled, sheet):
+        """evaluate a compiled formula outside of a recalculation pass and record it"""
+        started = time.perf_counter()
+        try:
+            return compiled.evaluate(sheet)
+        finally:
+            self.record_formula(None, '=' + compiled.text, time.perf_counter() - started)
+
+    def record_range(self, name, arguments, sheet):
+        """count a call of a range function (SUM, AVERAGE, MAX, MIN) with its arguments"""
+        ranges = [argument for argument in arguments if isinstance(argument, tuple)]
+        cells = sum((end_row - start_row + 1) * (end_col - start_col + 1)
+                    for start_row, start_col, end_row, end_col in ranges)
+        if name in ('MAX', 'MIN'):
+            indexed = all(col in sheet.minmax_index for _, start_col, _, end_col in ranges
+                          for col in sheet.dependencies.range_columns(start_col, end_col))
+        else:
+            indexed = sheet.sum_index is not None and all(map(sheet.sum_index.covers, ranges))
+        with self.lock:
+            entry = self.ranges.setdefault(name, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += cells
+            entry[2] += bool(ranges) and indexed
+
+    def profile_pass(self, sheet, changed):
+        """the steps of Sheet.recalculate_steps, with every formula and the whole pass timed"""
+        started = time.perf_counter()
+        order, cyclic = sheet.recalc_order(changed)
+        seconds = time.perf_counter() - started
+        steps = sheet.evaluate_steps(order, cyclic)
+        evaluated = 0
+        completed = False
+        try:
+            while True:
+                started = time.perf_counter()
+                cell = next(steps, None)
+                step = time.perf_counter() - started
+                seconds += step
+                if cell is None:
+                    completed = True
+                    return
+                evaluated += 1
+                self.record_formula(cell, sheet.cells.get_formula(*cell), step)
+                yield cell
+        finally:
+            # Cancelled and superseded passes are closed before their end
+            self.record_pass(evaluated, seconds, completed)
+
+    def record_pass(self, formulas, seconds, completed=True):
+        with self.lock:
+            self.passes['count'] += 1
+            self.passes['cancelled'] += not completed
+            self.passes['formulas'] += formulas
+            self.passes['total'] += seconds
+            self.passes['max'] = max(self.passes['max'], seconds)
+            self.recent_passes.append((formulas, seconds, completed))
+
+    def stats(self):
+        """return the counters as a dictionary (what dump() writes), formulas sorted by time"""
+        cache = compile_cached.cache_info()
+        with self.lock:
+            hits, misses = cache.hits - self.cache_start.hits, cache.misses - self.cache_start.misses
+            formulas = [{'cell': cell, 'formula': formula, 'evaluations': count, 'time': seconds}
+                        for (cell, formula), (count, seconds) in self.formulas.items()]
+            formulas.sort(key=lambda entry: entry['time'], reverse=True)
+            passes = dict(self.passes)
+            passes['mean'] = passes['total'] / passes['count'] if passes['count'] else 0.0
+            passes['recent'] = [{'formulas': count, 'time': seconds, 'completed': completed}
+                                for count, seconds, completed in self.recent_passes]
+            return {
+                'formulas': formulas,
+                'ranges': {name: {'calls': calls, 'cells': cells, 'indexed': indexed}
+                           for name, (calls, cells, indexed) in self.ranges.items()},
+                'cache': {'hits': hits, 'misses': misses,
+                          'hit_rate': hits / (hits + misses) if hits + misses else 0.0},
+                'passes': passes,
+            }
+
+    def dump(self, file_path):
+        """write stats() to a JSON file"""
+        with open(file_path, 'w') as file:
+            json.dump(self.stats(), file, indent=2)
+
+    def report(self, limit=20):
+        """return stats() as text, with the limit slowest formulas"""
+        stats = self.stats()
+        passes, cache = stats['passes'], stats['cache']
+        lines = [f"Recalculation passes: {passes['count']} ({passes['cancelled']} cancelled), "
+                 f"{passes['formulas']} formulas, {passes['total']:.4f}s in total, "
+                 f"longest {passes['max']:.4f}s, mean {passes['mean']:.4f}s",
+                 f"Formula cache: {cache['hits']} hits, {cache['misses']} misses "
+                 f"({cache['hit_rate']:.0%} hits)",
+                 "Range functions:"]
+        for name, entry in sorted(stats['ranges'].items()):
+            lines.append(f"  {name}: {entry['calls']} calls, {entry['cells']} cells, "
+                         f"{entry['indexed']} answered by an index")
+        lines.append(f"Slowest formulas ({len(stats['formulas'])} in total):")
+        for entry in stats['formulas'][:limit]:
+            lines.append(f"  {entry['cell'] or '(entry)'}  {entry['formula']}  "
+                         f"{entry['evaluations']} evaluations  {entry['time']:.6f}s")
+        return "\n".join(lines)
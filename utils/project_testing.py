@@ -1,6 +1,14 @@
-from sheet import Sheet
+from sheet import Sheet, Cell, column_label
+from addresses import column_index
+import storage
+from storage import CellStore
 import pytest
-from utils.calculates import FormulaParser, FunctionLibrary
+from calculates import FormulaParser, FunctionLibrary
+from formula_compiler import tokenize, compile_formula, compile_cached, FormulaSyntaxError, FormulaDivisionError
+import json
+import os
+import subprocess
+import sys
 
 @pytest.fixture
 def sheet():
@@ -147,3 +155,1120 @@ def test_find_min():
     test_sheet.set_value(20, 1, 1)
     # Test minimum value calculation
     assert FunctionLibrary.find_min("A1:B2", test_sheet) == 5
+
+
+def test_cell_store_keeps_types():
+    test_sheet = Sheet(3, 3)
+    test_sheet.set_value(5, 0, 0)
+    test_sheet.set_value(2.5, 0, 1)
+    test_sheet.set_value("hello", 0, 2)
+    assert test_sheet.get_value(0, 0) == 5 and isinstance(test_sheet.get_value(0, 0), int)
+    assert test_sheet.get_value(0, 1) == 2.5
+    assert test_sheet.get_value(0, 2) == "hello"
+    assert test_sheet.get_value(2, 2) == ''
+    # Overwriting text with a number moves the cell back to the column array
+    test_sheet.set_value(7, 0, 2)
+    assert test_sheet.get_value(0, 2) == 7
+    assert test_sheet.cells.objects == {}
+
+
+def test_cell_store_memory_per_cell():
+    test_sheet = Sheet(1000, 3)
+    # Untouched columns are not allocated at all
+    assert test_sheet.cells.nbytes() == 0
+    for row in range(1000):
+        test_sheet.set_value(row * 1.5, row, 0)
+    assert test_sheet.cells.nbytes() == CellStore.BLOCK_ROWS * CellStore.BYTES_PER_NUMERIC_CELL
+    assert test_sheet.get_value(999, 0) == 999 * 1.5
+
+
+def test_formula_cell_without_value():
+    test_sheet = Sheet(3, 3)
+    test_sheet.set_value(4, 1, 1)
+    test_sheet.set_formula("=A1+B1", 1, 1)
+    assert test_sheet.get_value(1, 1) is None
+    assert test_sheet.get_formula(0, 0) is None
+
+
+def test_insert_row():
+    test_sheet = Sheet(2, 2)
+    test_sheet.set_value(1, 1, 1)
+    test_sheet.insert_row()
+    assert test_sheet.rows == 3
+    test_sheet.set_value(3, 2, 1)
+    assert test_sheet.get_value(2, 1) == 3
+    assert test_sheet.get_value(2, 0) == ''
+
+
+def test_column_labels():
+    assert column_label(0) == "A"
+    assert column_label(25) == "Z"
+    assert column_label(26) == "AA"
+    assert column_label(701) == "ZZ"
+    assert column_label(702) == "AAA"
+    for col in (0, 25, 26, 51, 701, 702, 16383):
+        assert column_index(column_label(col)) == col
+
+
+def test_cell_loc_multi_letter():
+    assert Cell().cell_loc("AB12") == (11, 27)
+    assert Cell().cell_loc("a1") == (0, 0)
+    assert Cell().cell_loc("12") is False
+
+
+def test_large_sparse_sheet():
+    test_sheet = Sheet(500000, 300)
+    assert test_sheet.get_cell_address(499999, 299) == "KN500000"
+    test_sheet.set_value(1, 499999, 299)
+    test_sheet.set_value("text", 0, 27)
+    assert test_sheet.get_value(499999, 299) == 1
+    assert test_sheet.get_value(250000, 150) == ''
+    # Only the block that was written to holds memory
+    assert test_sheet.cells.nbytes() == 2 * CellStore.BLOCK_ROWS * CellStore.BYTES_PER_NUMERIC_CELL
+    test_sheet.insert_row()
+    assert test_sheet.rows == 500001
+    assert test_sheet.cells.nbytes() == 2 * CellStore.BLOCK_ROWS * CellStore.BYTES_PER_NUMERIC_CELL
+
+
+@pytest.fixture
+def math_sheet():
+    sheet = Sheet(3, 30)
+    sheet.set_value(2, 0, 0)
+    sheet.set_value(3, 0, 1)
+    sheet.set_value(4, 1, 0)
+    sheet.set_value(5, 0, 27)
+    return sheet
+
+
+def test_tokenize():
+    assert [token[:2] for token in tokenize("2A1 + sum(B1:B3)")] == [
+        ('number', 2), ('cell', 'A1'), ('op', '+'), ('function', 'SUM'),
+        ('op', '('), ('cell', 'B1'), ('op', ':'), ('cell', 'B3'), ('op', ')')]
+    assert [token[:2] for token in tokenize("1E5 + 2.5e-3*A1")] == [
+        ('number', 100000.0), ('op', '+'), ('number', 0.0025), ('op', '*'), ('cell', 'A1')]
+    with pytest.raises(FormulaSyntaxError):
+        tokenize("A1 $ B1")
+
+
+def test_compiled_precedence_and_parentheses(math_sheet):
+    assert FormulaParser.convert_to_math_formula("A1 + B1 * A2", math_sheet) == 14
+    assert FormulaParser.convert_to_math_formula("(A1 + B1) * A2", math_sheet) == 20
+    assert FormulaParser.convert_to_math_formula("-A1 - -B1", math_sheet) == 1
+    assert FormulaParser.convert_to_math_formula("=10 / 4 + 0.5", math_sheet) == 3
+    assert FormulaParser.convert_to_math_formula("2A1 + AB1", math_sheet) == 9
+    assert FormulaParser.convert_to_math_formula("=1E5", math_sheet) == 100000
+    assert FormulaParser.convert_to_math_formula("=2.5e-3", math_sheet) == 0.0025
+    assert FormulaParser.convert_to_math_formula("1e+2 - A1", math_sheet) == 98
+
+
+def test_compiled_nested_functions(math_sheet):
+    assert FormulaParser.evaluate_formula("=SUM(A1:B1) * 2", math_sheet) == 10
+    assert FormulaParser.evaluate_formula("=MAX(SUM(A1:A2), 7, B1)", math_sheet) == 7
+    assert FormulaParser.evaluate_formula("=min(A1:B1, 1 + MAX(A1:A2))", math_sheet) == 2
+    assert FormulaParser.evaluate_formula("=AVERAGE(A1:A2) + 1", math_sheet) == 4
+
+
+def test_compiled_formula_errors(math_sheet):
+    with pytest.raises(ValueError, match="Division by zero error!"):
+        FormulaParser.convert_to_math_formula("A1 / (B1 - 3)", math_sheet)
+    with pytest.raises(FormulaSyntaxError):
+        FormulaParser.convert_to_math_formula("A1 +", math_sheet)
+    with pytest.raises(FormulaSyntaxError, match="Unsupported function"):
+        FormulaParser.convert_to_math_formula("FOO(A1:A2)", math_sheet)
+
+
+def test_functions_need_arguments():
+    for formula in ("=MAX()", "=MIN()", "=SUM()", "=AVERAGE( )"):
+        with pytest.raises(FormulaSyntaxError, match="at least one argument"):
+            compile_formula(formula)
+    test_sheet = Sheet(3, 2)
+    test_sheet.set_value(2, 0, 0)
+    test_sheet.set_formula("=MAX()", 1, 0)
+    test_sheet.set_formula("=A1 + 1", 2, 0)
+    assert test_sheet.recalculate() == [(2, 0)]  # the invalid formula doesn't stop the pass
+    assert test_sheet.get_value(2, 0) == 3
+    assert test_sheet.get_value(1, 0) == '#NAME?'
+    test_sheet.set_formula("=clr(A1:A2)", 1, 1)
+    assert test_sheet.get_value(1, 1) is None
+
+
+def test_compiled_formula_cache(math_sheet):
+    compiled = compile_formula("=A1 * 3 + 17")
+    assert compile_formula("A1 * 3 + 17") is compiled
+    hits = compile_cached.cache_info().hits
+    FormulaParser.convert_to_math_formula("A1 * 3 + 17", math_sheet)
+    assert compile_cached.cache_info().hits == hits + 1
+    assert compiled.cells == ((0, 0),)
+    assert compile_formula("SUM(B3:A1)").ranges == ((0, 0, 2, 1),)
+
+
+@pytest.fixture
+def chain_sheet():
+    sheet = Sheet(10, 3)
+    for row in range(5):
+        sheet.set_value(row + 1, row, 0)
+    sheet.set_formula("=SUM(A1:A5)", 0, 1)
+    sheet.set_formula("=B1 * 2", 1, 1)
+    sheet.set_formula("=A5 + 1", 2, 1)
+    sheet.set_formula("=C2 + 1", 0, 2)
+    sheet.recalculate()
+    return sheet
+
+
+def test_dependents_of(chain_sheet):
+    graph = chain_sheet.dependencies
+    assert graph.dependents_of((0, 0)) == {(0, 1)}
+    assert graph.dependents_of((4, 0)) == {(0, 1), (2, 1)}
+    assert graph.dependents_of((0, 1)) == {(1, 1)}
+    assert graph.dependents_of((9, 0)) == set()
+
+
+def test_wide_ranges_stop_at_the_last_column(chain_sheet):
+    graph = chain_sheet.dependencies
+    chain_sheet.set_formula("=SUM(A1:ZZZZZZZ1)", 5, 1)
+    chain_sheet.set_formula("=SUM(A1:E1)", 6, 1)
+    assert sorted(graph.range_dependents) == [0, 1, 2]
+    assert graph.dependents_of((0, 2)) == {(5, 1), (6, 1)}
+    chain_sheet.recalculate()
+    assert chain_sheet.get_value(6, 1) == '#REF!'
+    # Growing the sheet extends the edges to its new columns
+    chain_sheet.resize(10, 5)
+    assert sorted(graph.range_dependents) == [0, 1, 2, 3, 4]
+    chain_sheet.set_value(7, 0, 4)
+    chain_sheet.recalculate([(0, 4)])
+    assert chain_sheet.get_value(6, 1) == 1 + 15 + 1 + 7
+    chain_sheet.clear_formula(5, 1)
+    chain_sheet.clear_formula(6, 1)
+    assert sorted(graph.range_dependents) == [0]
+
+
+def test_incremental_recalculate(chain_sheet):
+    assert chain_sheet.get_value(1, 1) == 30
+    chain_sheet.set_value(10, 0, 0)
+    recalculated = chain_sheet.recalculate([(0, 0)])
+    assert sorted(recalculated) == [(0, 1), (1, 1)]
+    assert chain_sheet.get_value(0, 1) == 24
+    assert chain_sheet.get_value(1, 1) == 48
+    # Cells that read nothing that changed are left alone
+    assert chain_sheet.recalculate([(8, 2)]) == []
+
+
+def test_clear_formula_removes_dependencies(chain_sheet):
+    chain_sheet.clear_formula(0, 1)
+    assert not chain_sheet.has_formula(0, 1)
+    assert chain_sheet.dependencies.dependents_of((0, 0)) == set()
+    assert chain_sheet.get_value(0, 1) == 15
+    # Replacing a formula replaces its precedents
+    chain_sheet.set_formula("=A1", 2, 1)
+    assert chain_sheet.dependencies.dependents_of((4, 0)) == set()
+    assert chain_sheet.dependencies.dependents_of((0, 0)) == {(2, 1)}
+
+
+def test_recalculate_in_dependency_order():
+    test_sheet = Sheet(5, 2)
+    # Each formula reads a formula that comes after it
+    test_sheet.set_formula("=A2 + 1", 0, 0)
+    test_sheet.set_formula("=A3 + 1", 1, 0)
+    test_sheet.set_formula("=B1 * 10", 2, 0)
+    test_sheet.set_value(2, 0, 1)
+    test_sheet.recalculate()
+    assert test_sheet.get_value(0, 0) == 22
+    order, cyclic = test_sheet.dependencies.recalc_order(test_sheet.dependencies.formulas)
+    assert order == [(2, 0), (1, 0), (0, 0)]
+    assert cyclic == []
+
+
+def test_recalculate_cycle():
+    test_sheet = Sheet(5, 2)
+    test_sheet.set_formula("=B1 + 1", 0, 0)
+    test_sheet.set_formula("=A1 + 1", 0, 1)
+    test_sheet.set_formula("=A1 * 2", 1, 0)
+    test_sheet.set_formula("=B3 + 1", 2, 1)
+    test_sheet.set_formula("=5", 3, 0)
+    test_sheet.recalculate()
+    assert test_sheet.get_value(0, 0) == Cell.CYCLE
+    assert test_sheet.get_value(0, 1) == Cell.CYCLE
+    # Cells reading a cycle can't be calculated either
+    assert test_sheet.get_value(1, 0) == Cell.CYCLE
+    assert test_sheet.get_value(2, 1) == Cell.CYCLE
+    assert test_sheet.get_value(3, 0) == 5
+    # Breaking the cycle fixes every cell
+    test_sheet.set_formula("=7", 0, 1)
+    test_sheet.recalculate([(0, 1)])
+    assert test_sheet.get_value(0, 0) == 8
+    assert test_sheet.get_value(1, 0) == 16
+
+
+def test_recalculate_long_chain():
+    test_sheet = Sheet(5000, 1)
+    test_sheet.set_value(1, 0, 0)
+    for row in range(1, 5000):
+        test_sheet.set_formula(f"=A{row} + 1", row, 0)
+    # No recursion, so a long chain can't overflow the stack
+    test_sheet.recalculate([(0, 0)])
+    assert test_sheet.get_value(4999, 0) == 5000
+
+
+@pytest.fixture(params=["numpy", "python"])
+def aggregate_sheet(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(storage, "np", None)
+        monkeypatch.setattr(storage, "numpy_checked", True)
+    elif storage.load_numpy() is None:
+        pytest.skip("numpy is not installed")
+    sheet = Sheet(3000, 4)
+    for row in range(3000):
+        sheet.set_value(row % 97 - 40, row, 0)
+        sheet.set_value(row * 0.5, row, 1)
+    sheet.set_value("12.5", 2500, 2)
+    sheet.set_value("text", 10, 2)
+    sheet.set_value(-3, 2999, 3)
+    return sheet
+
+
+def brute_force_values(sheet, start_row, start_col, end_row, end_col):
+    values = [sheet.get_value(row, col)
+              for row in range(start_row, end_row + 1) for col in range(start_col, end_col + 1)]
+    return [value for value in values if isinstance(value, (int, float))]
+
+
+def test_vectorized_aggregates(aggregate_sheet):
+    for bounds in ((0, 0, 2999, 3), (5, 0, 2100, 1), (1000, 1, 1030, 2), (2400, 2, 2999, 3)):
+        expected = brute_force_values(aggregate_sheet, *bounds)
+        assert FunctionLibrary.sum_range(bounds, aggregate_sheet) == pytest.approx(sum(expected))
+        assert FunctionLibrary.max_range(bounds, aggregate_sheet) == max(expected)
+        assert FunctionLibrary.min_range(bounds, aggregate_sheet) == min(expected)
+    # Empty and text only ranges
+    assert FunctionLibrary.calc_sum("C1:C20", aggregate_sheet) == 0
+    assert FunctionLibrary.find_max("C1:C20", aggregate_sheet) == float('-inf')
+    assert FunctionLibrary.find_min("C1:C20", aggregate_sheet) == float('inf')
+
+
+def test_sum_index_matches_scan(aggregate_sheet):
+    index = aggregate_sheet.enable_sum_index(0, 0, 2999, 3)
+    for bounds in ((0, 0, 2999, 3), (5, 0, 2100, 1), (1000, 1, 1030, 2), (2400, 2, 2999, 3), (7, 1, 7, 1)):
+        expected = brute_force_values(aggregate_sheet, *bounds)
+        assert FunctionLibrary.sum_range(bounds, aggregate_sheet) == pytest.approx(sum(expected))
+        assert FunctionLibrary.count_numbers(bounds, aggregate_sheet) == len(expected)
+        assert FunctionLibrary.average_range(bounds, aggregate_sheet) == pytest.approx(sum(expected) / len(expected))
+    assert index.rebuilds == 1
+
+
+def test_sum_index_keeps_small_sums_next_to_large_values(aggregate_sheet):
+    aggregate_sheet.set_value(1e20, 0, 3)
+    aggregate_sheet.set_value(1, 1, 3)
+    aggregate_sheet.set_value(1, 2, 3)
+    aggregate_sheet.enable_sum_index(0, 0, 2999, 3)
+    assert FunctionLibrary.calc_sum("D2:D3", aggregate_sheet) == 2
+    assert FunctionLibrary.average("D2:D3", aggregate_sheet) == 1
+    assert FunctionLibrary.calc_sum("D1:D3", aggregate_sheet) == 1e20
+    # Ranges away from the large value are still answered by the table
+    assert aggregate_sheet.sum_index.query((0, 0, 2999, 0))[0] == sum(brute_force_values(aggregate_sheet, 0, 0, 2999, 0))
+    assert aggregate_sheet.sum_index.query((5, 1, 2100, 1))[0] == pytest.approx(
+        sum(brute_force_values(aggregate_sheet, 5, 1, 2100, 1)))
+
+
+def test_sum_index_rebuilds_lazily_after_writes(aggregate_sheet):
+    index = aggregate_sheet.enable_sum_index(0, 0, 99, 1)
+    assert FunctionLibrary.calc_sum("A1:B2", aggregate_sheet) == -40 - 39 + 0 + 0.5
+    aggregate_sheet.set_value(1000, 0, 0)
+    # A write outside the region keeps the table
+    aggregate_sheet.set_value(5, 500, 0)
+    assert index.stale
+    assert FunctionLibrary.calc_sum("A1:B2", aggregate_sheet) == 1000 - 39 + 0 + 0.5
+    aggregate_sheet.set_value(5, 500, 0)
+    assert not index.stale
+    assert index.rebuilds == 2
+
+
+def test_sum_index_from_formulas():
+    test_sheet = Sheet(10, 5)
+    for row in range(10):
+        test_sheet.set_value(row, row, 1)
+    test_sheet.set_formula("=SUM(B1:B5)", 0, 4)
+    test_sheet.set_formula("=AVERAGE(B3:C10)", 1, 4)
+    index = test_sheet.enable_sum_index()
+    assert index.bounds == (0, 1, 9, 2)
+    test_sheet.recalculate()
+    assert test_sheet.get_value(0, 4) == 10
+    assert test_sheet.get_value(1, 4) == sum(range(2, 10)) / 8
+
+
+def test_average_counts_numeric_cells_only():
+    test_sheet = Sheet(3, 3)
+    test_sheet.set_value(4, 0, 0)
+    test_sheet.set_value("text", 1, 0)
+    test_sheet.set_value(8, 2, 0)
+    assert FunctionLibrary.average("A1:A3", test_sheet) == 6
+
+
+def test_minmax_index_only_for_referenced_columns(aggregate_sheet):
+    aggregate_sheet.set_formula("=MAX(A1:B3000)", 0, 3)
+    aggregate_sheet.set_formula("=SUM(C1:C10)", 1, 3)
+    assert sorted(aggregate_sheet.minmax_index) == [0, 1]
+    aggregate_sheet.set_formula("=MIN(B1:B10)", 2, 3)
+    aggregate_sheet.clear_formula(0, 3)
+    assert sorted(aggregate_sheet.minmax_index) == [1]
+    # Columns past the last one of the sheet get no index
+    aggregate_sheet.set_formula("=MAX(C1:ZZZZZZZ1)", 3, 3)
+    assert sorted(aggregate_sheet.minmax_index) == [1, 2, 3]
+    aggregate_sheet.resize(3000, 6)
+    assert sorted(aggregate_sheet.minmax_index) == [1, 2, 3, 4, 5]
+    aggregate_sheet.clear_formula(3, 3)
+    assert sorted(aggregate_sheet.minmax_index) == [1]
+
+
+def test_minmax_index_queries_and_updates(aggregate_sheet):
+    aggregate_sheet.set_formula("=MAX(A1:C3000) + MIN(A1:C3000)", 0, 3)
+    for bounds in ((0, 0, 2999, 2), (5, 0, 2100, 1), (1000, 1, 1030, 2), (2400, 2, 2999, 2)):
+        expected = brute_force_values(aggregate_sheet, *bounds)
+        assert FunctionLibrary.max_range(bounds, aggregate_sheet) == max(expected)
+        assert FunctionLibrary.min_range(bounds, aggregate_sheet) == min(expected)
+    # Point updates from set_value
+    aggregate_sheet.set_value(-500, 1500, 1)
+    aggregate_sheet.set_value("99999", 10, 2)
+    aggregate_sheet.set_value(4, 2999, 0)
+    for bounds in ((0, 0, 2999, 2), (1400, 1, 1600, 1), (0, 2, 2999, 2)):
+        expected = brute_force_values(aggregate_sheet, *bounds)
+        assert FunctionLibrary.max_range(bounds, aggregate_sheet) == max(expected)
+        assert FunctionLibrary.min_range(bounds, aggregate_sheet) == min(expected)
+    aggregate_sheet.set_value("text", 10, 2)
+    assert FunctionLibrary.max_range((0, 2, 20, 2), aggregate_sheet) == float('-inf')
+
+
+def test_engine_imports_without_tkinter():
+    utils_dir = os.path.dirname(os.path.abspath(__file__))
+    code = "import sys, calculates, sheet; print('tkinter' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=utils_dir, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "False"
+
+
+def test_evaluate_formula_raises_instead_of_showing_dialogs(math_sheet):
+    with pytest.raises(FormulaSyntaxError):
+        FormulaParser.evaluate_formula("=SUM(A1:", math_sheet)
+    with pytest.raises(FormulaDivisionError):
+        FormulaParser.evaluate_formula("=A1 / 0", math_sheet)
+
+
+def test_recalculate_keeps_errors_as_values():
+    test_sheet = Sheet(3, 3)
+    test_sheet.set_value(0, 0, 0)
+    test_sheet.set_formula("=10 / A1", 0, 1)
+    test_sheet.set_formula("=B1 + 1", 0, 2)
+    test_sheet.set_formula("=SUM(A1:A9)", 1, 1)
+    test_sheet.set_formula("=C1 * 0 + 3", 1, 2)
+    test_sheet.recalculate()
+    assert test_sheet.get_value(0, 1) == "#DIV/0!"
+    # Errors flow to the formulas that read them
+    assert test_sheet.get_value(0, 2) == "#DIV/0!"
+    assert test_sheet.get_value(1, 2) == "#DIV/0!"
+    assert test_sheet.get_value(1, 1) == "#REF!"
+    test_sheet.set_value(5, 0, 0)
+    test_sheet.recalculate([(0, 0)])
+    assert test_sheet.get_value(0, 2) == 3
+
+
+@pytest.fixture
+def sheet_files(tmp_path):
+    import json
+    paths = []
+    for index in range(3):
+        path = tmp_path / f"sheet{index}.json"
+        cells = [{"row": 0, "col": 0, "value": index}, {"row": 1, "col": 0, "value": 10},
+                 {"row": 2, "col": 0, "value": "=SUM(A1:A2) * 2"}]
+        path.write_text(json.dumps({"rows": 3, "cols": 1, "cells": cells}))
+        paths.append(str(path))
+    return paths
+
+
+def test_loader_reads_formulas(sheet_files):
+    from import_export import SheetLoader
+    loaded = SheetLoader.load_from_json(sheet_files[1])
+    assert loaded.has_formula(2, 0)
+    loaded.recalculate()
+    assert loaded.get_value(2, 0) == 22
+
+
+def test_batch_convert(sheet_files, tmp_path):
+    from batch import run_batch
+    output_dir = tmp_path / "out"
+    results = list(run_batch(sheet_files + [str(tmp_path / "missing.json")], "csv", str(output_dir), processes=2))
+    assert len(results) == 4
+    failed = [result for result in results if result["error"]]
+    assert [result["input"] for result in failed] == [str(tmp_path / "missing.json")]
+    for result in results:
+        if not result["error"]:
+            assert result["formulas"] == 1 and result["total"] >= result["recalc"]
+    assert (output_dir / "sheet2.csv").read_text().splitlines()[2] == "24.0"
+
+
+def test_batch_command_line(sheet_files, tmp_path):
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output_dir = tmp_path / "out"
+    command = [sys.executable, "main.py", "--batch", *sheet_files, "--to", "csv", "--output-dir", str(output_dir)]
+    output = subprocess.run(command, cwd=root_dir, capture_output=True, text=True)
+    assert output.returncode == 0, output.stderr
+    assert output.stdout.splitlines()[-1].startswith("3 of 3 files converted")
+    assert (output_dir / "sheet1.csv").read_text().splitlines()[2] == "22.0"
+    output = subprocess.run([sys.executable, "main.py", "--help"], cwd=root_dir, capture_output=True, text=True)
+    assert output.returncode == 0 and "--batch" in output.stdout
+
+
+def test_failed_export_keeps_the_previous_file(monkeypatch, sheet_files, tmp_path):
+    from batch import convert_file
+    from import_export import SheetLoader
+    output_path = tmp_path / "sheet0.csv"
+    output_path.write_text("previous\n")
+
+    def fail(sheet, file_path):
+        with open(file_path, 'w') as file:
+            file.write("0,")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(SheetLoader, "write_csv", staticmethod(fail))
+    result = convert_file((sheet_files[0], str(output_path), "csv"))
+    assert result["error"] == "disk full"
+    assert output_path.read_text() == "previous\n"
+    assert sorted(os.listdir(tmp_path)) == ["sheet0.csv", "sheet0.json", "sheet1.json", "sheet2.json"]
+
+
+def test_startup_imports_no_lazy_module():
+    # The import time budgets are checked by running startup_benchmark.py, timings are too
+    # noisy for the test suite
+    from startup_benchmark import BUDGETS, LAZY_MODULES, import_times
+    for module in BUDGETS:
+        assert not set(LAZY_MODULES) & set(import_times(module, runs=1))
+
+
+def test_format_registry(sheet_files, tmp_path):
+    from import_export import SheetLoader
+    loaded = SheetLoader.load(sheet_files[0])
+    SheetLoader.export(loaded, str(tmp_path / "copy.yaml"))
+    assert SheetLoader.load(str(tmp_path / "copy.yaml")).get_value(1, 0) == 10
+    with pytest.raises(ValueError, match="Unsupported file format"):
+        SheetLoader.load(str(tmp_path / "sheet.pdf"))
+
+
+def test_viewport_size_does_not_grow_with_the_sheet():
+    from main import UserInterface
+    user_interface = UserInterface.__new__(UserInterface)  # no Tk window needed
+    user_interface.sheet = Sheet(50, 10)
+    small = user_interface.viewport_size(800, 500)
+    user_interface.sheet = Sheet(100000, 10)
+    assert user_interface.viewport_size(800, 500) == small
+    user_interface.sheet = Sheet(3, 2)
+    assert user_interface.viewport_size(800, 500) == (3, 2)
+
+
+def test_scroll_position():
+    from main import UserInterface
+    assert UserInterface.scroll_position(('scroll', '1', 'units'), 0, 15, 100000) == 1
+    assert UserInterface.scroll_position(('scroll', '-1', 'pages'), 10, 15, 100000) == 0
+    assert UserInterface.scroll_position(('moveto', '0.5'), 0, 15, 100000) == 50000
+    assert UserInterface.scroll_position(('moveto', '1.0'), 0, 15, 100000) == 100000 - 15
+
+
+class FakeEntry:
+    """stands in for tk.Entry (and the labels and scrollbars of the viewport), counts the calls
+    that make Tk redraw the widget"""
+    def __init__(self, text=''):
+        self.text = text
+        self.writes = 0
+
+    def get(self):
+        return self.text
+
+    def delete(self, first, last):
+        self.text = ''
+        self.writes += 1
+
+    def insert(self, index, text):
+        self.text = text
+
+    def config(self, **options):
+        self.writes += 1
+
+    def set(self, first, last):
+        self.writes += 1
+
+    def focus_set(self):
+        pass
+
+
+def test_entry_positions_follow_the_viewport(monkeypatch):
+    import main
+    test_sheet = Sheet(1000, 50)
+    test_sheet.set_value("moved", 501, 21)
+    user_interface = main.UserInterface.__new__(main.UserInterface)  # no Tk window needed
+    user_interface.__dict__.update(sheet=test_sheet, cell_colors={}, font_colors={}, entry_font_size=10,
+                                   entry_styles={}, top_row=0, left_col=0, view_rows=3, view_cols=2,
+                                   grid_frame=FakeEntry(), vertical_scrollbar=FakeEntry(),
+                                   horizontal_scrollbar=FakeEntry())
+    user_interface.entry_pool = [[FakeEntry(), FakeEntry()] for _ in range(3)]
+    user_interface.row_labels = [FakeEntry() for _ in range(3)]
+    user_interface.column_labels = [FakeEntry(), FakeEntry()]
+    user_interface.render_viewport()
+    focused = user_interface.entry_pool[1][1]
+    monkeypatch.setattr(main, 'window', type('FakeWindow', (), {'focus_get': staticmethod(lambda: focused)}))
+    assert user_interface.get_entry_position(focused) == (1, 1)
+    assert user_interface.get_selected_cell() == (1, 1)
+
+    # The same entry shows another cell once the viewport scrolled
+    user_interface.scroll_rows('moveto', '0.5')
+    user_interface.scroll_cols('scroll', '20', 'units')
+    assert (user_interface.top_row, user_interface.left_col) == (500, 20)
+    assert user_interface.get_entry_position(focused) == (501, 21)
+    assert user_interface.get_selected_cell() == (501, 21)
+    assert focused.text == "moved"
+    assert user_interface.get_entry_position(FakeEntry()) == (-1, -1)
+
+
+def test_font_size_changes_resize_the_viewport(monkeypatch):
+    import main
+
+    class MeasuredEntry(FakeEntry):
+        """an entry whose size grows with its font, like a Tk one"""
+        def __init__(self, master, font, **options):
+            super().__init__()
+            self.font_size = font[1]
+
+        def winfo_reqwidth(self):
+            return 8 * self.font_size
+
+        def winfo_reqheight(self):
+            return 2 * self.font_size
+
+        def destroy(self):
+            pass
+
+    monkeypatch.setattr(main.tk, 'Entry', MeasuredEntry)
+    monkeypatch.setattr(main, 'window', type('FakeWindow', (), {'focus_get': staticmethod(lambda: None)}))
+    user_interface = main.UserInterface.__new__(main.UserInterface)  # no Tk window needed
+    user_interface.__dict__.update(sheet=Sheet(1000, 50), entry_font_size=10, entry_cells={})
+    sizes = []
+
+    def build_viewport():
+        user_interface.measure_cell_size()
+        sizes.append(user_interface.viewport_size(800, 500))
+
+    user_interface.build_viewport = build_viewport
+    user_interface.measure_cell_size()
+    assert user_interface.cell_size == (84, 24)
+    user_interface.increase_font_size()
+    user_interface.decrease_font_size()
+    user_interface.decrease_font_size()
+    assert sizes == [(16, 7), (17, 8), (19, 9)]  # fewer cells fit with a bigger font
+
+
+def test_refresh_repaints_only_changed_cells(monkeypatch, chain_sheet):
+    import main
+    idle_callbacks = []
+    monkeypatch.setattr(main, 'window', type('FakeWindow', (), {'after_idle': staticmethod(idle_callbacks.append)}))
+    user_interface = main.UserInterface.__new__(main.UserInterface)  # no Tk window needed
+    user_interface.__dict__.update(sheet=chain_sheet, cell_colors={}, font_colors={}, entry_font_size=10,
+                                   entry_styles={}, pending_cells=set(), refresh_scheduled=False)
+    user_interface.entry_boxes = {(row, col): FakeEntry() for row in range(5) for col in range(3)}
+    user_interface.queue_refresh(user_interface.entry_boxes)
+    idle_callbacks.pop()()
+    assert user_interface.entry_boxes[(1, 1)].text == '30.0'
+
+    for entry in user_interface.entry_boxes.values():
+        entry.writes = 0
+    chain_sheet.set_value(10, 0, 0)
+    user_interface.queue_refresh([(0, 0)])
+    user_interface.show_recalculated(chain_sheet.recalculate([(0, 0)]))
+    user_interface.set_cell_color(4, 2, '#FF0000')
+    assert len(idle_callbacks) == 1  # a single flush for the whole event
+    idle_callbacks.pop()()
+    touched = {cell for cell, entry in user_interface.entry_boxes.items() if entry.writes}
+    assert touched == {(0, 0), (0, 1), (1, 1), (4, 2)}
+
+
+def test_recalculate_can_be_cancelled(chain_sheet):
+    assert chain_sheet.recalculate(cancelled=lambda: True) is None
+
+
+def test_snapshot_is_independent(chain_sheet):
+    snapshot = chain_sheet.snapshot()
+    chain_sheet.set_value(10, 0, 0)
+    chain_sheet.set_formula("=A1 * 3", 2, 2)
+    assert snapshot.get_value(0, 0) == 1
+    assert not snapshot.has_formula(2, 2)
+    assert (2, 2) not in snapshot.dependencies.dependents_of((0, 0))
+    snapshot.recalculate()
+    assert snapshot.get_value(0, 1) == 15
+    assert chain_sheet.get_value(0, 1) == 15  # the sheet itself was not recalculated
+
+
+def test_snapshot_shares_blocks_until_written(chain_sheet):
+    snapshot = chain_sheet.snapshot()
+    # Both sheets read the same block, the first write copies it
+    assert snapshot.cells.get_block(0, 2) is chain_sheet.cells.get_block(0, 2)
+    snapshot.set_value(5, 1, 2)
+    chain_sheet.set_value(7, 2, 2)
+    assert snapshot.cells.get_block(0, 2) is not chain_sheet.cells.get_block(0, 2)
+    assert (snapshot.get_value(1, 2), snapshot.get_value(2, 2)) == (5, '')
+    assert (chain_sheet.get_value(1, 2), chain_sheet.get_value(2, 2)) == ('', 7)
+    # The dependents of a cell are copied the first time either graph changes them
+    chain_sheet.set_formula("=B2 + A5", 3, 2)
+    snapshot.clear_formula(2, 1)
+    assert chain_sheet.dependencies.dependents_of((4, 0)) == {(0, 1), (2, 1), (3, 2)}
+    assert snapshot.dependencies.dependents_of((4, 0)) == {(0, 1)}
+    assert chain_sheet.dependencies.dependents_of((1, 1)) == {(3, 2)}
+    assert snapshot.dependencies.dependents_of((1, 1)) == set()
+
+
+def wait_for_result(worker):
+    import time
+    for _ in range(500):
+        result = worker.poll()
+        if result is not None:
+            return result
+        time.sleep(0.01)
+    raise AssertionError("the background recalculation did not finish")
+
+
+def test_background_recalculation(chain_sheet):
+    from recalc_worker import RecalcWorker
+    worker = RecalcWorker()
+    chain_sheet.set_value(10, 0, 0)
+    worker.submit(chain_sheet, [(0, 0)])
+    assert worker.stale
+    chain_sheet.set_value(20, 4, 0)
+    worker.submit(chain_sheet, [(4, 0)])  # supersedes the first pass and keeps its change
+    recalculated, values, error = wait_for_result(worker)
+    assert not worker.stale and error is None
+    assert sorted(recalculated) == [(0, 1), (1, 1), (2, 1)]
+    assert values[(0, 1)] == 39 and values[(2, 1)] == 21
+    assert chain_sheet.get_value(0, 1) == 15  # values are written by the caller
+
+
+def test_background_recalculation_uses_the_indexes(monkeypatch, aggregate_sheet):
+    from indexes import RangeMinMax, SummedAreaTable
+    from recalc_worker import RecalcWorker
+    aggregate_sheet.set_formula("=MAX(A1:B3000)", 0, 3)
+    aggregate_sheet.set_formula("=SUM(A1:B3000)", 1, 3)
+    aggregate_sheet.enable_sum_index(0, 0, 2999, 1)
+    aggregate_sheet.recalculate()  # builds the indexes of the sheet
+    queries = []  # (index, was stale)
+    for index_class in (RangeMinMax, SummedAreaTable):
+        def query(index, *bounds, original=index_class.query):
+            queries.append((index, index.stale))
+            return original(index, *bounds)
+        monkeypatch.setattr(index_class, "query", query)
+    aggregate_sheet.set_value(5000, 4, 0)
+    worker = RecalcWorker()
+    worker.submit(aggregate_sheet, [(4, 0)])
+    recalculated, values, error = wait_for_result(worker)
+    assert values[(0, 3)] == 5000
+    assert values[(1, 3)] == sum(brute_force_values(aggregate_sheet, 0, 0, 2999, 1))
+    # The pass read the indexes of its snapshot, the min/max trees without rebuilding them
+    assert {type(index) for index, _ in queries} == {RangeMinMax, SummedAreaTable}
+    assert all(index.cells is not aggregate_sheet.cells for index, _ in queries)
+    assert not any(stale for index, stale in queries if isinstance(index, RangeMinMax))
+    # The trees stay shared until a write, which goes to a copy
+    snapshot_index = next(index for index, _ in queries if isinstance(index, RangeMinMax) and index.col == 0)
+    assert snapshot_index.min_levels is aggregate_sheet.minmax_index[0].min_levels
+    aggregate_sheet.set_value(9000, 5, 0)
+    assert aggregate_sheet.minmax_index[0].query(0, 2999)[1] == 9000
+    assert snapshot_index.query(0, 2999)[1] == 5000
+
+
+def test_background_recalculation_reports_failures(monkeypatch, chain_sheet):
+    from recalc_worker import RecalcWorker
+    worker = RecalcWorker()
+
+    def fail(sheet, changed=None, cancelled=None):
+        raise RuntimeError("no memory left")
+
+    monkeypatch.setattr(Sheet, "recalculate", fail)
+    worker.submit(chain_sheet, [(0, 0)])
+    recalculated, values, error = wait_for_result(worker)
+    assert not worker.stale
+    assert (recalculated, values, str(error)) == ([], {}, "no memory left")
+    # The next pass covers the changes of the failed one
+    monkeypatch.undo()
+    chain_sheet.set_value(10, 0, 0)
+    worker.submit(chain_sheet, [(4, 1)])
+    recalculated, values, error = wait_for_result(worker)
+    assert error is None and values[(1, 1)] == 48
+
+
+def test_sliced_recalculation(chain_sheet):
+    from recalc_worker import SlicedRecalc
+    scheduled = []
+    done = []
+    slicer = SlicedRecalc(scheduled.append, budget=0, on_done=done.append)
+    chain_sheet.set_value(10, 0, 0)
+    slicer.submit(chain_sheet, [(0, 0)])
+    scheduled.pop()()  # a budget of 0 evaluates one formula per slice
+    assert slicer.stale and chain_sheet.get_value(0, 1) == 24
+    chain_sheet.set_value(20, 4, 0)
+    slicer.submit(chain_sheet, [(4, 0)])  # restarts the pass with both changes
+    while scheduled:
+        scheduled.pop()()
+    assert not slicer.stale
+    assert sorted(done[0]) == [(0, 1), (1, 1), (2, 1)]
+    assert chain_sheet.get_value(1, 1) == 78 and chain_sheet.get_value(2, 1) == 21
+    assert slicer.blocked_stats()['slices'] >= 4
+
+
+@pytest.mark.parametrize("chunk_size", [5, 1 << 16])
+def test_json_round_trip_keeps_formulas(monkeypatch, tmp_path, chain_sheet, chunk_size):
+    from import_export import SheetLoader
+    from json_stream import JsonStreamReader
+    monkeypatch.setattr(JsonStreamReader, 'CHUNK_SIZE', chunk_size)  # values cut across chunks
+    chain_sheet.set_value("text, with \"quotes\"", 9, 2)
+    chain_sheet.set_value(123456789.25, 8, 2)
+    path = str(tmp_path / "sheet.json")
+    SheetLoader.export_to_json(chain_sheet, path)
+    with open(path) as file:
+        assert len(file.readlines()) == 13  # header, 11 used cells, footer: empty cells are skipped
+    loaded = SheetLoader.load_from_json(path)
+    assert (loaded.rows, loaded.cols) == (10, 3)
+    assert loaded.get_formula(1, 1) == "=B1 * 2"
+    assert loaded.get_value(1, 1) == 30
+    assert loaded.get_value(9, 2) == "text, with \"quotes\""
+    assert loaded.get_value(8, 2) == 123456789.25
+    loaded.set_value(10, 0, 0)
+    loaded.recalculate([(0, 0)])
+    assert loaded.get_value(1, 1) == 48
+
+
+def test_json_loads_old_files(tmp_path):
+    import json
+    from import_export import SheetLoader
+    cells = [{"row": row, "col": col, "value": ""} for row in range(2) for col in range(2)]
+    cells[0]["value"] = 7
+    cells[3]["value"] = "=A1*2"
+    path = tmp_path / "old.json"
+    path.write_text(json.dumps({"rows": 2, "cols": 2, "cells": cells}, indent=4))
+    loaded = SheetLoader.load_from_json(str(path))
+    loaded.recalculate()
+    assert loaded.get_value(0, 0) == 7
+    assert loaded.get_value(1, 1) == 14
+
+
+def test_json_dense_file_round_trips_sparse(tmp_path):
+    from import_export import SheetLoader
+    cells = [{"row": row, "col": col, "value": ""} for row in range(100) for col in range(10)]
+    cells[57]["value"] = 3.5
+    path = tmp_path / "dense.json"
+    path.write_text(json.dumps({"rows": 100, "cols": 10, "cells": cells}))
+    loaded = SheetLoader.load_from_json(str(path))
+    assert loaded.cells.objects == {}
+    assert list(loaded.used_cells()) == [(5, 7, 3.5, None)]
+    SheetLoader.export_to_json(loaded, str(tmp_path / "sparse.json"))
+    with open(tmp_path / "sparse.json") as file:
+        assert json.load(file)["cells"] == [{"row": 5, "col": 7, "value": 3.5}]
+    # Writing '' or None empties a cell
+    loaded.set_value("", 5, 7)
+    loaded.set_value(None, 0, 0)
+    assert list(loaded.used_cells()) == []
+    assert loaded.get_value(5, 7) == ''
+
+
+@pytest.mark.parametrize("compression", [None, 'zlib', 'lzma'])
+def test_native_round_trip(tmp_path, chain_sheet, compression):
+    from import_export import SheetLoader
+    chain_sheet.set_value("text", 9, 2)
+    chain_sheet.set_value(2 ** 60, 8, 2)
+    chain_sheet.set_value(2.5, 7, 2)
+    path = str(tmp_path / "sheet.hsheet")
+    SheetLoader.export(chain_sheet, path, compression=compression)
+    loaded = SheetLoader.load(path)
+    assert [cell for cell in loaded.used_cells()] == [cell for cell in chain_sheet.used_cells()]
+    assert loaded.get_value(7, 2) == 2.5 and loaded.get_value(8, 2) == 2 ** 60
+    loaded.set_value(10, 0, 0)
+    loaded.recalculate([(0, 0)])
+    assert loaded.get_value(1, 1) == 48
+    assert chain_sheet.get_value(1, 1) == 30
+
+
+def test_native_blocks_are_mapped_until_written(tmp_path, chain_sheet):
+    from import_export import SheetLoader
+    path = str(tmp_path / "sheet.hsheet")
+    SheetLoader.export_to_native(chain_sheet, path)
+    loaded = SheetLoader.load_from_native(path)
+    numbers, tags = loaded.cells.get_block(0, 0)
+    assert isinstance(numbers, memoryview) and numbers.readonly
+    assert loaded.cells.range_sum(0, 0, 9, 0) == 15
+    loaded.set_value(7, 9, 0)
+    numbers, tags = loaded.cells.get_block(0, 0)
+    assert isinstance(tags, bytearray)
+    assert loaded.cells.range_sum(0, 0, 9, 0) == 22
+    assert loaded.get_value(0, 0) == 1
+
+
+def test_native_save_over_the_mapped_file(tmp_path, chain_sheet):
+    from import_export import SheetLoader
+    import native_format
+    path = str(tmp_path / "sheet.hsheet")
+    SheetLoader.export_to_native(chain_sheet, path)
+    loaded = SheetLoader.load_from_native(path)
+    loaded.set_value(42, 5, 2)  # column A stays mapped from the file that is replaced
+    assert isinstance(loaded.cells.get_block(0, 0)[0], memoryview)
+    SheetLoader.export_to_native(loaded, path)
+    assert loaded.cells.range_sum(0, 0, 9, 0) == 15
+    saved = native_format.read_sheet(path)
+    assert saved.get_value(5, 2) == 42 and saved.cells.range_sum(0, 0, 9, 0) == 15
+    assert os.listdir(tmp_path) == ["sheet.hsheet"]
+
+
+def test_native_rejects_other_files(sheet_files):
+    from import_export import SheetLoader
+    assert SheetLoader.load_from_native(sheet_files[0]) is None
+
+
+def test_load_from_csv(tmp_path):
+    from import_export import SheetLoader
+    lines = [f"{row},{row * 0.5},item {row}," for row in range(2500)]
+    lines[3] = "3,,x,=A1+A4"
+    lines[2000] = "-7,1e3,nan,=SUM(A1:A2500)"
+    path = tmp_path / "data.csv"
+    path.write_text("\n".join(lines) + "\n")
+    loaded = SheetLoader.load(str(path))
+    assert (loaded.rows, loaded.cols) == (2500, 4)
+    assert loaded.get_value(10, 0) == 10 and isinstance(loaded.cells.get_value(10, 0), int)
+    assert loaded.get_value(11, 1) == 5.5
+    assert loaded.get_value(3, 1) == '' and loaded.get_value(3, 2) == 'x'
+    assert loaded.get_value(2000, 0) == -7 and loaded.get_value(2000, 1) == 1000
+    assert loaded.get_value(2000, 2) == 'nan'
+    loaded.recalculate()
+    assert loaded.get_value(3, 3) == 3
+    assert loaded.get_value(2000, 3) == sum(range(2500)) - 2000 - 7
+
+
+def test_csv_round_trip(tmp_path, chain_sheet):
+    from import_export import SheetLoader
+    path = str(tmp_path / "sheet.csv")
+    SheetLoader.export(chain_sheet, path)
+    loaded = SheetLoader.load(path)
+    assert loaded.get_value(1, 1) == 30 and loaded.get_value(4, 0) == 5
+
+
+def test_excel_round_trip(tmp_path, chain_sheet):
+    pytest.importorskip("openpyxl")
+    from import_export import SheetLoader
+    chain_sheet.set_value("text", 6, 2)
+    path = str(tmp_path / "sheet.xlsx")
+    SheetLoader.export(chain_sheet, path)
+    loaded = SheetLoader.load(path)
+    assert (loaded.rows, loaded.cols) == (7, 3)
+    assert loaded.get_formula(0, 1) == "=SUM(A1:A5)"
+    assert loaded.get_value(6, 2) == "text" and loaded.get_value(4, 0) == 5
+    loaded.recalculate()
+    assert loaded.get_value(1, 1) == 30
+
+
+def test_excel_dates_load_as_text(tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    import datetime
+    from import_export import SheetLoader
+    workbook = openpyxl.Workbook()
+    workbook.active.append([datetime.datetime(2024, 1, 2), datetime.date(2024, 3, 4), datetime.time(5, 6), 7])
+    path = str(tmp_path / "dates.xlsx")
+    workbook.save(path)
+    loaded = SheetLoader.load(path)
+    assert [loaded.get_value(0, col) for col in range(4)] == \
+        ["2024-01-02T00:00:00", "2024-03-04T00:00:00", "05:06:00", 7]
+    # The loaded sheet can be saved again
+    for extension in ('.json', '.hsheet'):
+        SheetLoader.export(loaded, str(tmp_path / f"dates{extension}"))
+        assert SheetLoader.load(str(tmp_path / f"dates{extension}")).get_value(0, 0) == "2024-01-02T00:00:00"
+
+
+def test_iter_rows(chain_sheet):
+    rows = list(chain_sheet.iter_rows(formulas=True, empty=None))
+    assert len(rows) == 5
+    assert rows[0] == [1, "=SUM(A1:A5)", "=C2 + 1"]
+    assert rows[3] == [4, None, None]
+
+
+def test_pdf_color_ranges():
+    from pdf_export import sparse_colors, color_ranges
+    colors = {(row, col): 'red' for row in range(2, 5) for col in range(1, 4)}
+    colors[(3, 4)] = 'red'
+    colors[(0, 0)] = '#FFFFFF'
+    colors_by_row = sparse_colors(colors)
+    assert 0 not in colors_by_row
+    assert sorted(color_ranges(colors_by_row, 0, 10, 0, 8)) == [
+        ('red', 2, 1, 2, 3), ('red', 3, 1, 3, 4), ('red', 4, 1, 4, 3)]
+    del colors[(3, 4)]
+    assert color_ranges(sparse_colors(colors), 0, 10, 0, 8) == [('red', 2, 1, 4, 3)]
+    assert color_ranges(sparse_colors(colors), 3, 10, 2, 8) == [('red', 3, 2, 4, 3)]
+
+
+def test_pdf_export_pages(tmp_path):
+    pytest.importorskip("reportlab")
+    from import_export import SheetLoader
+    import pdf_export
+    test_sheet = Sheet(100000, 20)
+    for row in range(100):
+        test_sheet.set_value(row, row, 0)
+    test_sheet.set_value("wide", 0, 9)
+    path = tmp_path / "sheet.pdf"
+    SheetLoader.export_to_pdf(test_sheet, str(path), {(5, 1): '#FF0000', (6, 1): '#FF0000'})
+    pages = path.read_bytes().count(b"/Type /Page\n")
+    # 100 used rows in pages of ROWS_PER_PAGE, 10 used columns in pages of COLS_PER_PAGE
+    assert pages == -(-100 // pdf_export.ROWS_PER_PAGE) * -(-10 // pdf_export.COLS_PER_PAGE)
+
+
+def test_export_all(tmp_path, chain_sheet):
+    pytest.importorskip("openpyxl")
+    pytest.importorskip("reportlab")
+    from import_export import SheetLoader
+    paths = [str(tmp_path / f"sheet{extension}") for extension in ('.json', '.csv', '.xlsx', '.pdf')]
+    futures = SheetLoader.export_all(chain_sheet, paths, cell_colors={(0, 0): '#FF0000'})
+    chain_sheet.set_value(100, 0, 0)  # the exports work on the snapshot taken by export_all
+    assert sorted(future.result(timeout=60) for future in futures.values()) == sorted(paths)
+    assert SheetLoader.load(paths[0]).get_value(0, 0) == 1
+    assert SheetLoader.load(paths[1]).get_value(1, 1) == 30
+    with pytest.raises(ValueError):
+        SheetLoader.export_all(chain_sheet, [str(tmp_path / "sheet.txt")])
+
+
+def test_export_snapshot_keeps_the_previous_file(monkeypatch, tmp_path, chain_sheet):
+    from import_export import SheetLoader, export_snapshot
+    path = tmp_path / "sheet.csv"
+    path.write_text("previous\n")
+    def fail(sheet, file_path):
+        raise OSError("no space")
+
+    monkeypatch.setattr(SheetLoader, "write_csv", staticmethod(fail))
+    with pytest.raises(OSError, match="no space"):
+        export_snapshot((chain_sheet.rows, chain_sheet.cols, chain_sheet.cells.copy(), str(path), {}))
+    assert path.read_text() == "previous\n"
+    monkeypatch.undo()
+    assert export_snapshot((chain_sheet.rows, chain_sheet.cols, chain_sheet.cells.copy(), str(path), {})) == str(path)
+    assert path.read_text().splitlines()[1] == "2,30.0,"
+    assert os.listdir(tmp_path) == ["sheet.csv"]
+
+
+def test_benchmark_suite(tmp_path):
+    import benchmark
+    results = benchmark.run_benchmarks(['1k'], ['heavy'], ['.csv', '.hsheet'], repeat=1)
+    for name in ('construct', 'parse', 'recalc_full', 'recalc_incremental', 'export.csv', 'load.hsheet'):
+        assert results[f"1k/heavy/{name}"] >= 0
+    output = tmp_path / "baseline.json"
+    assert benchmark.main(['--sizes', '1k', '--profiles', 'light', '--formats', 'none', '--repeat', '1',
+                           '--json', str(output)]) == 0
+    assert "1k/light/recalc_full" in json.loads(output.read_text())['results']
+
+
+def test_benchmark_compare():
+    from benchmark import compare
+    baseline = {'a': 1.0, 'b': 1.0, 'c': 0.0001, 'gone': 1.0}
+    results = {'a': 1.1, 'b': 1.5, 'c': 0.0005, 'new': 9.0}
+    # c is 5x slower but by less than MIN_DELTA, new has no baseline
+    assert compare(results, baseline) == [('b', 1.0, 1.5)]
+    assert compare(results, baseline, tolerance=0.05) == [('a', 1.0, 1.1), ('b', 1.0, 1.5)]
+
+
+def test_profiling(chain_sheet, tmp_path):
+    import profiling
+    chain_sheet.recalculate()  # nothing is recorded while profiling is off
+    profiler = FormulaParser.start_profiling()
+    try:
+        chain_sheet.recalculate()
+        chain_sheet.set_value(10, 0, 0)
+        chain_sheet.recalculate([(0, 0)])
+        FormulaParser.evaluate_formula("AVERAGE(A1:A5, 2)", chain_sheet)
+        steps = chain_sheet.recalculate_steps()
+        next(steps)
+        steps.close()  # a cancelled pass
+    finally:
+        assert FormulaParser.stop_profiling() is profiler
+    chain_sheet.recalculate()
+    stats = profiler.stats()
+    assert stats['passes']['count'] == 3 and stats['passes']['cancelled'] == 1
+    evaluations = {(entry['cell'], entry['formula']): entry['evaluations'] for entry in stats['formulas']}
+    assert evaluations[('B1', '=SUM(A1:A5)')] == 3
+    assert evaluations[('B2', '=B1 * 2')] == 2
+    assert evaluations[(None, '=AVERAGE(A1:A5, 2)')] == 1
+    assert stats['ranges']['SUM'] == {'calls': 3, 'cells': 15, 'indexed': 0}
+    assert stats['ranges']['AVERAGE']['cells'] == 5
+    assert 0 <= stats['cache']['hit_rate'] <= 1
+    profiler.dump(str(tmp_path / "profile.json"))
+    assert json.loads((tmp_path / "profile.json").read_text())['passes']['count'] == 3
+    assert "B1  =SUM(A1:A5)  3 evaluations" in profiler.report()
+    profiler.reset()
+    assert profiler.stats()['formulas'] == [] and profiling.active is None
+
+
+def test_profile_dialog_report():
+    import main
+    user_interface = main.UserInterface.__new__(main.UserInterface)  # no Tk window needed
+    user_interface.__dict__.update(sheet=Sheet(5, 5), profiler=None, profile_text=FakeEntry(),
+                                   profile_toggle=FakeEntry())
+    user_interface.refresh_profile()
+    assert user_interface.profile_text.text.startswith("Profiling is off")
+    user_interface.toggle_profiling()
+    try:
+        user_interface.sheet.set_formula("=SUM(A1:A3)", 0, 1)
+        user_interface.sheet.recalculate()
+        user_interface.refresh_profile()
+        assert user_interface.profile_text.text.startswith("Recording.")
+        assert "B1  =SUM(A1:A3)  1 evaluations" in user_interface.profile_text.text
+    finally:
+        user_interface.toggle_profiling()
+    assert user_interface.profile_text.text.startswith("Stopped.")
+
+
+def test_values_are_typed_when_written():
+    test_sheet = Sheet(10, 3)
+    for row, text in enumerate(["-12", "1.5e3", " 2.50 ", "true", "FALSE", "#DIV/0!", "12abc", "nan", "1_000"]):
+        test_sheet.set_value(text, row, 0)
+    values = [test_sheet.get_value(row, 0) for row in range(9)]
+    assert values == [-12, 1500, 2.5, True, False, "#DIV/0!", "12abc", "nan", "1_000"]
+    assert [type(value) for value in values[:5]] == [int, int, float, bool, bool]
+    tags = [test_sheet.cells.get_block(row, 0)[1][row] for row in range(9)]
+    assert tags[3:6] == [CellStore.BOOL, CellStore.BOOL, CellStore.ERROR]
+    assert test_sheet.cells.number_at(0, 0) == -12.0
+    assert test_sheet.cells.number_at(3, 0) is None and test_sheet.cells.number_at(9, 0) is None
+    # booleans and errors are not numbers in ranges, an error cell fails the formulas reading it
+    assert test_sheet.cells.range_sum(0, 0, 9, 0) == -12 + 1500 + 2.5
+    assert test_sheet.cells.range_count(0, 0, 9, 0) == 3
+    assert compile_formula("A4 + A1").evaluate(test_sheet) == -11
+    with pytest.raises(FormulaDivisionError):
+        compile_formula("A6 + 1").evaluate(test_sheet)
+    test_sheet.set_value("text again", 5, 0)
+    assert test_sheet.cells.objects[(5, 0)] == "text again"
+    test_sheet.set_value(7, 5, 0)
+    assert (5, 0) not in test_sheet.cells.objects
+
+
+def test_csv_import_types_text(tmp_path):
+    from csv_import import read_csv
+    path = tmp_path / "typed.csv"
+    path.write_text("TRUE,-1e2\nname,#REF!\n")
+    loaded = read_csv(str(path))
+    assert [loaded.get_value(0, 0), loaded.get_value(0, 1), loaded.get_value(1, 0), loaded.get_value(1, 1)] == \
+        [True, -100, "name", "#REF!"]
+    assert loaded.cells.get_block(1, 1)[1][1] == CellStore.ERROR
+    # Digits with underscores are text, like when they are typed in a cell
+    path.write_text("1,1_000\n2_5,2\n3,x\n")
+    loaded = read_csv(str(path))
+    assert [loaded.get_value(row, 0) for row in range(3)] == [1, "2_5", 3]
+    assert [loaded.get_value(row, 1) for row in range(3)] == ["1_000", 2, "x"]
+    test_sheet = Sheet(1, 1)
+    test_sheet.set_value("1_000", 0, 0)
+    assert test_sheet.get_value(0, 0) == "1_000"
+    # Integral numbers are ints only while a double holds them exactly, like in typed_value
+    path.write_text("1e20,1e20\n3,x\n")
+    loaded = read_csv(str(path))
+    assert [loaded.cells.get_block(0, col)[1][0] for col in range(2)] == [CellStore.FLOAT, CellStore.FLOAT]
+    assert loaded.cells.get_block(1, 0)[1][1] == CellStore.INT
+    path.write_text("")
+    loaded = read_csv(str(path))
+    assert (loaded.rows, loaded.cols) == (1, 1) and loaded.get_value(0, 0) == ''
+
+
+def test_display_text_formats_typed_values():
+    from main import UserInterface
+    user_interface = UserInterface.__new__(UserInterface)  # no Tk window needed
+    user_interface.sheet = Sheet(3, 3)
+    user_interface.sheet.set_value("true", 0, 0)
+    user_interface.sheet.set_value("-3", 1, 0)
+    assert user_interface.display_text(0, 0) == "TRUE"
+    assert user_interface.display_text(1, 0) == "-3"
@@ -0,0 +1,150 @@
+import queue
+import threading
+import time
+
+
+class RecalcWorker:
+    """Recalculates sheets in a background thread.
+
+    submit() queues a snapshot of the sheet, so the GUI keeps editing the sheet while
+    the worker recalculates the copy. A newer submit supersedes the pass that is running:
+    the pass stops at its next formula and the worker moves on to the newest snapshot,
+    which also covers the changes of the passes it replaced. The results are read with
+    poll() by the thread that owns the sheet, and only the result of the newest pass is
+    returned, since the sheet was not edited after its snapshot was taken. A pass that fails
+    is returned too, with its error, so the caller stops waiting for it.
+    """
+
+    def __init__(self):
+        self.generation = 0  # number of the newest pass
+        self.applied = 0  # number of the last pass returned by poll()
+        self.unapplied = set()  # cells changed since the last returned pass, None for every cell
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def stale(self):
+        """True while the values of the sheet wait for a pass"""
+        return self.applied != self.generation
+
+    def submit(self, sheet, changed=None):
+        """recalculate a snapshot of the sheet in the background, changed as in Sheet.recalculate"""
+        if changed is None or self.unapplied is None:
+            self.unapplied = None
+        else:
+            self.unapplied.update(changed)
+        self.generation += 1
+        changes = None if self.unapplied is None else list(self.unapplied)
+        self.jobs.put((self.generation, sheet.snapshot(), changes))
+
+    def run(self):
+        while True:
+            generation, snapshot, changed = self.jobs.get()
+            if generation != self.generation:
+                continue  # a newer snapshot is already queued
+            try:
+                recalculated = snapshot.recalculate(changed, lambda: generation != self.generation)
+            except Exception as e:
+                self.results.put((generation, [], {}, e))
+                continue
+            if recalculated is None:
+                continue
+            values = {(row, col): snapshot.cells.get_value(row, col, None) for row, col in recalculated}
+            self.results.put((generation, recalculated, values, None))
+
+    def poll(self):
+        """return (recalculated cells, {cell: value}, error) of the newest pass once it is done, None
+        before. the caller writes the values to its sheet. error is the exception a failed pass
+        raised (it has no values), None otherwise"""
+        result = None
+        while True:
+            try:
+                generation, *outcome = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.generation:
+                result = tuple(outcome)
+        if result is not None:
+            self.applied = self.generation
+            if result[2] is None:
+                self.unapplied = set()
+            # else the changes of the failed pass are kept for the next one
+        return result
+
+
+class SlicedRecalc:
+    """Recalculates a sheet on the thread that owns it, in slices of at most budget seconds.
+
+    Every slice runs as its own event of the caller's event loop (schedule(callback) must run
+    the callback on a later turn), so input is handled between two slices. A submit during a
+    pass restarts it with the changes of both passes. The time every slice kept the thread
+    busy is recorded, see blocked_stats().
+    """
+
+    def __init__(self, schedule, budget=0.005, on_slice=None, on_done=None):
+        self.schedule = schedule
+        self.budget = budget  # seconds per slice
+        self.on_slice = on_slice  # called with the cells recalculated by every slice
+        self.on_done = on_done  # called with every cell recalculated by the pass
+        self.steps = None  # generator of the running pass
+        self.changed = set()  # changes of the running pass, None for every cell
+        self.recalculated = []
+        self.scheduled = False
+        self.slices = 0
+        self.blocked_total = 0.0
+        self.blocked_max = 0.0
+
+    @property
+    def stale(self):
+        """True while a pass is running"""
+        return self.steps is not None
+
+    def submit(self, sheet, changed=None):
+        """start a pass (changed as in Sheet.recalculate), restarting the running one"""
+        if self.steps is None:
+            self.changed = set()
+        if changed is None or self.changed is None:
+            self.changed = None
+        else:
+            self.changed.update(changed)
+        self.steps = sheet.recalculate_steps(None if self.changed is None else list(self.changed))
+        self.recalculated = []
+        if not self.scheduled:
+            self.scheduled = True
+            self.schedule(self.run_slice)
+
+    def run_slice(self):
+        """evaluate formulas until the budget is spent, then give the event loop back"""
+        self.scheduled = False
+        if self.steps is None:
+            return
+        started = time.perf_counter()
+        deadline = started + self.budget
+        cells = []
+        for cell in self.steps:
+            cells.append(cell)
+            if time.perf_counter() >= deadline:
+                break
+        else:
+            self.steps = None
+        self.recalculated.extend(cells)
+        self.record_blocked(time.perf_counter() - started)
+        if self.on_slice is not None:
+            self.on_slice(cells)
+        if self.steps is not None:
+            self.scheduled = True
+            self.schedule(self.run_slice)
+        elif self.on_done is not None:
+            self.on_done(self.recalculated)
+
+    def record_blocked(self, seconds):
+        self.slices += 1
+        self.blocked_total += seconds
+        self.blocked_max = max(self.blocked_max, seconds)
+
+    def blocked_stats(self):
+        """how long the slices kept the thread busy: {'slices', 'total', 'max', 'mean'} in seconds"""
+        mean = self.blocked_total / self.slices if self.slices else 0.0
+        return {'slices': self.slices, 'total': self.blocked_total, 'max': self.blocked_max, 'mean': mean}
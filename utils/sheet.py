@@ -1,7 +1,14 @@
-import string
+from storage import CellStore
+from addresses import column_label, split_cell_name
+from dependencies import DependencyGraph
+from indexes import SummedAreaTable, RangeMinMax
+from formula_compiler import compile_formula, FormulaError, FormulaCycleError
+import profiling
+
 class Cell:
     EMPTY_CELL = '_'
     EMPTY = ''
+    CYCLE = FormulaCycleError.error_value  # value of formulas that depend on themselves
 
     def __init__(self, value=None, formula=None):
         self.value = value
@@ -16,36 +23,34 @@ class Cell:
     def cell_loc(self, name):
         """gets coordinate for a cell as text and returns a tuple of the cell location"""
         try:
-            first_letter = name[0].upper()
-            if not ('A' <= first_letter <= 'Z'):
-                raise ValueError("Error: First part of the cell name must be a letter.")
-
-            column_guess_num = ord(first_letter) - ord('A') + 1
-            row_guess = int(name[1:])
-            user_guess = (row_guess - 1, column_guess_num - 1)
-            return user_guess
-
-        except ValueError:
-            print("Error: Second part of the cell name must be a number.")
+            return split_cell_name(name)
+        except ValueError as e:
+            print(e)
             return False
 
 class Sheet:
+    MAX_ROWS = 1048576
+    MAX_COLS = 16384
+
     def __init__(self, rows, cols):
+        if rows < 0 or rows > self.MAX_ROWS or cols < 0 or cols > self.MAX_COLS:
+            raise IndexError("Sheet dimensions are out of range")
         self.rows = rows
         self.cols = cols
-        self.cells_dict = {}
-        self.formula_cells = {}  # Dictionary to store cells with formulas
-
-        # Initialize cells_dict with empty values for all cells
-        for row in range(rows):
-            for col in range(cols):
-                cell_address = self.get_cell_address(row, col)
-                self.cells_dict[cell_address] = {'value': '', 'formula': None}
+        # Sparse typed column blocks for numbers, sparse maps for text and formulas (see CellStore)
+        self.cells = CellStore(rows, cols)
+        # Which formula cells read which cells, used to recalculate only what an edit touches
+        self.dependencies = DependencyGraph(cols)
+        # Optional summed-area table answering rectangle SUM/AVERAGE in constant time
+        self.sum_index = None
+        # Range min/max trees, only for the columns read by MAX/MIN formulas
+        self.minmax_index = {}  # col -> RangeMinMax
+        self.minmax_users = {}  # col -> number of MAX/MIN ranges reading the column
 
     def __str__(self):
         result = ""
         # Generating column labels (A, B, C, ...)
-        column_labels = [string.ascii_uppercase[i] for i in range(self.cols)]
+        column_labels = [column_label(i) for i in range(self.cols)]
 
         # Printing column labels as the first row
         result += "   "  # Padding for row index column
@@ -57,40 +62,42 @@ class Sheet:
         for row_index in range(self.rows):
             result += str(row_index + 1).ljust(3)  # Print row index at the beginning of each row
             for col_index in range(self.cols):
-                cell_address = self.get_cell_address(row_index, col_index)
-                value = self.cells_dict.get(cell_address, {}).get('value', Cell.EMPTY_CELL)
+                value = self.cells.get_value(row_index, col_index)
                 result += str(value).ljust(8)  # Adjust width to align cells properly
             result += "\n"
 
         return result.rstrip("\n")  # Remove trailing newline before returning
 
     def get_cell_address(self, row, col):
-        return f"{string.ascii_uppercase[col]}{row + 1}"
+        return f"{column_label(col)}{row + 1}"
 
     def set_value(self, value, row, col):
-        """insert a value to a cell"""
+        """insert a value to a cell. text is typed once, here: numbers ('-1.5e3'), TRUE/FALSE and
+        error values ('#DIV/0!') are stored as such, see storage.typed_value. '' and None empty the cell"""
         if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
             raise IndexError("Row or column index is out of range")
 
-        cell_address = self.get_cell_address(row, col)
-        self.cells_dict[cell_address]['value'] = value
-        # Only update formula if the cell doesn't already have a formula
-        if self.cells_dict[cell_address]['formula'] is None:
-            self.cells_dict[cell_address]['formula'] = str(value)
+        if value is None or value == Cell.EMPTY:
+            self.cells.clear_value(row, col)
+        else:
+            self.cells.set_value(row, col, value)
+        if self.sum_index is not None:
+            self.sum_index.touch(row, col)
+        if col in self.minmax_index:
+            self.minmax_index[col].update(row)
 
     def get_value(self, row, col):
         """return the stored value of a cell"""
         if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
             raise IndexError("Error! Row or column index is out of range")
 
-        cell_address = self.get_cell_address(row, col)
-        value = self.cells_dict.get(cell_address, {}).get('value', Cell.EMPTY_CELL)
-        if isinstance(value, str) and value.replace('.', '', 1).isdigit():
-            try:
-                value = float(value)
-            except ValueError:
-                value = int(value)
-        elif value == Cell.EMPTY_CELL:
+        cells = self.cells
+        if cells.is_empty(row, col):
+            # A formula cell that was not calculated yet has no value
+            return None if cells.get_formula(row, col) is not None else Cell.EMPTY
+        # Values were typed when they were written (see CellStore.set_value), nothing is parsed here
+        value = cells.get_value(row, col)
+        if value == Cell.EMPTY_CELL:
             raise ValueError("Error! Cell is empty")
 
         return value
@@ -100,38 +107,207 @@ class Sheet:
         if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
             raise IndexError("Row or column index is out of range")
 
-        cell_address = self.get_cell_address(row, col)
-        self.cells_dict[cell_address] = {'value': None, 'formula': formula}
-        self.formula_cells[cell_address] = formula
+        self.cells.clear_value(row, col)
+        if self.sum_index is not None:
+            self.sum_index.touch(row, col)
+        if col in self.minmax_index:
+            self.minmax_index[col].update(row)
+        self.register_formula(formula, row, col)
+
+    def register_formula(self, formula, row, col):
+        """store and compile the formula of a cell, keeping its value (used when loading a formula
+        together with its last calculated value)"""
+        self.cells.set_formula(row, col, formula)
+        try:
+            compiled = compile_formula(formula)
+        except FormulaError as e:
+            # Formulas the engine can't run have no precedents. They show their error ('#NAME?'),
+            # except clr, the color formula of the GUI
+            compiled = None
+            if not formula.lstrip('=').strip().startswith('clr'):
+                self.set_value(e.error_value, row, col)
+        self.track_minmax_columns(self.dependencies.formulas.get((row, col)), -1)
+        self.track_minmax_columns(compiled, 1)
+        self.dependencies.set_formula((row, col), compiled)
+
+    def used_cells(self):
+        """yield (row, col, value, formula) for every cell holding a value or a formula. formula is
+        None for plain values, value is None for formulas that were not calculated yet"""
+        for row, col in self.cells.used_cells():
+            yield row, col, self.cells.get_value(row, col, None), self.cells.get_formula(row, col)
+
+    def iter_rows(self, formulas=False, empty=''):
+        """yield the rows of the sheet as lists of values, up to the last used row and column.
+        empty cells are given as empty, formula cells as their formula with formulas=True"""
+        cells = self.cells
+        rows, cols = cells.used_bounds()
+        for row in range(rows):
+            values = [cells.get_value(row, col, empty) for col in range(cols)]
+            if formulas and cells.formulas:
+                for col in range(cols):
+                    formula = cells.formulas.get((row, col))
+                    if formula is not None:
+                        values[col] = formula
+            yield values
+
+    def resize(self, rows, cols):
+        """change the dimensions of the sheet, cells outside of them must be empty"""
+        if rows < 0 or rows > self.MAX_ROWS or cols < 0 or cols > self.MAX_COLS:
+            raise IndexError("Sheet dimensions are out of range")
+        # The range edges only cover the columns of the sheet, the formulas whose ranges
+        # reach past the smaller width are registered again with the new one
+        widest = min(cols, self.cols) - 1
+        formulas = [(cell, compiled) for cell, compiled in self.dependencies.formulas.items()
+                    if compiled is not None and any(cell_range[3] > widest for cell_range in compiled.ranges)]
+        for cell, compiled in formulas:
+            self.track_minmax_columns(compiled, -1)
+            self.dependencies.remove_formula(cell)
+        self.rows = self.cells.rows = rows
+        self.cols = self.cells.cols = self.dependencies.cols = cols
+        for cell, compiled in formulas:
+            self.track_minmax_columns(compiled, 1)
+            self.dependencies.set_formula(cell, compiled)
+
+    def has_formula(self, row, col):
+        """return True if the cell holds a formula (and not just a value)"""
+        return (row, col) in self.cells.formulas
+
+    def clear_formula(self, row, col):
+        """remove the formula of a cell, keeping its current value"""
+        self.cells.formulas.pop((row, col), None)
+        self.track_minmax_columns(self.dependencies.formulas.get((row, col)), -1)
+        self.dependencies.remove_formula((row, col))
+
+    def track_minmax_columns(self, compiled, delta):
+        """count the MAX/MIN ranges of a formula that is added (delta=1) or removed (delta=-1),
+        creating or dropping the range min/max index of their columns"""
+        if compiled is None:
+            return
+        for name, (start_row, start_col, end_row, end_col) in compiled.calls:
+            if name not in ('MAX', 'MIN'):
+                continue
+            for col in self.dependencies.range_columns(start_col, end_col):
+                users = self.minmax_users.get(col, 0) + delta
+                if users > 0:
+                    self.minmax_users[col] = users
+                    if col not in self.minmax_index:
+                        self.minmax_index[col] = RangeMinMax(self.cells, col)
+                else:
+                    self.minmax_users.pop(col, None)
+                    self.minmax_index.pop(col, None)
+
+    def enable_sum_index(self, start_row=None, start_col=None, end_row=None, end_col=None):
+        """index a rectangle of the sheet with a summed-area table. Without bounds the index covers
+        every range read by the formulas of the sheet. returns the index (None if there is nothing to index)"""
+        if start_row is None:
+            ranges = [cell_range for compiled in self.dependencies.formulas.values() if compiled is not None
+                      for cell_range in compiled.ranges]
+            if not ranges:
+                self.sum_index = None
+                return None
+            start_row = min(cell_range[0] for cell_range in ranges)
+            start_col = min(cell_range[1] for cell_range in ranges)
+            end_row = min(max(cell_range[2] for cell_range in ranges), self.rows - 1)
+            end_col = min(max(cell_range[3] for cell_range in ranges), self.cols - 1)
+        self.sum_index = SummedAreaTable(self.cells, start_row, start_col, end_row, end_col)
+        return self.sum_index
+
+    def disable_sum_index(self):
+        self.sum_index = None
+
+    def snapshot(self):
+        """return a copy of the sheet that another thread can recalculate while this one is edited.
+        the copy keeps the indexes, sharing their tables with the sheet until either one changes them"""
+        copy = Sheet(self.rows, self.cols)
+        copy.cells = self.cells.copy()
+        copy.dependencies = self.dependencies.copy()
+        if self.sum_index is not None:
+            copy.sum_index = self.sum_index.copy(copy.cells)
+        copy.minmax_index = {col: index.copy(copy.cells) for col, index in self.minmax_index.items()}
+        copy.minmax_users = dict(self.minmax_users)
+        return copy
+
+    def recalculate(self, changed=None, cancelled=None):
+        """recalculate the formulas that depend on the changed (row, col) cells, or every
+        formula when changed is None, in dependency order. Formulas on a cycle get the
+        value Cell.CYCLE and formulas that fail get their error value ('#DIV/0!', '#REF!', ...).
+        cancelled is called after every formula, the pass stops when it returns True.
+        returns the list of recalculated cells, None if the pass was cancelled"""
+        recalculated = []
+        for cell in self.recalculate_steps(changed):
+            recalculated.append(cell)
+            if cancelled is not None and cancelled():
+                return None
+        return recalculated
+
+    def recalculate_steps(self, changed=None):
+        """the steps of recalculate: a generator that evaluates one formula per next() and yields
+        its cell, so a pass can be spread over many calls. the sheet must not be edited between
+        two steps, start a new pass instead"""
+        if profiling.active is not None:
+            yield from profiling.active.profile_pass(self, changed)
+        else:
+            yield from self.evaluate_steps(*self.recalc_order(changed))
+
+    def recalc_order(self, changed=None):
+        """return (order, cyclic): the formula cells a pass recalculates, in dependency order,
+        and the formula cells on a cycle"""
+        formulas = self.dependencies.formulas
+        if changed is None:
+            dirty = list(formulas)
+        else:
+            # Changed formula cells are recalculated too, together with everything that reads them
+            dirty = [cell for cell in changed if cell in formulas] + self.dependencies.dirty_cells(changed)
+        return self.dependencies.recalc_order(dirty)
+
+    def evaluate_steps(self, order, cyclic):
+        """evaluate the formulas of recalc_order one per next(), yielding their cells"""
+        formulas = self.dependencies.formulas
+        # A single pass in dependency order, every formula reads up to date values
+        for row, col in order:
+            compiled = formulas[(row, col)]
+            if compiled is None:
+                continue
+            try:
+                result = compiled.evaluate(self)
+            except FormulaError as e:
+                # Errors are kept in the cell as values like '#DIV/0!', nothing is shown from here
+                result = e.error_value
+            self.set_value(result, row, col)
+            yield row, col
+        for row, col in cyclic:
+            self.set_value(Cell.CYCLE, row, col)
+            yield row, col
 
     def get_formula(self, row, col):
         """return the formula of a cell"""
         try:
             if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
                 raise IndexError("Error! Row or column index is out of range")
-            cell_address = self.get_cell_address(row, col)
-            return self.cells_dict[cell_address]['formula']
+            formula = self.cells.get_formula(row, col)
+            if formula is None and not self.cells.is_empty(row, col):
+                # A plain value acts as its own formula
+                formula = str(self.cells.get_value(row, col))
+            return formula
         except IndexError as e:
             print(e)  # Print an error message
             return
 
     def get_formula_cells(self):
-        return self.formula_cells
+        """return a dictionary of cell address -> formula for every formula cell"""
+        return {self.get_cell_address(row, col): formula
+                for (row, col), formula in self.cells.formulas.items()}
 
     def insert_row(self):
         """insert a row to the sheet"""
         if self.rows == self.get_max_rows():
             raise IndexError("Sheet is already full. Cannot insert a new row.")
-        # Insert empty cells in the new row
-        new_row_index = self.rows
-        for col in range(self.cols):
-            cell_address = self.get_cell_address(new_row_index, col)
-            self.cells_dict[cell_address] = {'value': '', 'formula': None}
+        self.cells.insert_row()
         self.rows += 1
 
     def get_max_rows(self):
         """Returns the maximum number of rows supported by the sheet."""
-        return 50  # Example limit
+        return self.MAX_ROWS
 
     def print_sheet(self):
         """Print the sheet with values and formulas."""
@@ -139,4 +315,8 @@ class Sheet:
             for col_index in range(self.cols):
                 value = self.get_value(row_index, col_index)
                 formula = self.get_formula(row_index, col_index)
-                print(f"Cell [{row_index}, {col_index}]: Value = {value}, Formula = {formula}")
\ No newline at end of file
+                print(f"Cell [{row_index}, {col_index}]: Value = {value}, Formula = {formula}")
+
+# Registers SUM, AVERAGE, MAX and MIN in the formula compiler, so sheets loaded without the GUI
+# (batch workers, file loaders) can compile them. Imported last: calculates imports this module
+import calculates
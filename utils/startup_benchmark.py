@@ -0,0 +1,75 @@
+"""Cold start benchmark based on python -X importtime.
+
+Every module in BUDGETS is imported in a fresh interpreter and its cumulative import
+time is compared with its budget. Modules in LAZY_MODULES must not be imported at
+startup at all, they are loaded the first time a format (or a range) needs them.
+Run it with 'python startup_benchmark.py' from the utils folder, the exit code is 1
+when a budget is exceeded.
+"""
+import os
+import subprocess
+import sys
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Cumulative import time budget of each module, in seconds
+BUDGETS = {
+    'sheet': 0.08,
+    'calculates': 0.1,
+    'import_export': 0.12,
+    'batch': 0.2,
+}
+
+LAZY_MODULES = ('yaml', 'openpyxl', 'reportlab', 'numpy')
+
+
+def import_times(module, runs=3):
+    """import a module in fresh interpreters and return {imported module: cumulative seconds}
+    of the fastest run (the first run also pays for writing the .pyc files)"""
+    best = None
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                 cwd=UTILS_DIR, capture_output=True, text=True, check=True)
+        times = {}
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative) / 1e6
+        if best is None or times[module] < best[module]:
+            best = times
+    return best
+
+
+def startup_times(budgets=None):
+    """return {module: import_times(module)} for every module of the budgets"""
+    return {module: import_times(module) for module in budgets or BUDGETS}
+
+
+def check_startup(budgets=None, times=None):
+    """return a list of problems: modules over their budget and lazy modules imported at startup.
+    times are the startup_times() of the budgets, measured here when not given"""
+    budgets = budgets or BUDGETS
+    times = times or startup_times(budgets)
+    problems = []
+    for module, budget in budgets.items():
+        if times[module][module] > budget:
+            problems.append(f"importing {module} took {times[module][module]:.3f}s, the budget is {budget:.3f}s")
+        for lazy_module in LAZY_MODULES:
+            if lazy_module in times[module]:
+                problems.append(f"importing {module} also imports {lazy_module} at startup")
+    return problems
+
+
+def main():
+    times = startup_times()
+    for module, budget in BUDGETS.items():
+        print(f"{module}: {times[module][module]:.3f}s (budget {budget:.3f}s)")
+    problems = check_startup(times=times)
+    for problem in problems:
+        print("FAILED:", problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
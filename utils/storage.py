@@ -0,0 +1,323 @@
+import math
+from array import array
+from itertools import compress
+from formula_compiler import ERRORS
+
+np = None  # numpy, set by load_numpy() the first time a range is read. stays None without numpy
+numpy_checked = False
+
+
+def load_numpy():
+    """import numpy the first time a range is read, so starting the program doesn't pay for it.
+    range functions fall back to itertools when numpy is not installed"""
+    global np, numpy_checked
+    if not numpy_checked:
+        numpy_checked = True
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+    return np
+
+
+def is_array(chunk):
+    return np is not None and isinstance(chunk, np.ndarray)
+
+
+NUMBER_START = frozenset('+-.0123456789')
+BOOLEANS = {'TRUE': True, 'FALSE': False}
+
+
+def typed_value(text):
+    """classify text written to a cell: return the int or float it writes ('-12', '1.5e3'), True or
+    False for 'TRUE' and 'FALSE' (any case), the text itself otherwise (error values included)"""
+    stripped = text.strip()
+    if stripped[:1] in NUMBER_START and '_' not in stripped:
+        try:
+            number = float(stripped)
+        except ValueError:
+            return text
+        if not math.isfinite(number):
+            return text  # 'nan' and 'inf' are kept as text
+        return int(number) if number.is_integer() and abs(number) <= 2 ** 53 else number
+    if len(stripped) <= 5:
+        return BOOLEANS.get(stripped.upper(), text)
+    return text
+
+
+class CellStore:
+    """Sparse, column oriented storage for the cells of a sheet.
+
+    Every column is cut into blocks of BLOCK_ROWS rows. A block holds the numbers of
+    its rows in an array('d') next to a bytearray of type tags, so a numeric cell
+    costs BYTES_PER_NUMERIC_CELL bytes instead of a whole dict. Blocks are only
+    allocated the first time one of their cells is written, which means that empty
+    cells (and growing the sheet) take no memory.
+    Booleans are stored in the blocks as 1.0 and 0.0 with their own tag. Text, error values
+    (like '#DIV/0!', with their own tag) and any other object, and formulas live in sparse
+    dictionaries keyed by the integer (row, col) of the cell.
+    Text is typed once, when it is written: a cell never holds a number as text.
+    A block may also be a pair of read-only memoryviews of a memory-mapped file (see
+    native_format) or of a block shared with a copy of the store (see copy), it is copied
+    to an array and a bytearray the first time it is written.
+    """
+    EMPTY = 0
+    INT = 1
+    FLOAT = 2
+    OBJECT = 3  # the value lives in self.objects
+    BOOL = 4  # 1.0 or 0.0 in the numbers of the block
+    ERROR = 5  # an error value of ERRORS, in self.objects
+
+    BLOCK_ROWS = 1024
+    BYTES_PER_NUMERIC_CELL = 9  # 8 bytes for the double + 1 byte for the type tag
+
+    # bytes.translate table that turns a slice of tags to a mask of the numeric cells
+    NUMERIC_MASK = bytes([0, 1, 1]) + bytes(253)  # 1 for INT and FLOAT
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.columns = {}  # col -> {block index -> (array('d'), bytearray)}
+        self.objects = {}  # (row, col) -> non numeric value
+        self.formulas = {}  # (row, col) -> formula text
+
+    def copy(self):
+        """return an independent copy of the store. The blocks are not copied: both stores share
+        them as read-only memoryviews, like the blocks of a mapped file, and the first store that
+        writes to a block copies it (see writable_block). the dictionaries are copied"""
+        for column in self.columns.values():
+            for index, (numbers, tags) in column.items():
+                if isinstance(tags, bytearray):
+                    column[index] = (memoryview(numbers).toreadonly(), memoryview(tags).toreadonly())
+        store = CellStore(self.rows, self.cols)
+        store.columns = {col: dict(column) for col, column in self.columns.items()}
+        store.objects = dict(self.objects)
+        store.formulas = dict(self.formulas)
+        return store
+
+    def __getstate__(self):
+        """pickle the blocks of a mapped file as arrays, memoryviews can't be pickled"""
+        state = dict(self.__dict__)
+        state['columns'] = {col: {index: (numbers, tags) if isinstance(tags, bytearray)
+                                  else (array('d', numbers.tobytes()), bytearray(tags))
+                                  for index, (numbers, tags) in column.items()}
+                            for col, column in self.columns.items()}
+        return state
+
+    def get_block(self, row, col):
+        """return the (numbers, tags) block holding a cell, or None if it was never allocated"""
+        column = self.columns.get(col)
+        if column is None:
+            return None
+        return column.get(row // self.BLOCK_ROWS)
+
+    def allocate_block(self, row, col, source=None):
+        """create the block holding a cell the first time it is written to, or a writable copy
+        of a read-only source block"""
+        if source is None:
+            block = (array('d', bytes(8 * self.BLOCK_ROWS)), bytearray(self.BLOCK_ROWS))
+        else:
+            numbers = array('d')
+            numbers.frombytes(source[0].tobytes())
+            block = (numbers, bytearray(source[1]))
+        self.columns.setdefault(col, {})[row // self.BLOCK_ROWS] = block
+        return block
+
+    def writable_block(self, row, col):
+        """return the block holding a cell, allocated (or copied from a mapped file) for writing"""
+        block = self.get_block(row, col)
+        if block is None or not isinstance(block[1], bytearray):
+            block = self.allocate_block(row, col, block)
+        return block
+
+    def set_value(self, row, col, value):
+        """store a value, numbers and booleans go to the column blocks and anything else to the
+        sparse map. text is typed first (see typed_value), numbers written as text are stored as numbers"""
+        if isinstance(value, str):
+            value = typed_value(value)
+        numbers, tags = self.writable_block(row, col)
+        offset = row % self.BLOCK_ROWS
+        if isinstance(value, bool):
+            tag = self.BOOL
+        elif isinstance(value, float) or (isinstance(value, int) and abs(value) <= 2 ** 53):
+            tag = self.INT if isinstance(value, int) else self.FLOAT
+        else:
+            # not a number, or an int too big to be stored exactly in a double
+            self.objects[(row, col)] = value
+            tags[offset] = self.ERROR if isinstance(value, str) and value in ERRORS else self.OBJECT
+            return
+        if tags[offset] == self.OBJECT or tags[offset] == self.ERROR:
+            del self.objects[(row, col)]
+        tags[offset] = tag
+        numbers[offset] = value
+
+    def get_value(self, row, col, default=''):
+        """return the stored value of a cell, default if the cell was never set"""
+        block = self.get_block(row, col)
+        if block is None:
+            return default
+        offset = row % self.BLOCK_ROWS
+        tag = block[1][offset]
+        if tag == self.FLOAT:
+            return block[0][offset]
+        if tag == self.INT:
+            return int(block[0][offset])
+        if tag == self.OBJECT or tag == self.ERROR:
+            return self.objects[(row, col)]
+        if tag == self.BOOL:
+            return block[0][offset] != 0
+        return default
+
+    def number_at(self, row, col):
+        """return the number of a cell as a float, None if the cell holds no number. the accessor of
+        the formula engine: one tag test, nothing is parsed or converted"""
+        column = self.columns.get(col)
+        if column is not None:
+            block = column.get(row // self.BLOCK_ROWS)
+            if block is not None:
+                offset = row % self.BLOCK_ROWS
+                tag = block[1][offset]
+                if tag == self.FLOAT or tag == self.INT:
+                    return block[0][offset]
+        return None
+
+    def is_empty(self, row, col):
+        block = self.get_block(row, col)
+        return block is None or block[1][row % self.BLOCK_ROWS] == self.EMPTY
+
+    def clear_value(self, row, col):
+        if not self.is_empty(row, col):
+            self.writable_block(row, col)[1][row % self.BLOCK_ROWS] = self.EMPTY
+        self.objects.pop((row, col), None)
+
+    def set_formula(self, row, col, formula):
+        self.formulas[(row, col)] = formula
+
+    def get_formula(self, row, col):
+        return self.formulas.get((row, col))
+
+    def insert_row(self):
+        """grow the sheet by one row, blocks are allocated only when the new cells are written"""
+        self.rows += 1
+
+    def used_cells(self):
+        """yield (row, col) of every cell holding a value or a formula, column by column.
+        formula cells without a value come last"""
+        for col in sorted(self.columns):
+            column = self.columns[col]
+            for index in sorted(column):
+                first_row = index * self.BLOCK_ROWS
+                for offset in compress(range(self.BLOCK_ROWS), column[index][1]):
+                    yield first_row + offset, col
+        for row, col in self.formulas:
+            if self.is_empty(row, col):
+                yield row, col
+
+    def used_bounds(self):
+        """return (rows, cols) up to the last row and the last column holding a value or a formula"""
+        rows = cols = 0
+        for col, column in self.columns.items():
+            for index, (numbers, tags) in column.items():
+                used = len(bytes(tags).rstrip(b'\0'))
+                if used:
+                    rows = max(rows, index * self.BLOCK_ROWS + used)
+                    cols = max(cols, col + 1)
+        for row, col in self.formulas:
+            rows = max(rows, row + 1)
+            cols = max(cols, col + 1)
+        return rows, cols
+
+    def column_slices(self, start_row, start_col, end_row, end_col):
+        """yield (numbers, tags, col, first_row) for the allocated parts of a range, one column block
+        at a time. numbers and tags are numpy views when numpy is installed (no copy is made)"""
+        rows_per_block = self.BLOCK_ROWS
+        load_numpy()
+        for col in range(start_col, end_col + 1):
+            column = self.columns.get(col)
+            if not column:
+                continue
+            for index in range(start_row // rows_per_block, end_row // rows_per_block + 1):
+                block = column.get(index)
+                if block is None:
+                    continue
+                first_row = index * rows_per_block
+                start = max(start_row - first_row, 0)
+                stop = min(end_row - first_row + 1, rows_per_block)
+                numbers, tags = block
+                if np is not None:
+                    yield (np.frombuffer(numbers, dtype=np.float64)[start:stop],
+                           np.frombuffer(tags, dtype=np.uint8)[start:stop], col, first_row + start)
+                else:
+                    # bytes() copies the tags of mapped blocks, memoryviews have no find/translate
+                    yield numbers[start:stop], bytes(tags[start:stop]), col, first_row + start
+
+    def numeric_slices(self, start_row, start_col, end_row, end_col):
+        """yield (values, mask, col, first_row) for the allocated parts of a range. values holds
+        the number of every numeric cell and 0 elsewhere, mask is 1 for numeric cells and 0 elsewhere"""
+        for numbers, tags, col, first_row in self.column_slices(start_row, start_col, end_row, end_col):
+            if np is not None:
+                mask = ((tags == self.INT) | (tags == self.FLOAT)).astype(np.uint8)
+                values = np.where(mask, numbers, 0.0)
+            else:
+                mask = bytearray(tags.translate(self.NUMERIC_MASK))
+                values = array('d', [number if numeric else 0.0 for number, numeric in zip(numbers, mask)])
+            yield values, mask, col, first_row
+
+    def numeric_chunks(self, start_row, start_col, end_row, end_col):
+        """yield the numeric values of a range one column block at a time, as numpy arrays when
+        numpy is installed and as iterables otherwise"""
+        for numbers, tags, col, first_row in self.column_slices(start_row, start_col, end_row, end_col):
+            if np is not None:
+                yield numbers[(tags == self.INT) | (tags == self.FLOAT)]
+            else:
+                yield compress(numbers, tags.translate(self.NUMERIC_MASK))
+
+    def range_sum(self, start_row, start_col, end_row, end_col):
+        """sum of the numeric cells of a range"""
+        total = 0
+        for chunk in self.numeric_chunks(start_row, start_col, end_row, end_col):
+            total += chunk.sum().item() if is_array(chunk) else sum(chunk)
+        return total
+
+    def range_count(self, start_row, start_col, end_row, end_col):
+        """number of numeric cells in a range"""
+        count = 0
+        for numbers, tags, col, first_row in self.column_slices(start_row, start_col, end_row, end_col):
+            if np is not None:
+                count += int(np.count_nonzero((tags == self.INT) | (tags == self.FLOAT)))
+            else:
+                count += tags.translate(self.NUMERIC_MASK).count(1)
+        return count
+
+    def range_max(self, start_row, start_col, end_row, end_col):
+        """largest numeric cell of a range, None if the range has no numbers"""
+        result = None
+        for chunk in self.numeric_chunks(start_row, start_col, end_row, end_col):
+            if is_array(chunk):
+                value = chunk.max().item() if chunk.size else None
+            else:
+                value = max(chunk, default=None)
+            if value is not None and (result is None or value > result):
+                result = value
+        return result
+
+    def range_min(self, start_row, start_col, end_row, end_col):
+        """smallest numeric cell of a range, None if the range has no numbers"""
+        result = None
+        for chunk in self.numeric_chunks(start_row, start_col, end_row, end_col):
+            if is_array(chunk):
+                value = chunk.min().item() if chunk.size else None
+            else:
+                value = min(chunk, default=None)
+            if value is not None and (result is None or value < result):
+                result = value
+        return result
+
+    def nbytes(self):
+        """memory used by the numeric column blocks, in bytes"""
+        total = 0
+        for column in self.columns.values():
+            for numbers, tags in column.values():
+                total += numbers.itemsize * len(numbers) + len(tags)
+        return total